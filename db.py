@@ -1,7 +1,13 @@
+import _strptime  # Imported before threads call datetime.strptime (lazy import is not thread safe)
+import atexit
+import collections
+import itertools
 import json
 import os
 import random
 import re
+import threading
+from multiprocessing.pool import ThreadPool
 from pprint import pprint
 
 import numpy as np
@@ -13,8 +19,10 @@ from pydal import DAL, Field
 import chdiff
 from editdist import edit_distance
 from json_plus import Serializable
+from revision_cache import RevisionCache
 from serializer import json_to_data, data_to_json
-from wikipedia import WikiFetch
+import wikipedia
+from wikipedia import WikiFetch, restore_request_limits, set_request_limits, set_revision_cache
 
 # Some constants to be used in DataAccess operations
 DATE_PATTERN = "%Y-%m-%dT%H:%M:%SZ"  # "%Y-%b%a, %d %b %Y %H:%M:%S %z"
@@ -23,6 +31,36 @@ ALPHA = 0.5
 SECS_IN_HR = 3600
 HRS_IN_WEEK = 168
 
+# Concurrent crawling (DataAccess.collect_contributions_concurrent)
+CRAWL_USERS_AT_ONCE = 8  # Users whose revisions are fetched at the same time
+CRAWL_MAX_IN_FLIGHT = 16  # Requests to Wikipedia in flight
+CRAWL_RATE = 20.0  # Requests to Wikipedia per second, None for no limit
+
+# Cache of fetched revisions, shared by all DataAccess objects
+REVISION_CACHE_FILE = os.path.join("data", "revision_cache.sqlite")
+REVISION_CACHE_SIZE = 10000  # Revisions held in memory
+_REVISION_CACHE_OBJ = None
+
+# Columns of revisions_restore exported per revision by load_fresh_from_db, in feature order
+EXPORT_FEATURE_COLUMNS = ['time_prev_user', 'time_prev_page', 'time_prev_user_page', 'chars_added',
+                          'chars_removed', 'spread', 'position_in_page', 'time_in_day', 'day_of_week',
+                          'rev_comment_length', 'upper_lower_ratio', 'digit_total_ratio', 'time_next_page', 'q10']
+
+# Columns of revisions_restore whose mean and std are used by _normalize_inputs, by key prefix
+NORMALIZATION_COLUMNS = [('com_len', 'rev_comment_length'),
+                         ('char_add', 'chars_added'),
+                         ('char_rem', 'chars_removed')]
+
+# Secondary indexes of the hot queries, as (index name, table, columns), for self.db and self.ug_db
+DB_INDEXES = [('revisions_restore_username_idx', 'revisions_restore', ['username']),
+              ('revisions_restore_revid_idx', 'revisions_restore', ['revid']),
+              ('authors_completed_idx', 'authors', ['completed', 'user_since', 'contributions'])]
+GRAPH_DB_INDEXES = [('graph_edge_uname1_rev1_idx', 'graph_edge', ['uname1', 'rev1'])]
+
+# Rows per INSERT statement of insert_graph_edges, keeping the bound values of
+# a statement under SQLite's default limit of 999
+GRAPH_INSERT_ROWS = 45
+
 
 def _normalize_inputs(features, gen_values, last_two=False):
     """
@@ -49,95 +87,449 @@ def _normalize_inputs(features, gen_values, last_two=False):
     :param features: Features of entry
     :param gen_values: General values to be used for normalization
     :param last_two: Boolean to control whether last two (time_to_next, quality) values should be touched
-    :return: normalized array for each row
+    :return: normalized array for each row, as the row of normalize_feature_matrix
+    """
+    n_cols = 14 if last_two else 12
+    return normalize_feature_matrix([features[:n_cols]], gen_values, last_two=last_two)[0]
+
+
+def normalize_feature_matrix(features, gen_values, last_two=False, out=None):
+    """
+    Normalize a matrix of feature rows to be in the range [0,1]
+    in one pass, applying the rule of each feature to its whole column.
+    The features are those listed in _normalize_inputs.
+
+    :param features: Matrix of shape (R, 12), or (R, 14) with last_two
+    :param gen_values: General values to be used for normalization
+    :param last_two: Boolean to control whether last two (time_to_next, quality) values should be touched
+    :param out: Matrix of shape (R, 12) or (R, 14) to write into. A new one if None
+    :return: Normalized matrix
+    :rtype: np.ndarray
     """
-    norm_list = []
+    features = np.asarray(features, dtype=np.float64)
+    n_cols = 14 if last_two else 12
+    if out is None:
+        out = np.empty((features.shape[0], n_cols))
+
+    def z_score(column, prefix):
+        val = 1.0 * (features[:, column] - gen_values.get(prefix + '_mean')) / gen_values.get(prefix + '_std')
+        np.clip(val, -3.0, 3.0, out=val)
+        return 1.0 * (val + 3) / 6.0
+
     # Time values - 0,1,2
     # Clip them
-    # print features
-    norm_list = [np.clip(1.0 * i / (1.0 * SECS_IN_HR * HRS_IN_WEEK), 0.0, 1.0) for i in features[:3]]
+    out[:, :3] = np.clip(1.0 * features[:, :3] / (1.0 * SECS_IN_HR * HRS_IN_WEEK), 0.0, 1.0)
 
     # Char measurement -3,4
     # Z-score
-    char_add_val = 1.0 * (features[3] - gen_values.get(('char_add_mean'))) / gen_values.get('char_add_std')
-    char_add_val = np.clip(char_add_val, -3.0, 3.0)
-    char_add_val = 1.0 * (char_add_val + 3) / 6.0
-    norm_list.append(char_add_val)
-
-    char_rem_val = 1.0 * (features[4] - gen_values.get(('char_rem_mean'))) / gen_values.get('char_rem_std')
-    char_rem_val = np.clip(char_rem_val, -3.0, 3.0)
-    char_rem_val = 1.0 * (char_rem_val + 3) / 6.0
-    norm_list.append(char_rem_val)
+    out[:, 3] = z_score(3, 'char_add')
+    out[:, 4] = z_score(4, 'char_rem')
 
     # Unchanged - 5,6
-    norm_list.append(features[5])
-    norm_list.append(features[6])
+    out[:, 5:7] = features[:, 5:7]
 
     # Time in day - 7
-    # sin(2*pi*h/24)
-    new_val = np.sin(2 * np.pi * features[7] / 24)
-    # Put in [0,1] range
-    norm_list.append(1.0 * (new_val + 1.0) / 2.0)
+    # sin(2*pi*h/24), put in [0,1] range
+    out[:, 7] = 1.0 * (np.sin(2 * np.pi * features[:, 7] / 24) + 1.0) / 2.0
 
     # Day of week - 8
     # Divide by 7
-    norm_list.append(1.0 * features[8] / 7.0)
+    out[:, 8] = 1.0 * features[:, 8] / 7.0
 
     # Rev comment Lenght - 9
     # Z-score
-    comm_len_val = 1.0 * (features[9] - gen_values.get(('com_len_mean'))) / gen_values.get('com_len_std')
-    comm_len_val = np.clip(comm_len_val, -3.0, 3)
-    comm_len_val = 1.0 * (comm_len_val + 3) / 6.0
-    norm_list.append(comm_len_val)
+    out[:, 9] = z_score(9, 'com_len')
 
     # Upper lower ratio - 10
     # Divide by 2 and clip between [0,1]
-    ul_original = features[10]
-    ul_new = np.clip(1.0 * ul_original / 2.0, 0, 1)
-    norm_list.append(ul_new)
+    out[:, 10] = np.clip(1.0 * features[:, 10] / 2.0, 0, 1)
 
     # Digit total ratio - 11
     # Unchanged
-    norm_list.append(features[11])
+    out[:, 11] = features[:, 11]
 
     if last_two:
         # Time to next -12
-        # Unchanged
-        norm_list.append((features[12] * 1.0) / (1.0 * SECS_IN_HR * HRS_IN_WEEK))
+        out[:, 12] = (features[:, 12] * 1.0) / (1.0 * SECS_IN_HR * HRS_IN_WEEK)
 
-        # Quality -12
+        # Quality -13
         # Scale
-        q_new = 1.0 * (features[13] + 1.0) / 2.0
-        norm_list.append(q_new)
+        out[:, 13] = 1.0 * (features[:, 13] + 1.0) / 2.0
+
+    return out
 
-    return np.array(norm_list)
 
+def _get_revision_cache():
+    global _REVISION_CACHE_OBJ
+    if _REVISION_CACHE_OBJ is None:
+        _REVISION_CACHE_OBJ = RevisionCache(REVISION_CACHE_FILE, max_items=REVISION_CACHE_SIZE)
+        atexit.register(_REVISION_CACHE_OBJ.flush)
+    return _REVISION_CACHE_OBJ
 
-def _operate_on_contributions(c, username):
+
+def save_dataset(filename, data_dict):
     """
-    Operate on the contributions sent for a user.
+    Write a dataset of {author: (x_mat, fy, yt)} as one .npz of flat arrays:
+    authors, x (all x_mat rows stacked), x_offsets (start of each author's rows, len(authors) + 1),
+    fy (one row per author) and yt.
 
-    :param contributions:
-    :return:
+    :param filename: Path of .npz file
+    :param data_dict: Dataset as built by DataAccess.load_fresh_from_db
+    """
+    authors = sorted(data_dict.keys())
+    x_mats = [data_dict[a][0] for a in authors]
+    offsets = np.cumsum([0] + [len(x) for x in x_mats])
+
+    with open(filename + '.tmp', 'wb') as output:
+        np.savez(output,
+                 authors=np.array(authors, dtype=unicode),
+                 x=np.concatenate(x_mats) if x_mats else np.zeros((0, 14)),
+                 x_offsets=offsets,
+                 fy=np.array([data_dict[a][1] for a in authors]).reshape(len(authors), -1),
+                 yt=np.array([data_dict[a][2] for a in authors], dtype=np.float64))
+    os.rename(filename + '.tmp', filename)
+
+
+def load_dataset(filename):
+    """
+    Read a dataset written by save_dataset
+
+    :param filename: Path of .npz file
+    :return: Dict of {author: (x_mat, fy, yt)}
+    :rtype: dict
+    """
+    data = np.load(filename)
+    offsets = data['x_offsets']
+    x, fy, yt = data['x'], data['fy'], data['yt']
+    return {a: (x[offsets[i]:offsets[i + 1]], fy[i], yt[i]) for i, a in enumerate(data['authors'])}
+
+
+def _revision_lookups(c, username, curr=None):
+    """
+    Wikipedia lookups needed for the features of the revision of contribution c.
+
+    Lookups on the current revision (parent, next, previous by user) take
+    its ids and timestamp from curr when given, else from the contribution,
+    which has the same ones. This lets all lookups be issued at once.
+
+    :param c: Contribution, with at least pageid and revid
+    :param username: Author of the revision
+    :param curr: Current revision, as fetched by the 'curr' lookup
+    :return: Dict of lookup name to (function, kwargs)
+    :rtype: dict
     """
     w = WikiFetch
-    user_revision = w.fetch_revisions_for_page(pageid=c['pageid'],
-                                               start_rev=c['revid'],
-                                               chunk_size=1, )
+    rev = curr if curr is not None else c
+    return {
+        # This revision
+        'curr': (w.fetch_revisions_for_page, dict(pageid=c['pageid'],
+                                                  start_rev=c['revid'],
+                                                  chunk_size=1)),
+        # Previous revision by another author
+        'prev': (w.fetch_revisions_for_page, dict(pageid=c['pageid'],
+                                                  start_rev=c['revid'],
+                                                  chunk_size=1,
+                                                  direction="older",  # Gets older revisions
+                                                  exclude=username)),  # excludes same user
+        # Next (upto 10) revisions by different authors
+        'following': (w.fetch_revisions_for_page, dict(pageid=c['pageid'],
+                                                       start_rev=c['revid'],
+                                                       chunk_size=10,
+                                                       direction="newer",  # Gets later revisions
+                                                       exclude=username)),
+        # Parent revision, using parentID
+        'parent': (w.fetch_revisions_for_page, dict(pageid=c['pageid'],
+                                                    start_rev=rev.get('parentid', None),
+                                                    chunk_size=1, )),
+        # This revision and the next one on page
+        'next': (w.fetch_revisions_for_page, dict(pageid=c['pageid'],
+                                                  start_rev=rev['revid'],
+                                                  chunk_size=2,
+                                                  direction="newer", )),
+        # This contribution and the previous one by user
+        'user_before': (w.get_user_contributions, dict(username=username,
+                                                       cont_limit=2,
+                                                       start_time=rev.get('timestamp'),
+                                                       direction="older")),
+        # Previous revision by user on this page
+        'user_page_before': (_get_previous_by_user_on_page, dict(username=username,
+                                                                 page=c['pageid'],
+                                                                 revision=rev.get('revid', None))),
+    }
+
+
+def _call_lookup(lookup):
+    """
+    Make a lookup of _revision_lookups, catching its error
 
-    prev_revision = w.fetch_revisions_for_page(pageid=c['pageid'],
-                                               start_rev=c['revid'],
-                                               chunk_size=1,
-                                               direction="older",  # Gets older revisions
-                                               exclude=username)  # excludes same user
+    :param lookup: (function, kwargs)
+    :return: (result, error)
+    """
+    function, kwargs = lookup
+    try:
+        return function(**kwargs), None
+    except Exception as e:
+        return None, e
 
-    next_revisions = w.fetch_revisions_for_page(pageid=c['pageid'],
-                                                start_rev=c['revid'],
-                                                chunk_size=10,
-                                                direction="newer",  # Gets later revisions
-                                                exclude=username)
 
-    return user_revision, prev_revision, next_revisions
+def _lookup_failed(name, result, error):
+    """
+    Whether the result of a lookup stops the features of its revision
+    (see the checks of _revision_features)
+    """
+    if error is not None:
+        return True
+    if name in ('curr', 'prev', 'parent'):
+        return not result
+    if name == 'next':
+        return len(result) < 2
+    return False
+
+
+class _FirstFailure(object):
+    """
+    Position of the first contribution of a user found to stop the crawl
+    of the user, shared by the threads making its lookups.
+    """
+
+    def __init__(self):
+        self.position = None
+        self._lock = threading.Lock()
+
+    def record(self, position):
+        with self._lock:
+            if self.position is None or position < self.position:
+                self.position = position
+
+    def after(self, position):
+        """
+        Whether position comes after the first failure, so its lookups are not needed
+        """
+        first = self.position
+        return first is not None and position > first
+
+
+# Result of a lookup not made because an earlier contribution failed
+_SKIPPED = object()
+
+
+def _call_user_lookup(name, lookup, position, failure):
+    """
+    Make a lookup for the contribution at position, unless an earlier
+    contribution of the user failed. A failed lookup is recorded in failure.
+
+    :return: (result, error), or _SKIPPED
+    """
+    if failure.after(position):
+        return _SKIPPED
+    result, error = _call_lookup(lookup)
+    if _lookup_failed(name, result, error):
+        failure.record(position)
+    return result, error
+
+
+def _revision_features(c, username, fetched=None):
+    """
+    Features of the revision of contribution c, as stored in revisions_restore.
+
+    Lookups are made in the order of the features. A lookup found in
+    fetched with the same arguments is taken from there (raising its
+    error, if it had one) instead of being made again.
+
+    :param c: Contribution, with at least pageid and revid
+    :param username: Author of the revision
+    :param fetched: Dict of lookup name to (kwargs, result, error) of lookups already made
+    :return: Dict of features, None if a revision needed could not be fetched
+    :rtype: dict
+    """
+
+    def lookup(name, curr=None):
+        function, kwargs = _revision_lookups(c, username, curr)[name]
+        if fetched is not None and name in fetched and fetched[name][0] == kwargs:
+            _, result, error = fetched[name]
+            if error is not None:
+                raise error
+            return result
+        return function(**kwargs)
+
+    # Wikipedia PageID of the revision under consideration
+    pageid = c.get('pageid')
+
+    # curr is this revision
+    # prev is previous revision by another author
+    # following is list of next (upto 10) revisions by different authors
+    curr, prev, following = lookup('curr'), lookup('prev'), lookup('following')
+
+    # Some checks since web data can often lead to unknown errors. (eg 500 from Wikipedia server)
+    # Current revision and previous revision by another author on page are
+    # important for quality measurements. So make sure they exist
+    if not curr or not prev:
+        return None
+
+    # Get individual entry from list curr
+    curr = curr[0]
+
+    # Basic features of current revision
+    t_curr = datetime.strptime(curr.get('timestamp'), DATE_PATTERN)
+    content_curr = curr.get('*', '')
+    parent_curr = curr.get('parentid', None)
+
+    # Get parent revision of current using parentID
+    # Features of parent revision are required in order to
+    # measure distance and char update values of this revision
+    parent_rev = lookup('parent', curr)
+    # Do not use the revision if parent_rev can't be fetched.
+    if not parent_rev:
+        return None
+
+    # Basic features of parent revision
+    parent_rev = parent_rev[0]
+    content_parent = parent_rev.get('*', '')
+    t_prev_page = datetime.strptime(parent_rev.get('timestamp'), DATE_PATTERN)
+
+    # Get next revision on page for future time feature
+    # The call will include current revision also
+    next_rev = lookup('next', curr)
+
+    # Check if next revision was retrieved or not
+    # If not then do not continue with this
+    if len(next_rev) < 2:
+        return None
+
+    # To get time feature from next revision on this page
+    next_rev = next_rev[1]
+    t_next_page = datetime.strptime(next_rev.get('timestamp'), DATE_PATTERN)
+
+    # Get distances from parent revision
+    # Here we get character features by comparing current revision with parent revision
+    feature_dict = _get_distances(content_curr, content_parent)
+    feature_dict['current_rev_length'] = len(content_curr)
+    feature_dict['parent_rev_length'] = len(content_parent)
+
+    # Now add action features to this set of character features
+    feature_dict['rev_comment_length'] = len(curr.get('comment', ''))
+    feature_dict['time_in_day'] = t_curr.hour
+    feature_dict['day_of_week'] = t_curr.weekday()
+
+    # Getting time features now by using current, previous and next tinmes.
+
+    # Time from previous revision on page
+    feature_dict['time_prev_page'] = (t_curr - t_prev_page).total_seconds()
+
+    # Time to next on page
+    feature_dict['time_next_page'] = (t_next_page - t_curr).total_seconds()
+
+    # Time from previous revision by user
+    # The call will include current revision also
+    contribution_before = lookup('user_before', curr)
+
+    t_user_prev = datetime.strptime(contribution_before[1].get('timestamp'), DATE_PATTERN) if len(
+        contribution_before) > 1 else 0
+
+    feature_dict['time_prev_user'] = (t_curr - t_user_prev).total_seconds() if t_user_prev else 0.0
+
+    # Time from previous revision by user on this page
+    t_user_page_prev = lookup('user_page_before', curr)
+
+    feature_dict['time_prev_user_page'] = (
+        t_curr - t_user_page_prev).total_seconds() if t_user_page_prev else 0.0
+
+    # Fill in remaining entries of revision dict
+    # to be placed in the DB. These include values from
+    # result dict obtained by calling Wikimedia API
+    feature_dict['revid'] = curr.get('revid')
+    feature_dict['pageid'] = pageid
+    feature_dict['parentid'] = parent_curr
+    feature_dict['username'] = username
+    feature_dict['rev_timestamp'] = t_curr  # To get it as datetime type
+    feature_dict['userid'] = curr['userid']
+    feature_dict['rev_content'] = content_curr
+    feature_dict['rev_comment'] = curr.get('comment', '')
+    feature_dict['rev_size'] = curr['size']
+
+    # Now we need to calculate the quality of this revision by
+    # using a revision prior to it from a different author and
+    # using next 10 revisions by different authors
+    # Measure quality for current revision
+    feature_dict['q4'] = _measure_revision_quality(curr=curr, prev=prev, foll=following, next_count=4)
+    feature_dict['q6'] = _measure_revision_quality(curr=curr, prev=prev, foll=following, next_count=6)
+    feature_dict['q10'] = _measure_revision_quality(curr=curr, prev=prev, foll=following, next_count=10)
+
+    return feature_dict
+
+
+def _batched_lookups(contributions, username):
+    """
+    Make the 'curr' and 'parent' lookups of _revision_lookups for all the
+    contributions of a user with batched requests (WikiFetch.fetch_revisions_by_ids).
+    Revisions not returned are left to be looked up one by one.
+
+    :param contributions: Contributions of the user
+    :param username: Username of user
+    :return: List of fetched dicts for _revision_features, one per contribution
+    :rtype: list
+    """
+    revids = set()
+    for c in contributions:
+        revids.add(c['revid'])
+        if c.get('parentid'):
+            revids.add(c['parentid'])
+    try:
+        revisions = WikiFetch.fetch_revisions_by_ids(sorted(revids))
+    except Exception as e:
+        # A failed batch is only a missed shortcut: its revisions are looked up one by one
+        print e
+        revisions = {}
+
+    fetched = []
+    for c in contributions:
+        lookups = _revision_lookups(c, username)
+        batched = {}
+        for name, revid in (('curr', c['revid']), ('parent', c.get('parentid'))):
+            if revid in revisions:
+                batched[name] = (lookups[name][1], [revisions[revid]], None)
+        fetched.append(batched)
+    return fetched
+
+
+def _fetch_user_revisions(username, request_pool):
+    """
+    Get the contributions of a user and make all the lookups of
+    _revision_lookups for all of them at once: current and parent
+    revisions in batches, the others on request_pool. Once a lookup
+    shows that a contribution can't be completed, the lookups of later
+    contributions are dropped (any needed after all are made by
+    _revision_features).
+    Run in a thread of DataAccess.collect_contributions_concurrent.
+
+    :param username: Username of user
+    :param request_pool: Thread pool making the requests
+    :return: (contributions, list of fetched dicts for _revision_features, one per contribution)
+    :rtype: tuple
+    """
+    contributions = WikiFetch.get_user_contributions(username=username,
+                                                     cont_limit=50, )
+    if len(contributions) < 3:
+        return contributions, None
+
+    fetched = _batched_lookups(contributions, username)
+
+    # Contributions after the first one which can't be completed are not stored,
+    # so their lookups still queued are skipped
+    failure = _FirstFailure()
+    pending = []
+    for position, (c, batched) in enumerate(zip(contributions, fetched)):
+        lookups = _revision_lookups(c, username)
+        pending.append({name: (lookup[1], request_pool.apply_async(_call_user_lookup,
+                                                                   (name, lookup, position, failure)))
+                        for name, lookup in lookups.iteritems() if name not in batched})
+
+    for batched, results in zip(fetched, pending):
+        for name, (kwargs, async_result) in results.iteritems():
+            result = async_result.get()
+            if result is not _SKIPPED:
+                batched[name] = (kwargs, ) + result
+    return contributions, fetched
 
 
 def _get_distances(r1, r2, distance_only=False):
@@ -473,6 +865,16 @@ class DataAccess:
                                                migrate=False
                                                )
 
+        # Running count, mean and sum of squared deviations of NORMALIZATION_COLUMNS,
+        # over the revisions_restore rows with id up to last_id
+        self.normalization_stats = self.db.define_table('normalization_stats',
+                                                        Field('column_name', unique=True),
+                                                        Field('row_count', 'integer'),
+                                                        Field('last_id', 'integer'),
+                                                        Field('mean', 'double'),
+                                                        Field('m2', 'double'),
+                                                        migrate=True)
+
         self.db.commit()
 
         self.ug_db = DAL('sqlite://graph_storage2.sqlite', folder="data")
@@ -503,7 +905,141 @@ class DataAccess:
 
         self.ug_db.commit()
 
+        self.create_indexes()
+
         self.wiki = WikiFetch()
+        set_revision_cache(_get_revision_cache())
+
+    @staticmethod
+    def _create_indexes(db, indexes):
+        """
+        Create the missing indexes of a db. Indexes of tables which do not
+        exist yet are skipped, and created by a later call.
+
+        :param db: DAL connection
+        :param indexes: List of (index name, table, columns)
+        :return: Names of the indexes serving the list
+        :rtype: list
+        """
+        tables = set(r[0] for r in db.executesql("SELECT name FROM sqlite_master WHERE type='table';"))
+        present = []
+        for name, table, columns in indexes:
+            if table not in tables:
+                continue
+            # An index on the same columns, as made for unique fields, already serves the queries
+            existing = [r[1] for r in db.executesql('PRAGMA index_list(%s);' % table)]
+            covered = [i for i in existing
+                       if i != name and [r[2] for r in db.executesql('PRAGMA index_info(%s);' % i)] == columns]
+            if covered:
+                present.append(covered[0])
+                continue
+            db.executesql('CREATE INDEX IF NOT EXISTS %s ON %s (%s);' % (name, table, ', '.join(columns)))
+            present.append(name)
+        db.commit()
+        return present
+
+    def create_indexes(self):
+        """
+        Create the indexes of DB_INDEXES and GRAPH_DB_INDEXES which do not
+        exist yet. Safe to call at every startup.
+
+        :return: Names of the indexes serving DB_INDEXES and GRAPH_DB_INDEXES
+        :rtype: list
+        """
+        return self._create_indexes(self.db, DB_INDEXES) + self._create_indexes(self.ug_db, GRAPH_DB_INDEXES)
+
+    def _hot_queries(self):
+        """
+        SQL of the frequent queries made through DataAccess, with
+        placeholder values
+
+        :return: List of (description, DAL connection, sql)
+        """
+        a, r, g = self.authors, self.revisions2, self.graph_edge
+        return [
+            ('users to collect', self.db,
+             self.db((a.user_since > START_TIME) & (a.contributions > 3) & (a.completed == False))._select(
+                 limitby=(1, 1000))),
+            ('completed users', self.db, self.db(a.completed == True)._select()),
+            ('revisions of completed users', self.db,
+             self.db((a.completed == True) & (r.username == a.username))._select(r.username, orderby=a.id | r.id)),
+            ('revisions of a user', self.db, self.db(r.username == '')._select()),
+            ('revision by revid', self.db, self.db(r.revid == 0)._select()),
+            ('edges of a user revision', self.ug_db, self.ug_db((g.uname1 == '') & (g.rev1 == ''))._select()),
+        ]
+
+    def explain_hot_queries(self, verbose=True):
+        """
+        Run EXPLAIN QUERY PLAN on the frequent queries and flag those
+        which scan a whole table or index instead of searching an index.
+
+        :param verbose: Print the plans, marking full scans
+        :return: Dict of query description to list of full table scan steps (empty if none)
+        :rtype: dict
+        """
+        ret_dict = {}
+        for description, db, sql in self._hot_queries():
+            try:
+                plan = [row[-1] for row in db.executesql('EXPLAIN QUERY PLAN ' + sql)]
+            except Exception as e:
+                # Table not created yet
+                if verbose:
+                    print "%s: not explained (%s)" % (description, e)
+                continue
+            scans = [step for step in plan if step.startswith('SCAN')]
+            ret_dict[description] = scans
+            if verbose:
+                print "%s%s" % (description, ': FULL SCAN' if scans else '')
+                for step in plan:
+                    print "    %s%s" % ('!! ' if step in scans else '', step)
+        return ret_dict
+
+    def begin_graph_load(self):
+        """
+        Set pragmas of the graph db for a bulk load: write ahead log
+        journal, and sync only at checkpoints instead of on every commit.
+        The journal and synchronous modes in use are kept for end_graph_load.
+        """
+        self._graph_pragmas = (self.ug_db.executesql('PRAGMA journal_mode')[0][0],
+                               self.ug_db.executesql('PRAGMA synchronous')[0][0])
+        self.ug_db.executesql('PRAGMA journal_mode=WAL')
+        self.ug_db.executesql('PRAGMA synchronous=NORMAL')
+
+    def end_graph_load(self):
+        """
+        Commit the bulk load and restore the journal and synchronous modes
+        in use before begin_graph_load
+        """
+        self.ug_db.commit()
+        journal_mode, synchronous = self._graph_pragmas
+        self.ug_db.executesql('PRAGMA journal_mode=%s' % journal_mode)
+        self.ug_db.executesql('PRAGMA synchronous=%d' % synchronous)
+
+    def insert_graph_edges(self, columns):
+        """
+        Insert rows into graph_edge with multi-row INSERT statements of
+        GRAPH_INSERT_ROWS rows each, in the current transaction. Nothing is
+        committed: the caller commits once per batch of batches (see
+        user_graph.add_to_graph).
+
+        :param columns: Dict of equal length lists keyed by graph_edge field names,
+                        as given by user_graph.parse_edit_lines with names resolved
+        :type columns: dict
+        :return: Number of rows inserted
+        :rtype: int
+        """
+        fields = [f for f in self.graph_edge.fields if f != 'id']
+        rows = zip(*[columns[f] for f in fields])
+        if not rows:
+            return 0
+
+        columns_sql = ', '.join('"%s"' % f for f in fields)
+        row_sql = '(%s)' % ', '.join('?' for _ in fields)
+        for start in range(0, len(rows), GRAPH_INSERT_ROWS):
+            chunk = rows[start:start + GRAPH_INSERT_ROWS]
+            sql = 'INSERT INTO graph_edge (%s) VALUES %s;' % (columns_sql, ', '.join([row_sql] * len(chunk)))
+            self.ug_db.executesql(sql, placeholders=[value for row in chunk for value in row])
+        return len(rows)
 
     def _get_main_normalization_values(self):
 
@@ -511,24 +1047,75 @@ class DataAccess:
         Contact revisions_extended table and measure required
         std and avg values per item
         These are DB level values to be used on individual normalizations
+
+        Aggregates are computed by SQLite over the needed columns only, and
+        kept in normalization_stats. Later calls only aggregate rows added
+        since (id above the stored last_id) and combine them with the
+        stored values. Rows updated in place by _store_revision reset
+        last_id, and the next call aggregates all rows again.
+
         :return: Dicrtionary of means and stds.
         """
+        stored = {r.column_name: r for r in self.db(self.normalization_stats).select()}
+        last_id = min([r.last_id for r in stored.itervalues()] or [0]) if len(stored) == len(NORMALIZATION_COLUMNS) else 0
+        if last_id == 0:
+            stored = {}
+
+        # Count and mean of new rows, per column
+        columns = [c for _, c in NORMALIZATION_COLUMNS]
+        row = self.db.executesql('SELECT MAX(id), %s FROM revisions_restore WHERE id > ?;' %
+                                 (', '.join('COUNT(%s), AVG(%s)' % (c, c) for c in columns)),
+                                 placeholders=[last_id])[0]
+        max_id = row[0]
+
+        if max_id is not None:
+            counts, means = row[1::2], row[2::2]
+            # Squared deviations from the mean of new rows
+            m2s = self.db.executesql('SELECT %s FROM revisions_restore WHERE id > ? AND id <= ?;' %
+                                     (', '.join('SUM((%s - ?) * (%s - ?))' % (c, c) for c in columns)),
+                                     placeholders=[v for m in means for v in (m, m)] + [last_id, max_id])[0]
+
+            for c, n_b, mean_b, m2_b in zip(columns, counts, means, m2s):
+                r = stored.get(c)
+                n_a, mean_a, m2_a = (r.row_count, r.mean, r.m2) if r is not None else (0, 0.0, 0.0)
+                n = n_a + n_b
+                if n_b:
+                    # Combination of (count, mean, M2) of two sets of rows
+                    delta = mean_b - mean_a
+                    mean_a, m2_a = mean_a + delta * n_b / n, m2_a + (m2_b or 0.0) + delta * delta * n_a * n_b / n
+                self.normalization_stats.update_or_insert(self.normalization_stats.column_name == c,
+                                                          column_name=c, row_count=n, last_id=max_id,
+                                                          mean=mean_a, m2=m2_a)
+            self.db.commit()
+            stored = {r.column_name: r for r in self.db(self.normalization_stats).select()}
+
         ret_dict = {}
+        for prefix, c in NORMALIZATION_COLUMNS:
+            r = stored.get(c)
+            if r is None or not r.row_count:
+                ret_dict[prefix + '_mean'] = ret_dict[prefix + '_std'] = np.nan
+                continue
+            ret_dict[prefix + '_mean'] = r.mean
+            ret_dict[prefix + '_std'] = np.sqrt(r.m2 / r.row_count)
 
-        data = self.db().select(self.revisions2.ALL)
-        com_lengths = [i.rev_comment_length for i in data]
-        ret_dict['com_len_mean'] = np.mean(com_lengths)
-        ret_dict['com_len_std'] = np.std(com_lengths)
+        return ret_dict
 
-        chars_add = [i.chars_added for i in data]
-        ret_dict['char_add_mean'] = np.mean(chars_add)
-        ret_dict['char_add_std'] = np.std(chars_add)
+    def _store_revision(self, feature_dict):
+        """
+        Insert the features of a revision into revisions_restore, or update
+        the row of the revision if it is already stored.
 
-        chars_rem = [i.chars_removed for i in data]
-        ret_dict['char_rem_mean'] = np.mean(chars_rem)
-        ret_dict['char_rem_std'] = np.std(chars_rem)
+        An update changes values already aggregated in normalization_stats,
+        so the stored aggregates are reset to be computed again from all rows.
 
-        return ret_dict
+        :param feature_dict: Features of the revision, with its revid
+        :return: Id of the inserted row, None if the row was updated
+        """
+        insert_return = self.revisions2.update_or_insert(self.revisions2.revid == feature_dict['revid'],
+                                                         **feature_dict)
+        if insert_return is None:
+            self.db(self.normalization_stats).update(last_id=0)
+        return insert_return
 
     def get_list_from_previous(self):
         """
@@ -577,23 +1164,10 @@ class DataAccess:
         :return: Returns total count of revisions fetched
         """
 
-        # Object for WikiFetch class (to communicate with Wikipedia)
-        w = WikiFetch()
-
         # Rveision count for total sum
         total_rev_count = 0
-        # Get users from the table. Controlled by 'cleaned' and 'completed'
-        q = (
-                self.authors.user_since > START_TIME) & (
-                self.authors.contributions > 3) & (
-                # self.authors.cleaned == True) & (
-                self.authors.completed == False
-            )
-        if not user_list:
-            users = self.db(q).select(limitby=(lim_start, lim_end))
-        else:
-            users = user_list
 
+        users = self._users_to_collect(lim_start, lim_end, user_list)
         print "Length of users: %r" % (len(users))
         # Get revisions for each user from Wikipedia
         for i in users:
@@ -608,193 +1182,184 @@ class DataAccess:
             # Since we have a really large number of users, we can avoid
             # such issues by not using the users.
             try:
-
-                if not user_list:
-
-                    # Remove if it is a bot
-                    if re.search("bot", i['username'], re.IGNORECASE):
-                        self.db(self.authors.id == i['id']).delete()
-                        print("{} deleted".format(i['username']))
-                        continue
-
-                    # Basic user values available in 'authors' table
-                    username = i['username']
-
-                else:
-                    username = i['username']
-
-                # Initialize a boolean to control completion of record
-                completed = True
+                username = self._user_to_crawl(i, user_list)
+                if username is None:
+                    continue
 
                 # Get the contributions for this user.
                 # Getting up to first 50
                 # Using the method written in wikipedia.py
                 # This call returns a list of contributions by this author
                 # with each entry of that list being a dict
-                contributions = w.get_user_contributions(username=username,
-                                                         cont_limit=50, )
+                contributions = WikiFetch.get_user_contributions(username=username,
+                                                                 cont_limit=50, )
                 print "Contributions by user (%r) are: %r" % (username, len(contributions))
 
                 # Don't operate if it has less than 3 revisions
                 if len(contributions) < 3:
                     continue
 
-                # Iterate over these contibutions and get their features
-                for c, v in enumerate(contributions):
-                    # Each contribution must be inserted into the database now with all supporting values
-                    # So at this stage, we merge basic fields of the revision with
-                    # extracted features using a set of methods.
-
-                    # To control previous revision in future calculations
-                    c_before = contributions[c - 1] if c else None
+                # Current and parent revisions of all contributions are fetched in bulk
+                fetched = _batched_lookups(contributions, username)
 
-                    # Wikipedia PageID of the revision under consideration
-                    pageid = v.get('pageid')
-
-                    # curr is this revision
-                    # prev is previous revision by another author
-                    # following is list of next (upto 10) revisions by different authors
-                    curr, prev, following = _operate_on_contributions(v, username=username)
-
-                    # Some checks since web data can often lead to unknown errors. (eg 500 from Wikipedia server)
-                    # Current revision and previous revision by another author on page are
-                    # important for quality measurements. So make sure they exist
-                    if not curr or not prev:
-                        completed = False
-                        break
-
-                    # Get individual entry from list curr
-                    curr = curr[0]
-
-                    # Basic features of current revision
-                    t_curr = datetime.strptime(curr.get('timestamp'), DATE_PATTERN)
-                    content_curr = curr.get('*', '')
-                    parent_curr = curr.get('parentid', None)
-
-                    # Get parent revision of current using parentID
-                    # Features of parent revision are required in order to
-                    # measure distance and char update values of this revision
-                    parent_rev = w.fetch_revisions_for_page(pageid=pageid,
-                                                            start_rev=parent_curr,
-                                                            chunk_size=1, )
-                    # Do not use the revision if parent_rev can't be fetched.
-                    if not parent_rev:
-                        completed = False
-                        break
-
-                    # Basic features of parent revision
-                    parent_rev = parent_rev[0]
-                    content_parent = parent_rev.get('*', '')
-                    t_prev_page = datetime.strptime(parent_rev.get('timestamp'), DATE_PATTERN)
-
-                    # Get next revision on page for future time feature
-                    # The call will include current revision also
-                    next_rev = w.fetch_revisions_for_page(pageid=pageid,
-                                                          start_rev=curr['revid'],
-                                                          chunk_size=2,
-                                                          direction="newer", )
-
-                    # Check if next revision was retrieved or not
-                    # If not then do not continue with this
-                    if len(next_rev) < 2:
-                        completed = False
-                        break
-
-                    # To get time feature from next revision on this page
-                    next_rev = next_rev[1]
-                    t_next_page = datetime.strptime(next_rev.get('timestamp'), DATE_PATTERN)
-
-                    # Get distances from parent revision
-                    # Here we get character features by comparing current revision with parent revision
-                    feature_dict = _get_distances(content_curr, content_parent)
-                    feature_dict['current_rev_length'] = len(content_curr)
-                    feature_dict['parent_rev_length'] = len(content_parent)
-
-                    # Now add action features to this set of character features
-                    feature_dict['rev_comment_length'] = len(curr.get('comment', ''))
-                    feature_dict['time_in_day'] = t_curr.hour
-                    feature_dict['day_of_week'] = t_curr.weekday()
-
-                    # Getting time features now by using current, previous and next tinmes.
-
-                    # Time from previous revision on page
-                    feature_dict['time_prev_page'] = (t_curr - t_prev_page).total_seconds()
-
-                    # Time to next on page
-                    feature_dict['time_next_page'] = (t_next_page - t_curr).total_seconds()
-
-                    # Time from previous revision by user
-                    # The call will include current revision also
-                    contribution_before = w.get_user_contributions(username=username,
-                                                                   cont_limit=2,
-                                                                   start_time=curr.get('timestamp'),
-                                                                   direction="older")
-
-                    t_user_prev = datetime.strptime(contribution_before[1].get('timestamp'), DATE_PATTERN) if len(
-                        contribution_before) > 1 else 0
-
-                    feature_dict['time_prev_user'] = (t_curr - t_user_prev).total_seconds() if t_user_prev else 0.0
-
-                    # Time from previous revision by user on this page
-                    t_user_page_prev = _get_previous_by_user_on_page(username=username,
-                                                                     page=pageid,
-                                                                     revision=curr.get('revid', None))
-
-                    feature_dict['time_prev_user_page'] = (
-                        t_curr - t_user_page_prev).total_seconds() if t_user_page_prev else 0.0
-
-                    # Fill in remaining entries of revision dict
-                    # to be placed in the DB. These include values from
-                    # result dict obtained by calling Wikimedia API
-                    feature_dict['revid'] = curr.get('revid')
-                    feature_dict['pageid'] = pageid
-                    feature_dict['parentid'] = parent_curr
-                    feature_dict['username'] = username
-                    feature_dict['rev_timestamp'] = t_curr  # To get it as datetime type
-                    feature_dict['userid'] = curr['userid']
-                    feature_dict['rev_content'] = content_curr
-                    feature_dict['rev_comment'] = curr.get('comment', '')
-                    feature_dict['rev_size'] = curr['size']
-
-                    # Now we need to calculate the quality of this revision by
-                    # using a revision prior to it from a different author and
-                    # using next 10 revisions by different authors
-                    # Measure quality for current revision
-                    feature_dict['q4'] = _measure_revision_quality(curr=curr, prev=prev, foll=following, next_count=4)
-                    feature_dict['q6'] = _measure_revision_quality(curr=curr, prev=prev, foll=following, next_count=6)
-                    feature_dict['q10'] = _measure_revision_quality(curr=curr, prev=prev, foll=following, next_count=10)
-
-                    # Can print and look at the dict if needed
-                    # print("===== DICT printing====")
-                    # pprint(feature_dict)
-                    # print("===== DICT printed====")
-
-                    # Push revision into the DB
-
-                    insert_return = self.revisions2.update_or_insert(self.revisions2.revid == curr.get('revid'),
-                                                                     **feature_dict)
-                    # Commit at this point to ensure it stays in DB even if something else crashes
-                    self.db.commit()
-
-                    # Update total revision count
+                for _ in self._store_user_revisions(username, contributions, fetched=fetched):
                     total_rev_count += 1
 
-                # Use completed boolean to update authors table flags
-                if completed:
-                    updates_user = self.db(self.authors.username == username).update(completed=True)
-                    print "User updated to complete"
-                else:
-                    updates_user = self.db(self.authors.username == username).update(cleaned=False)
-
-                self.db.commit()
-
             except:
                 # Basically if the revision fetch process crashed for any unknown reason,
                 # just continue the loop and move to next user.
                 continue
 
+        print "Revision cache: %r" % (_get_revision_cache().stats())
         return total_rev_count
 
+    def collect_contributions_concurrent(self, lim_start=1, lim_end=1000, user_list=None,
+                                         users_at_once=CRAWL_USERS_AT_ONCE,
+                                         max_in_flight=CRAWL_MAX_IN_FLIGHT,
+                                         rate=CRAWL_RATE):
+        """
+        Same as collect_contributions, with the Wikipedia requests made
+        concurrently: the contributions of users_at_once users are fetched
+        at the same time, and all the lookups of all the revisions of a
+        user (see _revision_lookups) are issued at once.
+
+        Requests to Wikipedia are limited to max_in_flight at a time and
+        to rate per second (wikipedia.set_request_limits) during the crawl. Features are
+        computed and stored by this thread, in the order of users and of
+        contributions, so the DB ends up as with collect_contributions.
+
+        :param users_at_once: Number of users fetched at the same time
+        :param max_in_flight: Maximum number of requests in flight
+        :param rate: Maximum number of requests per second, None for no limit
+        :return: Returns total count of revisions fetched
+        """
+        previous_limits = set_request_limits(max_in_flight=max_in_flight, rate=rate, url=wikipedia.WIKI_BASE_URL)
+        request_pool = ThreadPool(max_in_flight)
+        user_pool = ThreadPool(users_at_once)
+
+        # Rveision count for total sum
+        total_rev_count = 0
+
+        users = self._users_to_collect(lim_start, lim_end, user_list)
+        print "Length of users: %r" % (len(users))
+
+        def usernames():
+            for i in users:
+                try:
+                    username = self._user_to_crawl(i, user_list)
+                except:
+                    continue
+                if username is not None:
+                    yield username
+
+        # Users being fetched, in order. At most twice users_at_once are held.
+        pending = collections.deque()
+        to_fetch = usernames()
+        try:
+            for username in itertools.islice(to_fetch, 2 * users_at_once):
+                pending.append((username, user_pool.apply_async(_fetch_user_revisions, (username, request_pool))))
+
+            while pending:
+                username, async_result = pending.popleft()
+                for next_username in itertools.islice(to_fetch, 1):
+                    pending.append((next_username, user_pool.apply_async(_fetch_user_revisions,
+                                                                         (next_username, request_pool))))
+                try:
+                    contributions, fetched = async_result.get()
+                    print "Contributions by user (%r) are: %r" % (username, len(contributions))
+
+                    # Don't operate if it has less than 3 revisions
+                    if len(contributions) < 3:
+                        continue
+
+                    for _ in self._store_user_revisions(username, contributions, fetched=fetched):
+                        total_rev_count += 1
+
+                except:
+                    # As in collect_contributions, move to next user
+                    continue
+        finally:
+            user_pool.terminate()
+            request_pool.terminate()
+            # The limits only apply to this crawl
+            restore_request_limits(previous_limits, url=wikipedia.WIKI_BASE_URL)
+
+        print "Revision cache: %r" % (_get_revision_cache().stats())
+        return total_rev_count
+
+    def _users_to_collect(self, lim_start, lim_end, user_list):
+        """
+        Users whose contributions are to be collected: user_list if given,
+        else those of authors not yet completed.
+        """
+        if user_list:
+            return user_list
+
+        # Get users from the table. Controlled by 'cleaned' and 'completed'
+        q = (
+                self.authors.user_since > START_TIME) & (
+                self.authors.contributions > 3) & (
+                # self.authors.cleaned == True) & (
+                self.authors.completed == False
+            )
+        return self.db(q).select(limitby=(lim_start, lim_end))
+
+    def _user_to_crawl(self, user, user_list):
+        """
+        Username of a user to collect, None if it is a bot (then deleted from authors)
+        """
+        if not user_list:
+
+            # Remove if it is a bot
+            if re.search("bot", user['username'], re.IGNORECASE):
+                self.db(self.authors.id == user['id']).delete()
+                print("{} deleted".format(user['username']))
+                return None
+
+        # Basic user values available in 'authors' table
+        return user['username']
+
+    def _store_user_revisions(self, username, contributions, fetched=None):
+        """
+        Compute the features of the contributions of a user and push
+        them into revisions_restore, in order, stopping at the first one
+        which can't be completed. The user is then flagged in authors.
+
+        :param username: Username of user
+        :param contributions: Contributions of the user
+        :param fetched: Lookups already made, one dict per contribution (see _revision_features)
+        :return: Revids of the revisions stored, as they are stored
+        :rtype: iterator
+        """
+        # Initialize a boolean to control completion of record
+        completed = True
+
+        # Iterate over these contibutions and get their features
+        for c, v in enumerate(contributions):
+            # Each contribution must be inserted into the database now with all supporting values
+            # So at this stage, we merge basic fields of the revision with
+            # extracted features using a set of methods.
+            feature_dict = _revision_features(v, username, fetched=fetched[c] if fetched is not None else None)
+            if feature_dict is None:
+                completed = False
+                break
+
+            # Push revision into the DB
+            self._store_revision(feature_dict)
+            # Commit at this point to ensure it stays in DB even if something else crashes
+            self.db.commit()
+
+            yield feature_dict['revid']
+
+        # Use completed boolean to update authors table flags
+        if completed:
+            updates_user = self.db(self.authors.username == username).update(completed=True)
+            print "User updated to complete"
+        else:
+            updates_user = self.db(self.authors.username == username).update(cleaned=False)
+
+        self.db.commit()
+
     def load_fresh_from_db(self, store=True, limit_users=50):
         """
         This function should only be used if users and revisions
@@ -808,14 +1373,10 @@ class DataAccess:
         :return: Return two dicts training and test
         """
 
-        NUMBER_OF_FEATURES = 14
         LIMITER = -1
 
         t_start = time.clock()
 
-        # Get users from the DB where revisions are available
-        users = self.db(self.authors.completed == True).select()
-
         # Initialize empty dicts
         training_dict = {}
         test_dict = {}
@@ -824,67 +1385,36 @@ class DataAccess:
         print "Getting base normalization values after %r seconds" % (time.clock() - t_start)
         main_normalizer_values = self._get_main_normalization_values()
 
+        # One query for the revisions of all users with completed revisions,
+        # ordered by user (in order of authors) and then by revision
+        feature_fields = [self.revisions2[f] for f in EXPORT_FEATURE_COLUMNS]
+        rows = self.db((self.authors.completed == True) &
+                       (self.revisions2.username == self.authors.username)).iterselect(
+            self.revisions2.username, *feature_fields,
+            orderby=self.authors.id | self.revisions2.id)
+
         # Start getting revisions for each user
         print "Starting the loop after %r seconds" % (time.clock() - t_start)
-        for i in users:
-            revisions = self.db(self.revisions2.username == i.username).select()
+        for username, revisions in itertools.groupby(rows, key=lambda r: r.username):
+            revisions = [[r[f] for f in EXPORT_FEATURE_COLUMNS] for r in revisions]
 
             # Check to remove small sized entries
             if len(revisions) < 3:
                 continue
 
-            # Set matrix dimension for the user
-            # Dimension X is for the number of revisions from 1-(n-1)
-            dim_x = len(revisions[:LIMITER])
-            # Dimension y is for the number of features being used per revision
-            dim_y = NUMBER_OF_FEATURES
-            # Initialize an empty matrix for User's 1-(n-1) revision features
-            mat_ur = np.zeros((dim_x, dim_y))
-
-            # Getting features from the DB per revision
-            for ctr, c in enumerate(revisions[:LIMITER]):
-                l = [c.time_prev_user,
-                     c.time_prev_page,
-                     c.time_prev_user_page,
-                     c.chars_added,
-                     c.chars_removed,
-                     c.spread,
-                     c.position_in_page,
-                     c.time_in_day,
-                     c.day_of_week,
-                     c.rev_comment_length,
-                     c.upper_lower_ratio,
-                     c.digit_total_ratio,
-                     c.time_next_page,
-                     c.q10]
-
-                # Get normalized values for features
-                l_normalized = _normalize_inputs(l, main_normalizer_values, last_two=True)
-                mat_ur[ctr] = l_normalized
+            # Matrix of User's 1-(n-1) revision features, normalized in one pass
+            mat_ur = normalize_feature_matrix(revisions[:LIMITER], main_normalizer_values, last_two=True)
 
             # Create last row features (nth revision)
             last_row = revisions[LIMITER]
 
             # Set size of this row to be features without two (time to next revision and the quality)
-            vect_y_features = [last_row.time_prev_user,
-                               last_row.time_prev_page,
-                               last_row.time_prev_user_page,
-                               last_row.chars_added,
-                               last_row.chars_removed,
-                               last_row.spread,
-                               last_row.position_in_page,
-                               last_row.time_in_day,
-                               last_row.day_of_week,
-                               last_row.rev_comment_length,
-                               last_row.upper_lower_ratio,
-                               last_row.digit_total_ratio]
-
             # Normalize and get back in the form of a numpy array
-            vect_y_features = _normalize_inputs(vect_y_features, main_normalizer_values)
+            vect_y_features = normalize_feature_matrix([last_row[:12]], main_normalizer_values)[0]
 
             # Quality of last (nth) revision. At this point it is not normalized and is in range [-1,1]
             # The quality when used for loss measurement needs to be normalized (by scaling it into [0,1] range)
-            y_quality = last_row.q10
+            y_quality = last_row[13]
 
             # Randomly distribute to training and test
             # Structure of each entry in the dicts is like:
@@ -892,41 +1422,48 @@ class DataAccess:
             #                   Features of the nth revision,
             #                   Quality (label) of the nth revision)}
             if random.random() > 0.20:
-                training_dict[i.username] = (mat_ur, vect_y_features, y_quality)
+                training_dict[username] = (mat_ur, vect_y_features, y_quality)
             else:
-                test_dict[i.username] = (mat_ur, vect_y_features, y_quality)
+                test_dict[username] = (mat_ur, vect_y_features, y_quality)
 
-            # Store:
-            if store:
-                # Store the entries into json files
-                training_file = os.path.join(os.getcwd(), 'data', 'training_data.json')
-                test_file = os.path.join(os.getcwd(), 'data', 'test_data.json')
-                try:
-                    # Try to backup last data
-                    os.rename(training_file, training_file + ".bak")
-                    os.rename(test_file, test_file + ".bak")
-                except:
-                    pass
+        print "Loaded %d training and %d test users after %r seconds" % (len(training_dict), len(test_dict),
+                                                                        time.clock() - t_start)
+
+        # Store, once all users are loaded
+        if store:
+            # Store the entries into json files
+            training_file = os.path.join(os.getcwd(), 'data', 'training_data.json')
+            test_file = os.path.join(os.getcwd(), 'data', 'test_data.json')
+            try:
+                # Try to backup last data
+                os.rename(training_file, training_file + ".bak")
+                os.rename(test_file, test_file + ".bak")
+            except:
+                pass
+
+            with open(training_file, 'wb') as output:
+                json.dump(data_to_json(training_dict), output)
 
-                with open(training_file, 'wb') as output:
-                    json.dump(data_to_json(training_dict), output)
+            with open(test_file, 'wb') as output:
+                json.dump(data_to_json(test_dict), output)
 
-                with open(test_file, 'wb') as output:
-                    json.dump(data_to_json(test_dict), output)
+            # Store using Serializer from JSON Plus
 
-                # Store using Serializer from JSON Plus
+            ser_trn_file = os.path.join(os.getcwd(), 'data', 'ser_training_data.json')
+            ser_test_file = os.path.join(os.getcwd(), 'data', 'ser_test_data.json')
 
-                ser_trn_file = os.path.join(os.getcwd(), 'data', 'ser_training_data.json')
-                ser_test_file = os.path.join(os.getcwd(), 'data', 'ser_test_data.json')
+            ser_trn_struct = Serializable.dumps(training_dict)
+            ser_test_struct = Serializable.dumps(test_dict)
 
-                ser_trn_struct = Serializable.dumps(training_dict)
-                ser_test_struct = Serializable.dumps(test_dict)
+            with open(ser_trn_file, 'wb') as output:
+                json.dump(ser_trn_struct, output)
 
-                with open(ser_trn_file, 'wb') as output:
-                    json.dump(ser_trn_struct, output)
+            with open(ser_test_file, 'wb') as output:
+                json.dump(ser_test_struct, output)
 
-                with open(ser_test_file, 'wb') as output:
-                    json.dump(ser_test_struct, output)
+            # Binary form, see save_dataset
+            save_dataset(os.path.join(os.getcwd(), 'data', 'training_data.npz'), training_dict)
+            save_dataset(os.path.join(os.getcwd(), 'data', 'test_data.npz'), test_dict)
 
         return training_dict, test_dict
 
@@ -1231,119 +1768,10 @@ class DataAccess:
         # Wikipedia PageID of the revision under consideration
         revision_info = dict(pageid=pageid, revid=revid)
         username = revision.get('user')
-        # curr is this revision
-        # prev is previous revision by another author
-        # following is list of next (upto 10) revisions by different authors
-        curr, prev, following = _operate_on_contributions(revision_info, username=username)
-
-        # Some checks since web data can often lead to unknown errors. (eg 500 from Wikipedia server)
-        # Current revision and previous revision by another author on page are
-        # important for quality measurements. So make sure they exist
-        if not curr or not prev:
-            completed = False
+        feature_dict = _revision_features(revision_info, username)
+        if feature_dict is None:
             return None
 
-        # Get individual entry from list curr
-        curr = curr[0]
-
-        # Basic features of current revision
-        t_curr = datetime.strptime(curr.get('timestamp'), DATE_PATTERN)
-        content_curr = curr.get('*', '')
-        parent_curr = curr.get('parentid', None)
-
-        # Get parent revision of current using parentID
-        # Features of parent revision are required in order to
-        # measure distance and char update values of this revision
-        parent_rev = self.wiki.fetch_revisions_for_page(pageid=pageid,
-                                                        start_rev=parent_curr,
-                                                        chunk_size=1, )
-        # Do not use the revision if parent_rev can't be fetched.
-        if not parent_rev:
-            completed = False
-            return None
-
-        # Basic features of parent revision
-        parent_rev = parent_rev[0]
-        content_parent = parent_rev.get('*', '')
-        t_prev_page = datetime.strptime(parent_rev.get('timestamp'), DATE_PATTERN)
-
-        # Get next revision on page for future time feature
-        # The call will include current revision also
-        next_rev = self.wiki.fetch_revisions_for_page(pageid=pageid,
-                                                      start_rev=curr['revid'],
-                                                      chunk_size=2,
-                                                      direction="newer", )
-
-        # Check if next revision was retrieved or not
-        # If not then do not continue with this
-        if len(next_rev) < 2:
-            completed = False
-            return None
-
-        # To get time feature from next revision on this page
-        next_rev = next_rev[1]
-        t_next_page = datetime.strptime(next_rev.get('timestamp'), DATE_PATTERN)
-
-        # Get distances from parent revision
-        # Here we get character features by comparing current revision with parent revision
-        feature_dict = _get_distances(content_curr, content_parent)
-        feature_dict['current_rev_length'] = len(content_curr)
-        feature_dict['parent_rev_length'] = len(content_parent)
-
-        # Now add action features to this set of character features
-        feature_dict['rev_comment_length'] = len(curr.get('comment', ''))
-        feature_dict['time_in_day'] = t_curr.hour
-        feature_dict['day_of_week'] = t_curr.weekday()
-
-        # Getting time features now by using current, previous and next tinmes.
-
-        # Time from previous revision on page
-        feature_dict['time_prev_page'] = (t_curr - t_prev_page).total_seconds()
-
-        # Time to next on page
-        feature_dict['time_next_page'] = (t_next_page - t_curr).total_seconds()
-
-        # Time from previous revision by user
-        # The call will include current revision also
-        contribution_before = self.wiki.get_user_contributions(username=username,
-                                                               cont_limit=2,
-                                                               start_time=curr.get('timestamp'),
-                                                               direction="older")
-
-        t_user_prev = datetime.strptime(contribution_before[1].get('timestamp'), DATE_PATTERN) if len(
-            contribution_before) > 1 else 0
-
-        feature_dict['time_prev_user'] = (t_curr - t_user_prev).total_seconds() if t_user_prev else 0.0
-
-        # Time from previous revision by user on this page
-        t_user_page_prev = _get_previous_by_user_on_page(username=username,
-                                                         page=pageid,
-                                                         revision=curr.get('revid', None))
-
-        feature_dict['time_prev_user_page'] = (
-            t_curr - t_user_page_prev).total_seconds() if t_user_page_prev else 0.0
-
-        # Fill in remaining entries of revision dict
-        # to be placed in the DB. These include values from
-        # result dict obtained by calling Wikimedia API
-        feature_dict['revid'] = curr.get('revid')
-        feature_dict['pageid'] = pageid
-        feature_dict['parentid'] = parent_curr
-        feature_dict['username'] = username
-        feature_dict['rev_timestamp'] = t_curr  # To get it as datetime type
-        feature_dict['userid'] = curr['userid']
-        feature_dict['rev_content'] = content_curr
-        feature_dict['rev_comment'] = curr.get('comment', '')
-        feature_dict['rev_size'] = curr['size']
-
-        # Now we need to calculate the quality of this revision by
-        # using a revision prior to it from a different author and
-        # using next 10 revisions by different authors
-        # Measure quality for current revision
-        feature_dict['q4'] = _measure_revision_quality(curr=curr, prev=prev, foll=following, next_count=4)
-        feature_dict['q6'] = _measure_revision_quality(curr=curr, prev=prev, foll=following, next_count=6)
-        feature_dict['q10'] = _measure_revision_quality(curr=curr, prev=prev, foll=following, next_count=10)
-
         # Can print and look at the dict if needed
         # print("===== DICT printing====")
         # pprint(feature_dict)
@@ -1351,8 +1779,7 @@ class DataAccess:
 
         # Push revision into the DB
 
-        insert_return = self.revisions2.update_or_insert(self.revisions2.revid == curr.get('revid'),
-                                                         **feature_dict)
+        self._store_revision(feature_dict)
         # Commit at this point to ensure it stays in DB even if something else crashes
         self.db.commit()
 
@@ -0,0 +1,116 @@
+"""
+Append-only on-disk store of the edges parsed by user_graph.
+
+Used when the user graph is not kept in memory (FILE_MODE). Instead of
+loading and rewriting a user's whole file for every edge, an edge is
+buffered and appended as a json line
+
+    [user, rev, full_dict]
+
+to one of a fixed number of shard logs, chosen by a hash of the user.
+Buffers are written out once they hold flush_every edges, so a log
+receives one write per batch.
+
+All the edges of a user are in the same shard, so a shard can be
+compacted on its own: user_graph.compact_edge_store reads one shard
+log at a time, folds its edges into per-user records and removes it.
+Memory use is bounded by the size of a shard, not of the graph.
+"""
+import json
+import os
+import zlib
+
+DEFAULT_SHARDS = 64
+DEFAULT_FLUSH_EVERY = 10000
+
+
+class EdgeStore(object):
+    """
+    Sharded append-only logs of edges, with buffered writes.
+    """
+
+    def __init__(self, store_dir, shards=DEFAULT_SHARDS, flush_every=DEFAULT_FLUSH_EVERY):
+        """
+
+        :param store_dir: Directory of the shard logs
+        :param shards: Number of shards. Must stay the same for a store directory
+        :param flush_every: Number of buffered edges that triggers a flush
+        """
+        self.store_dir = store_dir
+        self.shards = shards
+        self.flush_every = flush_every
+        self._buffers = {}
+        self._buffered = 0
+
+        if not os.path.isdir(store_dir):
+            os.makedirs(store_dir)
+
+    def shard_of(self, user):
+        """
+        Shard holding the edges of user
+        """
+        if isinstance(user, unicode):
+            user = user.encode('utf-8')
+        return (zlib.crc32(user) & 0xffffffff) % self.shards
+
+    def shard_file(self, shard):
+        return os.path.join(self.store_dir, 'edges_%04d.jsonl' % (shard))
+
+    def append(self, user, rev, full_dict):
+        """
+        Buffer an edge, flushing all buffers once flush_every edges are held
+
+        :param user: Author of the judged revision
+        :param rev: Judged revision
+        :param full_dict: Parsed EditInc line
+        """
+        line = json.dumps([user, rev, full_dict]) + '\n'
+        self._buffers.setdefault(self.shard_of(user), []).append(line)
+        self._buffered += 1
+        if self._buffered >= self.flush_every:
+            self.flush()
+
+    def flush(self):
+        """
+        Append the buffered edges to their shard logs, one write per shard
+        """
+        for shard, lines in self._buffers.iteritems():
+            with open(self.shard_file(shard), 'ab') as outp:
+                outp.write(''.join(lines))
+        self._buffers = {}
+        self._buffered = 0
+
+    def shards_with_edges(self):
+        """
+        Shards whose log holds edges not yet compacted
+
+        :rtype: list
+        """
+        return [s for s in range(self.shards) if os.path.isfile(self.shard_file(s))]
+
+    def read_shard(self, shard):
+        """
+        Edges of a shard log in the order they were appended
+
+        :return: (user, rev, full_dict) tuples
+        :rtype: iterator
+        """
+        filename = self.shard_file(shard)
+        if not os.path.isfile(filename):
+            return
+        with open(filename, 'rb') as inp:
+            for line in inp:
+                try:
+                    user, rev, full_dict = json.loads(line)
+                except ValueError:
+                    # Partial line from an interrupted flush
+                    continue
+                yield user, rev, full_dict
+
+    def clear_shard(self, shard):
+        """
+        Remove a shard log once it has been compacted
+        """
+        filename = self.shard_file(shard)
+        if os.path.isfile(filename):
+            os.remove(filename)
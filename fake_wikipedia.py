@@ -0,0 +1,240 @@
+"""
+Local fake of the parts of the Wikipedia API used by wikipedia.WikiFetch,
+to run the crawlers of db.DataAccess offline.
+
+FakeWikipedia serves a small generated history of pages and users over
+HTTP on localhost: prop=revisions queries by pageids (with rvstartid,
+rvdir, rvlimit, rvuser and rvexcludeuser) or by revids, and
+list=usercontribs queries. Point wikipedia.WIKI_BASE_URL at its url.
+
+Run this module to test that the concurrent crawler stores the same
+revisions as the sequential one.
+"""
+import json
+import os
+import random
+import shutil
+import sys
+import tempfile
+import threading
+import unittest
+import urlparse
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+from SocketServer import ThreadingMixIn
+from datetime import datetime, timedelta
+
+DATE_PATTERN = "%Y-%m-%dT%H:%M:%SZ"
+USERS = ['alice', 'bob', 'carol', 'dave', 'erin', 'somebot']
+
+
+def make_history(n_pages=4, n_revisions=120, users=USERS, seed=3):
+    """
+    Random history of edits
+
+    :return: Dict of pageid to its revisions (oldest first), and list of all revisions in time order
+    :rtype: tuple
+    """
+    rnd = random.Random(seed)
+    words = ['w%d' % i for i in range(60)]
+    t = datetime(2014, 1, 1)
+    pages = {p: [] for p in range(1, n_pages + 1)}
+    revisions = []
+
+    for revid in range(100, 100 + n_revisions):
+        pageid = rnd.randint(1, n_pages)
+        t += timedelta(seconds=rnd.randint(60, 90000))
+        parent = pages[pageid][-1] if pages[pageid] else None
+
+        content = parent['*'].split() if parent else []
+        for _ in range(rnd.randint(1, 8)):
+            if rnd.random() < 0.6 or not content:
+                word = rnd.choice(words)
+                content.insert(rnd.randint(0, len(content)), word.upper() if rnd.random() < 0.2 else word)
+            else:
+                del content[rnd.randint(0, len(content) - 1)]
+        content = ' '.join(content)
+
+        user = rnd.choice(users)
+        revision = {'revid': revid, 'parentid': parent['revid'] if parent else 0, 'pageid': pageid,
+                    'user': user, 'userid': users.index(user) + 1, 'timestamp': t.strftime(DATE_PATTERN),
+                    'comment': 'c' * rnd.randint(0, 30), '*': content, 'size': len(content)}
+        pages[pageid].append(revision)
+        revisions.append(revision)
+
+    return pages, revisions
+
+
+class FakeWikipedia(object):
+    """
+    Fake API server, running in a daemon thread. Counts the requests
+    received and the maximum number of requests in flight.
+    """
+
+    def __init__(self, pages, revisions):
+        self.pages = pages
+        self.revisions = revisions
+        self.requests = 0
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self._lock = threading.Lock()
+        self._server = None
+
+    @staticmethod
+    def _page_revision(revision):
+        return {k: v for k, v in revision.iteritems() if k != 'pageid'}
+
+    def query_revisions(self, q):
+        if 'revids' in q:
+            revids = set(int(r) for r in q['revids'].split('|'))
+            pages = {}
+            for revision in self.revisions:
+                if revision['revid'] in revids:
+                    page = pages.setdefault(str(revision['pageid']), {'pageid': revision['pageid'], 'revisions': []})
+                    page['revisions'].append(self._page_revision(revision))
+            return {'query': {'pages': pages}}
+
+        pageid = int(q['pageids'])
+        newer = q.get('rvdir') == 'newer'
+        ordered = self.pages.get(pageid, [])
+        ordered = ordered if newer else ordered[::-1]
+        if 'rvstartid' in q:
+            start = [i for i, r in enumerate(ordered) if r['revid'] == int(q['rvstartid'])]
+            ordered = ordered[start[0]:] if start else []
+        if 'rvexcludeuser' in q:
+            ordered = [r for r in ordered if r['user'] != q['rvexcludeuser']]
+        if 'rvuser' in q:
+            ordered = [r for r in ordered if r['user'] == q['rvuser']]
+        ordered = ordered[:int(q.get('rvlimit', 1))]
+        return {'query': {'pages': {str(pageid): {'pageid': pageid,
+                                                  'revisions': [self._page_revision(r) for r in ordered]}}}}
+
+    def query_contributions(self, q):
+        newer = q.get('ucdir') == 'newer'
+        ordered = [r for r in self.revisions if r['user'] == q['ucuser']]
+        ordered = ordered if newer else ordered[::-1]
+        if 'ucstart' in q:
+            ordered = [r for r in ordered
+                       if (r['timestamp'] >= q['ucstart'] if newer else r['timestamp'] <= q['ucstart'])]
+        ordered = ordered[:int(q.get('uclimit', 10))]
+        return {'query': {'usercontribs': [{'user': r['user'], 'revid': r['revid'], 'parentid': r['parentid'],
+                                            'pageid': r['pageid'], 'timestamp': r['timestamp'],
+                                            'comment': r['comment'], 'size': r['size']} for r in ordered]}}
+
+    def respond(self, path):
+        with self._lock:
+            self.requests += 1
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        try:
+            q = dict(urlparse.parse_qsl(urlparse.urlparse(path).query, keep_blank_values=True))
+            if q.get('list') == 'usercontribs':
+                return json.dumps(self.query_contributions(q))
+            return json.dumps(self.query_revisions(q))
+        finally:
+            with self._lock:
+                self.in_flight -= 1
+
+    def start(self):
+        """
+        Start serving on a free port of localhost
+
+        :return: URL of the api
+        :rtype: str
+        """
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                body = fake.respond(self.path)
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        class Server(ThreadingMixIn, HTTPServer):
+            daemon_threads = True
+
+        self._server = Server(('127.0.0.1', 0), Handler)
+        thread = threading.Thread(target=self._server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return 'http://127.0.0.1:%d/w/api.php' % self._server.server_address[1]
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+
+class TestCrawl(unittest.TestCase):
+
+    def setUp(self):
+        import wikipedia
+        self.wikipedia = wikipedia
+        self.base_url = wikipedia.WIKI_BASE_URL
+        self.fake = FakeWikipedia(*make_history())
+        wikipedia.WIKI_BASE_URL = self.fake.start()
+        self.cwd = os.getcwd()
+        self.tmp = tempfile.mkdtemp()
+
+    def tearDown(self):
+        self.wikipedia.WIKI_BASE_URL = self.base_url
+        self.wikipedia.set_revision_cache(None)
+        self.fake.stop()
+        os.chdir(self.cwd)
+        shutil.rmtree(self.tmp)
+
+    def _crawl(self, name, concurrent):
+        """
+        Crawl all users into a new DB
+
+        :return: Count returned by the crawl, rows of revisions_restore and of authors
+        """
+        import db
+        folder = os.path.join(self.tmp, name)
+        os.makedirs(os.path.join(folder, 'data'))
+        os.chdir(folder)
+        db._REVISION_CACHE_OBJ = None
+
+        d = db.DataAccess()
+        for table in [d.authors, d.revisions2]:
+            d.db._adapter.create_table(table, migrate=True, fake_migrate=False)
+        for i, user in enumerate(USERS):
+            d.authors.insert(username=user, userid=i + 1, contributions=50, user_since=datetime(2013, 1, 1))
+        d.db.commit()
+
+        # The crawlers print the API results
+        stdout, sys.stdout = sys.stdout, open(os.devnull, 'w')
+        try:
+            if concurrent:
+                count = d.collect_contributions_concurrent(lim_start=0, lim_end=100, users_at_once=3,
+                                                           max_in_flight=4, rate=None)
+            else:
+                count = d.collect_contributions(lim_start=0, lim_end=100)
+        finally:
+            sys.stdout.close()
+            sys.stdout = stdout
+            # Commit the revision cache before its folder is removed
+            db._get_revision_cache().flush()
+
+        revisions = [{k: v for k, v in r.as_dict().iteritems() if k != 'id'}
+                     for r in d.db(d.revisions2).select(orderby=d.revisions2.id)]
+        authors = [(r.username, r.completed, r.cleaned) for r in d.db(d.authors).select(orderby=d.authors.username)]
+        return count, revisions, authors
+
+    def test_concurrent_same_as_sequential(self):
+        sequential = self._crawl('sequential', False)
+        self.fake.max_in_flight = 0
+        concurrent = self._crawl('concurrent', True)
+
+        self.assertTrue(len(sequential[1]) > 0)
+        self.assertEqual(sequential, concurrent)
+        self.assertTrue(self.fake.max_in_flight <= 4)
+        # Limits of the crawl are not left behind
+        self.assertEqual(self.wikipedia._LIMITERS, {})
+
+
+if __name__ == '__main__':
+    unittest.main()
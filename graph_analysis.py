@@ -8,13 +8,17 @@ Functions in this file should build labels from a graph,
 build required LSTM models and run them.
 """
 import json
+import multiprocessing
 import os
 import random
 from pprint import pprint
 from datetime import datetime
 import time
 from json_plus import Serializable
-from multi_LSTM import InstanceNode, SequenceItem, MultiLSTM
+from graph_cache import file_digest, params_key, load_instance_graph, save_instance_graph, load_labels, save_labels
+from graph_index import UserTimeIndex, EdgeTable
+from multi_LSTM import InstanceNode, SequenceItem, share_feature_matrix, MultiLSTM
+from results_log import append_result, results_log_file
 import numpy as np
 
 # WIKINAME = 'rmywiki'  # Very small
@@ -24,6 +28,9 @@ DEFAULT_PARAMS = {}
 
 FEATURE_VECTOR_SIZE = 8
 
+# Fields of an edge's judgement used to compute its features
+FEATURE_FIELDS = ['d01', 'd02', 'd12', 't01', 't12', 'Delta', 'dp2']
+
 
 def _timediff(timestamp1, timestamp2):
     """
@@ -128,32 +135,68 @@ def _print_distribution(labels):
     print "Percentage 1s: %0.2f and 0s: %0.2f" % (_percent(len_0s), _percent(len_1s))
 
 
-def user_quitting_labels(user_graph):
+def _memoized_labels(user_graph, name_suffix, build, cache_dir=None, graph_key=None, **params):
     """
-
-    :param user_graph:
-    :type user_graph:
-    :return:
-    :rtype:
+    Get labels from the on-disk memo in cache_dir if present. Otherwise
+    compute them with build(edges) on the EdgeTable of the graph, write
+    the label file and memoize them.
+
+    :param user_graph: User graph, its UserTimeIndex or EdgeTable
+    :param name_suffix: Name of the labeling
+    :param build: Function of an EdgeTable returning a dict of labels
+    :param cache_dir: Directory for the memo, None to not memoize
+    :param graph_key: Digest of the graph content (eg. graph_cache.file_digest of the graph file).
+                      If None, the digest of the edge columns is used.
+    :param params: Window parameters of the labeling
+    :return: Dict of {user: label}
+    :rtype: dict
     """
+    edges = user_graph if isinstance(user_graph, EdgeTable) else None
+    key = None
+
+    if cache_dir is not None:
+        if graph_key is None:
+            edges = edges or EdgeTable(user_graph)
+            graph_key = edges.digest()
+        key = params_key(graph_key, labeling=name_suffix, **params)
+        labels = load_labels(cache_dir, key)
+        if labels is not None:
+            _print_distribution(labels=labels)
+            return labels
+
+    edges = edges or EdgeTable(user_graph)
+    labels = build(edges)
+
+    _create_label_file(labels=labels, name_suffix=name_suffix)
+    if key is not None:
+        save_labels(cache_dir, key, labels)
 
-    MAX_DAYS = 1
-    print len(user_graph)
-    # user_graph = _graph_from_days_back(graph=user_graph, ending=100, starting_from = 5000)
+    _print_distribution(labels=labels)
 
-    print len(user_graph)
+    return labels
 
-    max_time = max([max([i['timestamp'] for k, i in a.iteritems()]) for t, a in user_graph.iteritems()])
 
-    quit_labels = {k: 0 if _days(max_time - max([i['timestamp'] for _, i in v.iteritems()])) < MAX_DAYS else 1 for k, v
-                   in
-                   user_graph.iteritems()}
+def user_quitting_labels(user_graph, max_days=1, cache_dir=None, graph_key=None):
+    """
+    A user has quit (label 1) if their latest edit is at least
+    max_days older than the latest edit in the graph.
 
-    _create_label_file(labels=quit_labels, name_suffix="quit")
+    :param user_graph:
+    :type user_graph: dict | UserTimeIndex | EdgeTable
+    :param max_days: Days without edits to consider a user quit
+    :param cache_dir: Directory to memoize labels, None to not memoize
+    :param graph_key: Digest identifying graph content
+    :return:
+    :rtype:
+    """
 
-    _print_distribution(labels=quit_labels)
+    def build(edges):
+        rows = edges.last_edits()
+        quitted = _days(edges.max_time - edges.timestamps[rows]) >= max_days
+        return {edges.users[u]: int(q) for u, q in zip(edges.user_idx[rows], quitted)}
 
-    return quit_labels
+    return _memoized_labels(user_graph, "quit", build, cache_dir=cache_dir, graph_key=graph_key,
+                            max_days=max_days)
 
 
 def _qual(d01, d12, d02):
@@ -173,67 +216,49 @@ def _graph_from_days_back(graph, ending=7, starting_from=None):
     Basically in the entire graph, remove entries of each author
     contributed after a certain number of days from top
 
-    :param graph:
-    :type graph:
+    The graph is not copied. The returned snapshot is a read-only view
+    over a UserTimeIndex which is built here if a plain dict is passed.
+    Pass the same UserTimeIndex when sweeping many windows.
+
+    :param graph: User graph dict or its UserTimeIndex
+    :type graph: dict | UserTimeIndex
     :param ending:
     :type ending:
     :return:
-    :rtype:
+    :rtype: GraphSnapshot
     """
-    max_time = max([max([i['timestamp'] for k, i in a.iteritems()]) for t, a in graph.iteritems()])
-    check_time = max_time - _secs_in_days(ending)
+    if not isinstance(graph, UserTimeIndex):
+        graph = UserTimeIndex(graph)
 
-    if starting_from is None:
-        return {user: {k: v for k, v in values.iteritems() if v['timestamp'] < check_time} for user, values in
-                graph.iteritems()}
-
-    else:
-        pop_list = []
-        previous_time = max_time - _secs_in_days(starting_from)
-        ret_graph = {
-            user: {k: v for k, v in values.iteritems() if
-                   v['timestamp'] < check_time and v['timestamp'] > previous_time}
-            for user, values in graph.iteritems()}
+    return graph.snapshot(ending=ending, starting_from=starting_from)
 
-        pop_list = [user for user, values in ret_graph.iteritems() if len(values) == 0]
 
-        for i in pop_list:
-            ret_graph.pop(i)
-
-        return ret_graph
-
-
-def user_reversion_label(user_graph):
+def user_reversion_label(user_graph, ending=14, cache_dir=None, graph_key=None):
     """
 
     Reversion means that the user's revision was reverted by next editor.
     So the label based on latest revision by an author goes like this:
         If the q on user's last revision <0, then reverted
 
+    Only revisions older than `ending` days from the latest edit
+    in the graph are considered.
+
     :param user_graph:
-    :type user_graph:
+    :type user_graph: dict | UserTimeIndex | EdgeTable
+    :param ending: Days back from latest edit
+    :param cache_dir: Directory to memoize labels, None to not memoize
+    :param graph_key: Digest identifying graph content
     :return:
     :rtype:
     """
 
-    pop_list = []
-
-    user_graph = _graph_from_days_back(graph=user_graph, ending=14)
-
-    user_last_revs = {k: max(v.values(), key=lambda x: x['timestamp']) if len(v) else pop_list.append(k) for k, v in
-                      user_graph.iteritems()}
-
-    # print pop_list
-    for i in pop_list:
-        user_last_revs.pop(i)
-
-    reversion_label = {k: 1 if _reverts(v['list'][0]) else 0 for k, v in user_last_revs.iteritems()}
+    def build(edges):
+        rows = edges.last_edits(end_time=edges.max_time - _secs_in_days(ending))
+        rows = rows[~np.isnan(edges.quality[rows])]
+        return {edges.users[u]: int(q < 1) for u, q in zip(edges.user_idx[rows], edges.quality[rows])}
 
-    _create_label_file(labels=reversion_label, name_suffix="reversion")
-
-    _print_distribution(labels=reversion_label)
-
-    return reversion_label
+    return _memoized_labels(user_graph, "reversion", build, cache_dir=cache_dir, graph_key=graph_key,
+                            ending=ending)
 
 
 def learn_from_graph(user_graph, user_labels, params=DEFAULT_PARAMS):
@@ -309,17 +334,111 @@ def _get_features_of_edit(data, feature_vector_size=FEATURE_VECTOR_SIZE):
         return None
 
 
-def _get_sequence_list_for(values, sequence_control=None, limiter=None):
+def _edge_columns(graph_data):
     """
-    Based on the sequence control, generate sequence list of SequenceItem type objects
-    :param values:
-    :type values:
+    Walk the graph once and collect the fields used for features
+    from the first judgement of every edge into numpy columns.
+
+    Edges without a 'list' are not given a row. Edges with an empty
+    list get a row which is marked as not judged.
+
+    :param graph_data: User graph
+    :type graph_data: dict
+    :return: Row index {user: {rev: row}}, dict of columns keyed by field, boolean array of judged rows
+    :rtype: tuple
+    """
+    rows = {}
+    fields = {f: [] for f in FEATURE_FIELDS}
+    judged = []
+
+    for user, values in graph_data.iteritems():
+        user_rows = rows[user] = {}
+        for edit, data in values.iteritems():
+            if not data.has_key('list'):
+                continue
+            user_rows[edit] = len(judged)
+            if len(data['list']):
+                element = data['list'][0]
+                for f in FEATURE_FIELDS:
+                    fields[f].append(element[f])
+                judged.append(True)
+            else:
+                for f in FEATURE_FIELDS:
+                    fields[f].append(0.0)
+                judged.append(False)
+
+    columns = {f: np.array(v, dtype=np.float64) for f, v in fields.iteritems()}
+    return rows, columns, np.array(judged, dtype=bool)
+
+
+def _normalize_matrix_for_features(columns, judged, feature_vector_size):
+    """
+    Vectorized _normalize_vector_for_features over all edges at once.
+    Rows which are not judged are left as zeros, as in _get_features_of_edit.
+
+    :param columns: Dict of columns from _edge_columns
+    :param judged: Boolean array of judged rows
+    :param feature_vector_size: Size of feature vector
+    :return: Matrix of shape (E, feature_vector_size)
+    :rtype: np.ndarray
+    """
+    TIME_DENOMINATOR = 10000000.0
+
+    fm = np.zeros((len(judged), feature_vector_size))
+
+    # Distances. Column 2 uses d02, same as the per edge function
+    fm[:, 0] = _dist_normal(columns['d01'])
+    fm[:, 1] = _dist_normal(columns['d02'])
+    fm[:, 2] = _dist_normal(columns['d02'])
+
+    # Times 01 and 12
+    fm[:, 3] = np.log(1 + np.abs(columns['t01']) / TIME_DENOMINATOR)
+    fm[:, 4] = np.log(1 + np.abs(columns['t12']) / TIME_DENOMINATOR)
+
+    # Delta and dp2
+    fm[:, 5] = _dist_normal(columns['Delta'])
+    fm[:, 6] = _dist_normal(columns['dp2'])
+
+    # Quality calculated by 1 on 0, as in _qual
+    d01 = columns['d01']
+    diff = columns['d02'] - columns['d12']
+    fm[:, 7] = np.where(d01 != 0, diff / np.where(d01 != 0, d01, 1.0), diff)
+
+    fm[~judged] = 0.0
+    return fm
+
+
+def build_feature_matrix(graph_data, feature_vector_size=FEATURE_VECTOR_SIZE):
+    """
+    Compute the features of every edge in the graph in one pass.
+
+    :param graph_data: User graph
+    :type graph_data: dict
+    :param feature_vector_size: Size of feature vector
+    :return: Row index {user: {rev: row}} and feature matrix of shape (E, feature_vector_size)
+    :rtype: tuple
+    """
+    rows, columns, judged = _edge_columns(graph_data)
+    return rows, _normalize_matrix_for_features(columns, judged, feature_vector_size)
+
+
+def _sequence_edits_for(values, labels, sequence_control=None, limiter=None):
+    """
+    Select the edits of a user that enter its sequence, as (edit, data) pairs.
+    An edit is used only if it was judged by a user present in labels.
+
+    :param values: Revisions of the user in graph
+    :type values: dict
+    :param labels: Labels of users
+    :type labels: dict
     :param sequence_control:
     :type sequence_control:
+    :param limiter: Maximum number of edits in sequence
+    :type limiter: int
     :return:
-    :rtype:
+    :rtype: list
     """
-    sequence_list = []
+    edits = []
     for edit, data in values.iteritems():
         if not len(data):
             continue
@@ -330,22 +449,62 @@ def _get_sequence_list_for(values, sequence_control=None, limiter=None):
         if not labels.has_key(data['list'][0]['uname2']):
             continue
 
+        edits.append((edit, data))
+
+    if sequence_control == 'time':
+        return sorted(edits, key=lambda x: x[1]['timestamp'])[:limiter]
+
+
+def _get_sequence_list_for(values, labels, sequence_control=None, limiter=None, feature_rows=None,
+                           feature_matrix=None):
+    """
+    Based on the sequence control, generate sequence list of SequenceItem type objects
+
+    If feature_matrix is given, items reference their row in it
+    (looked up in feature_rows) instead of computing a feature vector.
+
+    :param values:
+    :type values:
+    :param labels: Labels of users
+    :type labels: dict
+    :param sequence_control:
+    :type sequence_control:
+    :param feature_rows: Dict of {rev: row} for this user
+    :type feature_rows: dict
+    :param feature_matrix: Matrix from build_feature_matrix
+    :type feature_matrix: np.ndarray
+    :return:
+    :rtype:
+    """
+    edits = _sequence_edits_for(values, labels, sequence_control=sequence_control, limiter=limiter)
+    if edits is None:
+        return None
+
+    sequence_list = []
+    for edit, data in edits:
         # After all checks to not enter an item, create the SequenceItem object
         # and get its features
         link_node = data['list'][0]['uname2']
-        s = SequenceItem(item_id=edit,
-                         link_node_id=link_node,
-                         feature_vector=_get_features_of_edit(data),
-                         timestamp=data['timestamp'],
-                         action_time=data['list'][0]['timestamp'])
+        if feature_matrix is not None:
+            s = SequenceItem(item_id=edit,
+                             link_node_id=link_node,
+                             timestamp=data['timestamp'],
+                             action_time=data['list'][0]['timestamp'],
+                             feature_matrix=feature_matrix,
+                             feature_row=feature_rows[edit])
+        else:
+            s = SequenceItem(item_id=edit,
+                             link_node_id=link_node,
+                             feature_vector=_get_features_of_edit(data),
+                             timestamp=data['timestamp'],
+                             action_time=data['list'][0]['timestamp'])
 
         sequence_list.append(s)
 
-    if sequence_control == 'time':
-        return sorted(sequence_list, key=lambda x: x.timestamp)[:limiter]
+    return sequence_list
 
 
-def generate_instance_graph(graph_data, labels, limiter=20):
+def generate_instance_graph(graph_data, labels, limiter=20, vectorized=True):
     """
     Generate the graph structure using Instance and SequenceItem classes
 
@@ -355,6 +514,8 @@ def generate_instance_graph(graph_data, labels, limiter=20):
 
     :param graph_data:
     :type graph_data:dict
+    :param vectorized: Boolean to compute all edge features at once with build_feature_matrix
+    :type vectorized: bool
     :return:
     :rtype:
     """
@@ -364,19 +525,125 @@ def generate_instance_graph(graph_data, labels, limiter=20):
 
     instance_graph = {}
 
+    feature_rows, feature_matrix = build_feature_matrix(graph_data) if vectorized else ({}, None)
+
     for user, values in graph_data.iteritems():
         if not labels.has_key(user):
             continue
         new_node = InstanceNode(label=labels[user], sequence_control=SEQ_CONT)
 
         # Now that label is set for node, get its sequence list
-        new_node.sequence_list = _get_sequence_list_for(values, sequence_control=SEQ_CONT, limiter=LIMITER)
+        new_node.sequence_list = _get_sequence_list_for(values, labels, sequence_control=SEQ_CONT, limiter=LIMITER,
+                                                        feature_rows=feature_rows.get(user),
+                                                        feature_matrix=feature_matrix)
 
         instance_graph[user] = new_node
 
     return instance_graph
 
 
+# Arguments of the partition workers, set by _init_partition_worker
+_partition_worker = {}
+
+
+def _init_partition_worker(labels, feature_matrix, matrix_name, sequence_control, limiter):
+    """
+    Initializer of the generate_instance_graph_parallel pool.
+    Keeps the arguments used by all partitions in the worker, and registers
+    the feature matrix under the name the parent registered it with.
+    """
+    share_feature_matrix(matrix_name, feature_matrix)
+    _partition_worker.update(labels=labels, feature_matrix=feature_matrix,
+                             sequence_control=sequence_control, limiter=limiter)
+
+
+def _build_partition(partition):
+    """
+    Worker for generate_instance_graph_parallel.
+    Build the InstanceNode of each user in the partition.
+
+    The SequenceItems reference the shared feature matrix, which is pickled
+    back by name (see share_feature_matrix), so the nodes received by the
+    parent point at the parent's matrix.
+
+    :param partition: Tuple of (users, {user: revisions}, {user: feature rows})
+    :type partition: tuple
+    :return: List of (user, InstanceNode)
+    :rtype: list
+    """
+    users, graph_data, feature_rows = partition
+    labels = _partition_worker['labels']
+    sequence_control = _partition_worker['sequence_control']
+
+    nodes = []
+    for user in users:
+        new_node = InstanceNode(label=labels[user], sequence_control=sequence_control)
+        new_node.sequence_list = _get_sequence_list_for(graph_data[user], labels, sequence_control=sequence_control,
+                                                        limiter=_partition_worker['limiter'],
+                                                        feature_rows=feature_rows.get(user),
+                                                        feature_matrix=_partition_worker['feature_matrix'])
+        nodes.append((user, new_node))
+    return nodes
+
+
+def generate_instance_graph_parallel(graph_data, labels, limiter=20, processes=None, partitions_per_process=4,
+                                     sequence_control='time'):
+    """
+    Same graph as generate_instance_graph, with users partitioned across
+    a pool of worker processes.
+
+    The feature matrix is computed once in the parent and given, with the
+    labels, to the workers by the pool initializer. Each partition carries
+    the revisions and feature rows of its users. The nodes are merged in a
+    fixed order.
+
+    :param graph_data:
+    :type graph_data: dict
+    :param labels:
+    :type labels: dict
+    :param limiter: Maximum number of edits in a user's sequence
+    :type limiter: int
+    :param processes: Number of worker processes. Default is the number of CPUs
+    :type processes: int
+    :param partitions_per_process: Number of partitions handed to each worker
+    :type partitions_per_process: int
+    :param sequence_control: Order of the edits in a user's sequence
+    :type sequence_control: str
+    :return:
+    :rtype: dict
+    """
+    processes = processes or multiprocessing.cpu_count()
+    feature_rows, feature_matrix = build_feature_matrix(graph_data)
+
+    users = sorted(u for u in graph_data if labels.has_key(u))
+    n_partitions = max(1, processes * partitions_per_process)
+    partitions = []
+    for i in range(n_partitions):
+        part_users = users[i::n_partitions]
+        partitions.append((part_users,
+                           dict((u, graph_data[u]) for u in part_users),
+                           dict((u, feature_rows[u]) for u in part_users if feature_rows.has_key(u))))
+
+    matrix_name = 'instance-graph-%d-%d' % (os.getpid(), id(feature_matrix))
+    share_feature_matrix(matrix_name, feature_matrix)
+    try:
+        pool = multiprocessing.Pool(processes, initializer=_init_partition_worker,
+                                    initargs=(labels, feature_matrix, matrix_name, sequence_control, limiter))
+        try:
+            results = pool.map(_build_partition, partitions)
+        finally:
+            pool.close()
+            pool.join()
+    finally:
+        share_feature_matrix(matrix_name, None)
+
+    instance_graph = {}
+    for nodes in results:
+        instance_graph.update(nodes)
+
+    return instance_graph
+
+
 class GraphLearning(Serializable):
     """
     Class for the learning models
@@ -471,32 +738,179 @@ def _f1(prec, rec):
     return (2.0 * prec * rec) / (1.0 * (prec + rec))
 
 
-if __name__ == "__main__":
-    # Get the data for concerned wiki
+def run_repetition(instance_graph, seed, depth, hidden_layer_sizes, input_sizes, learning_rate_vector,
+                   number_of_instances, objective_function="softmax_classification", training_set_dist=0.60,
+                   fanouts=None, fanout_strategy='recent'):
+    """
+    One repetition of the experiment: split instances into training and
+    test sets, train a MultiLSTM and test it.
+
+    :param instance_graph: Dict of {user: InstanceNode}
+    :param seed: Seed for random and np.random in this repetition, also used for fan-out sampling
+    :param fanouts: Maximum children expanded per depth (see MultiLSTM), None for no limits
+    :param fanout_strategy: Sampling strategy when over a fan-out limit
+    :return: Record with precision, recall and F1 per label, or None if test was not binary
+    :rtype: dict
+    """
+    random.seed(seed)
+    np.random.seed(seed)
 
-    graph_file = os.path.join(os.getcwd(), 'results', WIKINAME, 'reduced_user_graph.json')
+    instance_list = instance_graph.values()
 
-    with open(graph_file, 'rb') as inp:
-        wikidata = Serializable.load(inp)
-        # wikidata = {k:wikidata[k] for k in random.sample(wikidata.keys(), 10000)}
-        print len(wikidata)
+    t1 = time.clock()
+    lstm_stack = MultiLSTM(max_depth=depth,
+                           hidden_layer_sizes=hidden_layer_sizes,
+                           input_sizes=input_sizes,
+                           instance_graph=instance_graph,
+                           fanouts=fanouts,
+                           fanout_strategy=fanout_strategy,
+                           fanout_seed=seed)
+    random.shuffle(instance_list)
+
+    training_set_size = int(training_set_dist * len(instance_list))
+    training_set = instance_list[0:training_set_size]
+    # get labels proportion
+    label_count = 0.0
+    for i in training_set:
+        if i.get_label() == 1.0:
+            label_count += 1.0
+
+    label_proportion = label_count / training_set_size
+    print "Label proportion: ", label_proportion
+    test_set = instance_list[training_set_size:len(instance_list)]
+
+    lstm_stack.train_model_force_balance(training_set, no_of_instances=number_of_instances, max_depth=depth - 1,
+                                         objective_function=objective_function,
+                                         learning_rate_vector=learning_rate_vector)
+    t2 = time.clock()
+    test_result = lstm_stack.test_model_simple(test_set, max_depth=depth - 1)
+    if test_result is None:
+        return None
+    precision_dict, recall_dict, recall_list, all_labels = test_result
 
-    BREADTH = 1
+    return dict(seed=seed,
+                train_time=t2 - t1,
+                prec={str(l): precision_dict[l] for l in all_labels},
+                rec={str(l): recall_dict[l] for l in all_labels},
+                f1={str(l): _f1(precision_dict[l], recall_dict[l]) for l in all_labels},
+                avg_rec=np.mean(recall_list))
 
-    # contrib_file = os.path.join(os.getcwd(), 'results', 'user_contrib_test.json')
-    #
-    # with open(contrib_file, 'rb') as inp:
-    #     user_contribs = json.load(inp)
 
-    # Build labels
+def get_instance_graph(graph_file, breadth, cache_dir, graph_digest=None, wikidata=None, ending=14,
+                       sequence_control='time'):
+    """
+    Instance graph and labels for the graph file with sequences limited to breadth.
+
+    Reuses the instance graph built on an earlier run with the same graph
+    file and parameters. Otherwise the graph file is loaded (unless
+    wikidata is given), and the labels and instance graph are built and cached.
+
+    :param graph_file: Path of reduced_user_graph.json
+    :param breadth: Limiter of sequence length
+    :param cache_dir: Directory for cached instance graphs and labels
+    :param graph_digest: graph_cache.file_digest of graph_file, computed if None
+    :param wikidata: Graph already loaded from graph_file, if any
+    :param ending: Days back from latest edit for the reversion labels
+    :param sequence_control: Order of the edits in a user's sequence
+    :return: Instance graph, labels, and the loaded graph (None if it was not needed)
+    :rtype: tuple
+    """
+    if graph_digest is None:
+        graph_digest = file_digest(graph_file)
+
+    key = params_key(graph_digest, labeling='reversion', ending=ending, limiter=breadth,
+                     sequence_control=sequence_control, feature_vector_size=FEATURE_VECTOR_SIZE)
+    cached = load_instance_graph(cache_dir, key)
 
-    # build_labels_for_user_quitting(user_contribs=user_contribs)
-    # build_labels_for_revision_quality(wikidata=wikidata)
+    if cached is not None:
+        print "Loaded instance graph from cache %s" % (key)
+        instance_graph, labels = cached
+        return instance_graph, labels, wikidata
+
+    if wikidata is None:
+        with open(graph_file, 'rb') as inp:
+            wikidata = Serializable.load(inp)
+            # wikidata = {k:wikidata[k] for k in random.sample(wikidata.keys(), 10000)}
+            print len(wikidata)
+
+    # Build labels
 
     # labels = user_quitting_labels(wikidata)
-    labels = user_reversion_label(wikidata)
-    instance_graph = generate_instance_graph(wikidata, labels, limiter=BREADTH)
-    instance_list = instance_graph.values()
+    labels = user_reversion_label(wikidata, ending=ending, cache_dir=cache_dir, graph_key=graph_digest)
+    instance_graph = generate_instance_graph_parallel(wikidata, labels, limiter=breadth,
+                                                      sequence_control=sequence_control)
+    save_instance_graph(cache_dir, key, instance_graph, FEATURE_VECTOR_SIZE, sequence_control=sequence_control)
+
+    return instance_graph, labels, wikidata
+
+
+# Read-only state shared with repetition processes through fork
+_EXPERIMENT_STATE = {}
+
+
+def _run_repetition_worker(seed):
+    """
+    Worker for run_repetitions. Runs one repetition and appends its record to the log.
+    """
+    record = run_repetition(_EXPERIMENT_STATE['instance_graph'], seed, **_EXPERIMENT_STATE['params'])
+    if record is not None:
+        record.update(_EXPERIMENT_STATE['config'])
+        append_result(_EXPERIMENT_STATE['log_file'], record)
+    return record
+
+
+def run_repetitions(instance_graph, log_file, repetitions, seeds=None, processes=None, config=None, **params):
+    """
+    Run repetitions of the experiment in parallel processes.
+
+    The instance graph is shared with the processes through fork.
+    Each repetition uses its own seed and appends its record to log_file
+    (see results_log), so results of concurrent runs are not lost.
+
+    :param instance_graph: Dict of {user: InstanceNode}
+    :param log_file: Path of results log
+    :param repetitions: Number of repetitions
+    :param seeds: List of seeds, one per repetition. Random if None
+    :param processes: Number of processes. Default is min(repetitions, number of CPUs)
+    :param config: Dict of configuration values added to each record
+    :param params: Parameters of run_repetition
+    :return: Records of the repetitions
+    :rtype: list
+    """
+    if seeds is None:
+        rng = random.SystemRandom()
+        seeds = [rng.randint(0, 2 ** 31 - 1) for _ in range(repetitions)]
+    processes = processes or min(len(seeds), multiprocessing.cpu_count())
+
+    if config is None:
+        config = dict(depth=params.get('depth'), instances=params.get('number_of_instances'))
+
+    _EXPERIMENT_STATE.update(instance_graph=instance_graph, log_file=log_file, params=params, config=config)
+    try:
+        if processes == 1:
+            records = [_run_repetition_worker(seed) for seed in seeds]
+        else:
+            pool = multiprocessing.Pool(processes)
+            try:
+                records = pool.map(_run_repetition_worker, seeds)
+            finally:
+                pool.close()
+                pool.join()
+    finally:
+        _EXPERIMENT_STATE.clear()
+
+    return [r for r in records if r is not None]
+
+
+if __name__ == "__main__":
+    # Get the data for concerned wiki
+
+    graph_file = os.path.join(os.getcwd(), 'results', WIKINAME, 'reduced_user_graph.json')
+    cache_dir = os.path.join(os.getcwd(), 'results', WIKINAME, 'instance_cache')
+
+    BREADTH = 1
+
+    instance_graph, labels, _ = get_instance_graph(graph_file, BREADTH, cache_dir)
 
     # for depth in [1,2]:
 
@@ -506,92 +920,29 @@ if __name__ == "__main__":
     DEPTH = 3
     OBJECTIVE_FUNCTION = "softmax_classification"
     NUMBER_OF_INSTANCES = 50000
+    # Limit of children expanded per depth, eg. [None, 10, 5]. None for no limits
+    FANOUTS = None
+    FANOUT_STRATEGY = 'recent'
     # lstm_stack = Multi_Layer_LSTM(DEPTH, HIDDEN_LAYER_SIZES, INPUT_SIZES)
 
     TEST_RANGE = 1
 
-    results = {}
-    total_prec_list = {}
-    total_prec_list[0] = []
-    total_prec_list[1] = []
-
-    total_recall_list = {}
-    total_recall_list[0] = []
-    total_recall_list[1] = []
-
-    total_f1_list = {}
-    total_f1_list[0] = []
-    total_f1_list[1] = []
-
-    total_avg_recall_list = []
-
-    for iter in range(TEST_RANGE):
-        t1 = time.clock()
-        lstm_stack = MultiLSTM(max_depth=DEPTH,
-                               hidden_layer_sizes=HIDDEN_LAYER_SIZES,
-                               input_sizes=INPUT_SIZES,
-                               instance_graph=instance_graph)
-        # random.seed(500)
-        random.shuffle(instance_list)
-
-        training_set_dist = 0.60
-        training_set_size = int(training_set_dist * len(instance_list))
-        training_set = instance_list[0:training_set_size]
-        # get labels proportion
-        label_count = 0.0
-        for i in training_set:
-            if i.get_label() == 1.0:
-                label_count += 1.0
-
-        label_proportion = label_count / training_set_size
-        print "Label proportion: ", label_proportion
-        test_set = instance_list[training_set_size:len(instance_list)]
-
-        lstm_stack.train_model_force_balance(training_set, no_of_instances=NUMBER_OF_INSTANCES, max_depth=DEPTH - 1,
-                                             objective_function=OBJECTIVE_FUNCTION,
-                                             learning_rate_vector=LEARNING_RATE_VECTOR)
-        t2 = time.clock()
-        precision_dict, recall_dict, recall_list, all_labels = lstm_stack.test_model_simple(test_set,
-                                                                                            max_depth=DEPTH - 1)
-
-        t3 = time.clock()
-
-        results_file = os.path.join(os.getcwd(), 'results', WIKINAME,
-                                    'results_breadth_%d_depth_%d_instances_%d.json' % (
-                                    BREADTH, DEPTH, NUMBER_OF_INSTANCES))
-
-        print "Training completed in %r" % (t2 - t1)
-        if os.path.isfile(results_file):
-            with open(results_file, 'rb') as inp:
-                results = (Serializable.loads(inp.read()))
-        else:
-            results = {}
-
-        for label in all_labels:
-            label = str(label)
-            # total_prec_list[label].append(precision_dict[label])
-            # total_recall_list[label].append(recall_dict[label])
-            # total_avg_recall_list.append(np.mean(recall_list))
-            # total_f1_list[label].append(_f1(precision_dict[label], recall_dict[label]))
-            for keyname in ['prec', 'rec', 'f1']:
-                if not results.has_key(keyname):
-                    results[keyname] = {}
-                if not results[keyname].has_key(label):
-                    results[keyname][label] = []
-            if not results.has_key('avg_rec'):
-                results['avg_rec'] = []
-
-            results['prec'][label].append(precision_dict[int(label)])
-            results['rec'][label].append(recall_dict[int(label)])
-            results['f1'][label].append(_f1(precision_dict[int(label)], recall_dict[int(label)]))
-        results['avg_rec'].append(np.mean(recall_list))
-
-        with open(results_file, 'wb') as outp:
-            outp.write(Serializable.dumps(results))
-
-        #     results = dict(prec = total_prec_list, rec = total_recall_list, f1=total_f1_list, avg_rec=total_avg_recall_list)
-        #
-        # with open('results_depth_%d.json'%(DEPTH), 'wb') as outp:
-        #     outp.write(Serializable.dumps(results))
-
-        # print "Depth was: %d"%(DEPTH)
+    log_file = results_log_file(WIKINAME, BREADTH, DEPTH, NUMBER_OF_INSTANCES)
+
+    records = run_repetitions(instance_graph, log_file, TEST_RANGE,
+                              depth=DEPTH,
+                              hidden_layer_sizes=HIDDEN_LAYER_SIZES,
+                              input_sizes=INPUT_SIZES,
+                              learning_rate_vector=LEARNING_RATE_VECTOR,
+                              number_of_instances=NUMBER_OF_INSTANCES,
+                              objective_function=OBJECTIVE_FUNCTION,
+                              fanouts=FANOUTS,
+                              fanout_strategy=FANOUT_STRATEGY,
+                              config=dict(breadth=BREADTH, depth=DEPTH, instances=NUMBER_OF_INSTANCES,
+                                          hidden_layer_sizes=HIDDEN_LAYER_SIZES[:DEPTH],
+                                          learning_rate_vector=LEARNING_RATE_VECTOR[:DEPTH],
+                                          fanouts=FANOUTS,
+                                          fanout_strategy=FANOUT_STRATEGY))
+
+    for record in records:
+        print "Seed %r: training completed in %r, F1 %r" % (record['seed'], record['train_time'], record['f1'])
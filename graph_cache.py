@@ -0,0 +1,245 @@
+"""
+On-disk cache of the instance graph built in graph_analysis.
+
+Loading reduced_user_graph.json, building labels and the instance graph
+takes minutes for the larger wikis, and is the same for every run on
+the same graph file with the same parameters. This module stores the
+result as a directory of .npy files, keyed by the hash of the graph file
+and the parameters used to build it:
+
+    users.npy           Users with a label (unicode array)
+    labels.npy          Label of each user
+    seq_offsets.npy     Start of each user's sequence in the seq_* arrays (len(users) + 1)
+    seq_items.npy       Item id (revision) of each sequence item
+    seq_links.npy       Position in users.npy of the item's link node
+    seq_timestamps.npy  Timestamp of the item
+    seq_action_times.npy Timestamp of the judging action
+    features.npy        Feature vector of each sequence item, one row per item
+
+The arrays are opened with memory mapping, and InstanceNodes are only
+created when a user is accessed in the returned CachedInstanceGraph.
+
+Labels computed by graph_analysis are memoized next to the entries,
+as labels_<key>.json.
+"""
+import hashlib
+import json
+import os
+import shutil
+from collections import Mapping
+
+import numpy as np
+
+from multi_LSTM import InstanceNode, SequenceItem
+
+CACHE_VERSION = 1
+HASH_CHUNK_SIZE = 1 << 20
+
+ARRAY_NAMES = ['users', 'labels', 'seq_offsets', 'seq_items', 'seq_links',
+               'seq_timestamps', 'seq_action_times', 'features']
+
+
+def file_digest(filename):
+    """
+    SHA1 of the content of a file, read in chunks
+
+    :param filename: Path of file
+    :return: Hex digest
+    :rtype: str
+    """
+    h = hashlib.sha1()
+    with open(filename, 'rb') as inp:
+        for chunk in iter(lambda: inp.read(HASH_CHUNK_SIZE), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def params_key(graph_digest, **params):
+    """
+    Key for a graph content digest combined with the given parameters.
+    Parameters must be json serializable.
+
+    :param graph_digest: Digest identifying the graph content
+    :return: Hex key
+    :rtype: str
+    """
+    h = hashlib.sha1()
+    h.update(graph_digest)
+    h.update(json.dumps(dict(params, cache_version=CACHE_VERSION), sort_keys=True))
+    return h.hexdigest()
+
+
+def cache_key(graph_file, **params):
+    """
+    Key of a cache entry for graph_file built with the given parameters
+    (labeling, limiter, ...). Parameters must be json serializable.
+
+    :param graph_file: Path of the user graph json file
+    :return: Hex key
+    :rtype: str
+    """
+    return params_key(file_digest(graph_file), **params)
+
+
+def _labels_file(cache_dir, key):
+    return os.path.join(cache_dir, 'labels_%s.json' % (key))
+
+
+def load_labels(cache_dir, key):
+    """
+    Labels memoized under key, or None
+
+    :param cache_dir: Directory holding cache entries
+    :param key: Key from params_key
+    :rtype: dict
+    """
+    filename = _labels_file(cache_dir, key)
+    if not os.path.isfile(filename):
+        return None
+    with open(filename, 'rb') as inp:
+        return json.load(inp)
+
+
+def save_labels(cache_dir, key, labels):
+    """
+    Memoize labels under key. Written to a temporary file and renamed into place.
+
+    :param cache_dir: Directory holding cache entries
+    :param key: Key from params_key
+    :param labels: Dict of {user: label}
+    """
+    if not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir)
+    filename = _labels_file(cache_dir, key)
+    with open(filename + '.tmp', 'wb') as outp:
+        json.dump(labels, outp)
+    os.rename(filename + '.tmp', filename)
+
+
+def _entry_dir(cache_dir, key):
+    return os.path.join(cache_dir, key)
+
+
+def save_instance_graph(cache_dir, key, instance_graph, feature_vector_size, sequence_control='time'):
+    """
+    Store instance graph in cache_dir under key.
+
+    The entry is written into a temporary directory and renamed into
+    place, so a reader never sees a partial entry.
+
+    :param cache_dir: Directory holding cache entries
+    :param key: Key from cache_key
+    :param instance_graph: Dict of {user: InstanceNode}
+    :param feature_vector_size: Length of the feature vector of an item
+    :param sequence_control: Sequence control to set on loaded nodes
+    :return: Path of the entry
+    :rtype: str
+    """
+    users = sorted(instance_graph.keys())
+    position = {u: i for i, u in enumerate(users)}
+
+    offsets = [0]
+    items, links, timestamps, action_times, features = [], [], [], [], []
+    for user in users:
+        for s in instance_graph[user].sequence_list or []:
+            items.append(s.item_id)
+            links.append(position[s.link_node_id])
+            timestamps.append(s.timestamp)
+            action_times.append(s.action_time)
+            features.append(s.get_feature_vector())
+        offsets.append(len(items))
+
+    arrays = dict(users=np.array(users, dtype=unicode),
+                  labels=np.array([instance_graph[u].get_label() for u in users], dtype=np.int64),
+                  seq_offsets=np.array(offsets, dtype=np.int64),
+                  seq_items=np.array(items, dtype=unicode),
+                  seq_links=np.array(links, dtype=np.int64),
+                  seq_timestamps=np.array(timestamps, dtype=np.int64),
+                  seq_action_times=np.array(action_times, dtype=np.int64),
+                  features=np.array(features, dtype=np.float64).reshape(len(features), feature_vector_size))
+
+    target = _entry_dir(cache_dir, key)
+    tmp_dir = target + '.tmp.%d' % os.getpid()
+    if not os.path.isdir(tmp_dir):
+        os.makedirs(tmp_dir)
+
+    for name in ARRAY_NAMES:
+        np.save(os.path.join(tmp_dir, name + '.npy'), arrays[name])
+    with open(os.path.join(tmp_dir, 'meta.json'), 'wb') as outp:
+        json.dump(dict(sequence_control=sequence_control, version=CACHE_VERSION), outp)
+
+    if os.path.isdir(target):
+        shutil.rmtree(target)
+    os.rename(tmp_dir, target)
+    return target
+
+
+def load_instance_graph(cache_dir, key):
+    """
+    Load a cache entry if it exists
+
+    :param cache_dir: Directory holding cache entries
+    :param key: Key from cache_key
+    :return: (CachedInstanceGraph, labels dict) or None if not cached
+    :rtype: tuple
+    """
+    entry = _entry_dir(cache_dir, key)
+    if not os.path.isfile(os.path.join(entry, 'meta.json')):
+        return None
+
+    with open(os.path.join(entry, 'meta.json'), 'rb') as inp:
+        meta = json.load(inp)
+
+    arrays = {name: np.load(os.path.join(entry, name + '.npy'), mmap_mode='r') for name in ARRAY_NAMES}
+    instance_graph = CachedInstanceGraph(arrays, sequence_control=meta['sequence_control'])
+    labels = {u: int(l) for u, l in zip(instance_graph.users, arrays['labels'])}
+
+    return instance_graph, labels
+
+
+class CachedInstanceGraph(Mapping):
+    """
+    Read-only dict of {user: InstanceNode} over the arrays of a cache entry.
+    Nodes are created on first access and kept, since the
+    learning code stores its cache and gradients on them.
+    """
+
+    def __init__(self, arrays, sequence_control='time'):
+        self.arrays = arrays
+        self.sequence_control = sequence_control
+        self.users = [unicode(u) for u in arrays['users']]
+        self.position = {u: i for i, u in enumerate(self.users)}
+        self.feature_matrix = arrays['features']
+        self._nodes = {}
+
+    def _build_node(self, i):
+        a = self.arrays
+        start, end = a['seq_offsets'][i], a['seq_offsets'][i + 1]
+
+        node = InstanceNode(label=int(a['labels'][i]), sequence_control=self.sequence_control)
+        node.sequence_list = [SequenceItem(item_id=unicode(a['seq_items'][j]),
+                                           link_node_id=self.users[a['seq_links'][j]],
+                                           timestamp=int(a['seq_timestamps'][j]),
+                                           action_time=int(a['seq_action_times'][j]),
+                                           feature_matrix=self.feature_matrix,
+                                           feature_row=j)
+                              for j in range(start, end)]
+        return node
+
+    def __getitem__(self, user):
+        node = self._nodes.get(user)
+        if node is None:
+            node = self._nodes[user] = self._build_node(self.position[user])
+        return node
+
+    def __iter__(self):
+        return iter(self.users)
+
+    def __len__(self):
+        return len(self.users)
+
+    def __contains__(self, user):
+        return user in self.position
+
+    def has_key(self, user):
+        return user in self.position
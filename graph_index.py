@@ -0,0 +1,254 @@
+"""
+Time index over the user graph generated by user_graph.
+
+The user graph is a dict of the form
+    {user: {rev: {'timestamp': ..., 'list': [...]}}}
+
+Label builders in graph_analysis look at the graph as it was in a
+time window (some days back from the latest edit). Instead of copying
+the whole nested dict for every window, the index keeps for each user
+the revision keys sorted by timestamp along with a numpy array of the
+timestamps, and the maximum timestamp of the graph.
+
+A window is then a GraphSnapshot, which behaves as a read-only dict of
+{user: {rev: data}} and finds the revisions of a user in the window
+with searchsorted only when that user is accessed.
+
+EdgeTable holds the same graph as flat numpy columns (one row per
+revision) for computations over all users at once, like finding
+each user's latest edit with a grouped argmax.
+"""
+import hashlib
+from collections import Mapping
+
+import numpy as np
+
+SECS_IN_DAY = 3600 * 24
+
+
+class UserTimeIndex(object):
+    """
+    Per user, revision keys and timestamps sorted by time.
+    """
+
+    def __init__(self, graph):
+        """
+
+        :param graph: User graph in structure {user: {rev: {'timestamp':..., 'list':[...]}}}
+        :type graph: dict
+        """
+        self.graph = graph
+        self.revs = {}
+        self.times = {}
+        self.max_time = None
+
+        for user, values in graph.iteritems():
+            ordered = sorted(values.iteritems(), key=lambda x: x[1]['timestamp'])
+            self.revs[user] = [k for k, _ in ordered]
+            self.times[user] = np.array([v['timestamp'] for _, v in ordered], dtype=np.int64)
+
+            if len(ordered) and (self.max_time is None or self.times[user][-1] > self.max_time):
+                self.max_time = int(self.times[user][-1])
+
+    def window(self, user, start_time=None, end_time=None):
+        """
+        Positions [lo, hi) of user's revisions with start_time < timestamp < end_time
+
+        :param user: User in graph
+        :param start_time: Exclusive lower bound in seconds, None for no bound
+        :param end_time: Exclusive upper bound in seconds, None for no bound
+        :return: (lo, hi)
+        :rtype: tuple
+        """
+        times = self.times[user]
+        lo = 0 if start_time is None else int(np.searchsorted(times, start_time, side='right'))
+        hi = len(times) if end_time is None else int(np.searchsorted(times, end_time, side='left'))
+        return lo, max(lo, hi)
+
+    def snapshot(self, ending=7, starting_from=None):
+        """
+        View of the graph with entries older than `ending` days from the
+        latest edit, and newer than `starting_from` days if given.
+
+        Same semantics as graph_analysis._graph_from_days_back: without
+        starting_from all users are kept, otherwise users left without
+        revisions are dropped.
+
+        :param ending: Days back from latest edit where the window ends
+        :param starting_from: Days back from latest edit where the window starts
+        :rtype: GraphSnapshot
+        """
+        end_time = self.max_time - ending * SECS_IN_DAY
+        start_time = None if starting_from is None else self.max_time - starting_from * SECS_IN_DAY
+        return GraphSnapshot(self, start_time=start_time, end_time=end_time,
+                             drop_empty=starting_from is not None)
+
+
+class GraphSnapshot(Mapping):
+    """
+    Read-only view of the user graph in a time window.
+    Nothing is copied until a user's entries are accessed.
+    """
+
+    def __init__(self, index, start_time=None, end_time=None, drop_empty=False):
+        self.index = index
+        self.start_time = start_time
+        self.end_time = end_time
+        self.drop_empty = drop_empty
+        self._users = None
+
+    def _window(self, user):
+        return self.index.window(user, self.start_time, self.end_time)
+
+    def _user_list(self):
+        if self._users is None:
+            if self.drop_empty:
+                self._users = [u for u in self.index.revs if self.count(u)]
+            else:
+                self._users = list(self.index.revs)
+        return self._users
+
+    def count(self, user):
+        """
+        Number of revisions of user inside the window
+        """
+        lo, hi = self._window(user)
+        return hi - lo
+
+    def rev_keys(self, user):
+        """
+        Revision keys of user inside the window, sorted by timestamp
+        """
+        lo, hi = self._window(user)
+        return self.index.revs[user][lo:hi]
+
+    def last_rev(self, user):
+        """
+        Latest revision entry of user inside the window, or None
+        """
+        lo, hi = self._window(user)
+        if hi == lo:
+            return None
+        return self.index.graph[user][self.index.revs[user][hi - 1]]
+
+    @property
+    def max_time(self):
+        return self.index.max_time
+
+    def __getitem__(self, user):
+        if user not in self.index.revs or (self.drop_empty and not self.count(user)):
+            raise KeyError(user)
+        values = self.index.graph[user]
+        return {k: values[k] for k in self.rev_keys(user)}
+
+    def __contains__(self, user):
+        return user in self.index.revs and not (self.drop_empty and not self.count(user))
+
+    def has_key(self, user):
+        return user in self
+
+    def __iter__(self):
+        return iter(self._user_list())
+
+    def __len__(self):
+        return len(self._user_list())
+
+
+class EdgeTable(object):
+    """
+    Columnar form of the user graph, one row per revision (edge):
+
+        users       List of users, position is the user index
+        user_idx    Index of the revision's user
+        timestamps  Timestamp of the revision
+        quality     Quality (_qual) of the first judgement, NaN if not judged
+
+    Used by the label builders which only need these columns.
+    """
+
+    def __init__(self, graph):
+        """
+
+        :param graph: User graph or its UserTimeIndex
+        :type graph: dict | UserTimeIndex
+        """
+        if isinstance(graph, UserTimeIndex):
+            graph = graph.graph
+
+        self.users = sorted(graph.keys())
+        user_idx, timestamps, d01, d02, d12 = [], [], [], [], []
+
+        for i, user in enumerate(self.users):
+            for data in graph[user].itervalues():
+                if not data.has_key('timestamp'):
+                    continue
+                user_idx.append(i)
+                timestamps.append(data['timestamp'])
+                if len(data.get('list', [])):
+                    element = data['list'][0]
+                    d01.append(element['d01'])
+                    d02.append(element['d02'])
+                    d12.append(element['d12'])
+                else:
+                    d01.append(np.nan)
+                    d02.append(np.nan)
+                    d12.append(np.nan)
+
+        user_idx = np.array(user_idx, dtype=np.int64)
+        timestamps = np.array(timestamps, dtype=np.int64)
+
+        d01 = np.array(d01, dtype=np.float64)
+        diff = np.array(d02, dtype=np.float64) - np.array(d12, dtype=np.float64)
+        quality = np.where(d01 != 0, diff / np.where(d01 != 0, d01, 1.0), diff)
+
+        # Rows in a fixed order, so the same graph always gives the same columns
+        order = np.lexsort((quality, timestamps, user_idx))
+        self.user_idx = user_idx[order]
+        self.timestamps = timestamps[order]
+        self.quality = quality[order]
+
+        self.max_time = int(self.timestamps.max()) if len(self.timestamps) else None
+
+        # The rows of a user are a run sorted by timestamp. Keys put the runs one after
+        # the other on one sorted axis, so last_edits finds a window in every run with a
+        # searchsorted. Timestamps in seconds span less than 2**31, so keys fit in int64.
+        self._min_time = int(self.timestamps.min()) if len(self.timestamps) else 0
+        self._span = (self.max_time - self._min_time + 2) if len(self.timestamps) else 1
+        self._keys = self.user_idx * self._span + (self.timestamps - self._min_time)
+        self._run_users = np.unique(self.user_idx)
+
+    def digest(self):
+        """
+        SHA1 of the columns, identifies the content of the graph for label memoization
+
+        :rtype: str
+        """
+        h = hashlib.sha1()
+        h.update('\n'.join(u.encode('utf-8') if isinstance(u, unicode) else u for u in self.users))
+        for column in [self.user_idx, self.timestamps, self.quality]:
+            h.update(np.ascontiguousarray(column).tostring())
+        return h.hexdigest()
+
+    def last_edits(self, start_time=None, end_time=None):
+        """
+        Grouped argmax of timestamp per user, among the revisions with
+        start_time < timestamp < end_time. The window is found in each
+        user's run of rows with searchsorted, without a pass over all rows.
+
+        :param start_time: Exclusive lower bound, None for no bound
+        :param end_time: Exclusive upper bound, None for no bound
+        :return: Row of the latest revision for each user having one in the window
+        :rtype: np.ndarray
+        """
+        offset = self._run_users * self._span
+
+        # First row of each run at or after end_time, and first row after start_time
+        end = self._span - 1 if end_time is None else min(max(end_time - self._min_time, 0), self._span - 1)
+        hi = np.searchsorted(self._keys, offset + end, side='left')
+        if start_time is None:
+            lo = np.searchsorted(self._keys, offset, side='left')
+        else:
+            start = min(max(start_time - self._min_time, -1), self._span - 2)
+            lo = np.searchsorted(self._keys, offset + start, side='right')
+
+        return (hi - 1)[hi > lo]
@@ -0,0 +1,244 @@
+"""
+Reduce the user graph written by user_graph (user_graph.json) to the
+reduced_user_graph.json read by graph_analysis.
+
+The full graph is too large to load, so it is read as a stream: the
+top level json object is decoded one user at a time, and each reduced
+user is written out before the next one is read. Memory use is bounded
+by the largest single user, not by the size of the file.
+
+The reduction is done in two passes over the input:
+
+    1. Find the latest timestamp of the graph, which fixes the window
+       used by graph_analysis.user_reversion_label.
+    2. For every user:
+        - keep only the first judgement of each revision after
+          _cleanup_user_list deduplication,
+        - keep only the fields used for features, labels and sequences,
+        - drop revisions which were not judged, and users which would
+          not get a label (no revision judged before the window end).
+
+The revision holding the latest timestamp is always kept, so the
+reduced graph has the same window and the labels built from it are the
+same as those built from the full graph.
+"""
+import json
+import os
+import re
+
+from graph_analysis import FEATURE_FIELDS
+from graph_index import SECS_IN_DAY
+from user_graph import WIKINAME, _cleanup_user_list
+
+READ_CHUNK_SIZE = 1 << 20
+
+# Fields of a judgement kept in the reduced graph: features, judge and time of the judgement
+KEPT_FIELDS = FEATURE_FIELDS + ['uname2', 'timestamp']
+
+_WHITESPACE = re.compile(r'\s*')
+
+
+class _JsonObjectStream(object):
+    """
+    Reads the (key, value) pairs of a top level json object from a file,
+    holding in memory only the pair being decoded.
+    """
+
+    def __init__(self, inp, chunk_size=READ_CHUNK_SIZE):
+        self.inp = inp
+        self.chunk_size = chunk_size
+        self.decoder = json.JSONDecoder()
+        self.buf = ''
+        self.pos = 0
+        self.eof = False
+
+    def _more(self):
+        """
+        Read the next chunk into the buffer, dropping what was consumed.
+        Returns False at end of file.
+        """
+        if self.eof:
+            return False
+        chunk = self.inp.read(self.chunk_size)
+        if not chunk:
+            self.eof = True
+            return False
+        self.buf = self.buf[self.pos:] + chunk
+        self.pos = 0
+        return True
+
+    def _next_char(self):
+        """
+        Skip whitespace and return the next character without consuming it, '' at end of file
+        """
+        while True:
+            self.pos = _WHITESPACE.match(self.buf, self.pos).end()
+            if self.pos < len(self.buf):
+                return self.buf[self.pos]
+            if not self._more():
+                return ''
+
+    def _expect(self, char):
+        found = self._next_char()
+        if found != char:
+            raise ValueError("Expected %r at offset %d, found %r" % (char, self.pos, found))
+        self.pos += 1
+
+    def _decode(self):
+        """
+        Decode the json value starting at the current position, reading more
+        of the file while the value is incomplete
+        """
+        self._next_char()
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buf, self.pos)
+            except ValueError:
+                if not self._more():
+                    raise
+                continue
+            self.pos = end
+            return value
+
+    def __iter__(self):
+        self._expect('{')
+        if self._next_char() == '}':
+            return
+
+        while True:
+            key = self._decode()
+            self._expect(':')
+            yield key, self._decode()
+
+            if self._next_char() == ',':
+                self.pos += 1
+            else:
+                self._expect('}')
+                return
+
+
+def iter_graph(graph_file, chunk_size=READ_CHUNK_SIZE):
+    """
+    Iterate over the (user, revisions) pairs of a user graph json file
+
+    :param graph_file: Path of user graph json
+    :param chunk_size: Bytes read at a time
+    :rtype: iterator
+    """
+    with open(graph_file, 'rb') as inp:
+        for user, values in _JsonObjectStream(inp, chunk_size=chunk_size):
+            yield user, values
+
+
+def _latest_revision(graph_file):
+    """
+    First pass: latest revision timestamp of the graph, and the (user, rev) holding it
+
+    :rtype: tuple
+    """
+    max_time, anchor = None, None
+    for user, values in iter_graph(graph_file):
+        for rev, data in values.iteritems():
+            if data.has_key('timestamp') and (max_time is None or data['timestamp'] > max_time):
+                max_time, anchor = data['timestamp'], (user, rev)
+    return max_time, anchor
+
+
+def _has_label(values, end_time):
+    """
+    Whether user_reversion_label gives the user a label: its latest revisions
+    before end_time are all judged.
+
+    :param values: Revisions of the user
+    :param end_time: Exclusive end of the labeling window
+    :rtype: bool
+    """
+    last_time, judged = None, False
+    for data in values.itervalues():
+        if not data.has_key('timestamp') or data['timestamp'] >= end_time:
+            continue
+        is_judged = len(data.get('list', [])) > 0
+        if last_time is None or data['timestamp'] > last_time:
+            last_time, judged = data['timestamp'], is_judged
+        elif data['timestamp'] == last_time:
+            judged = judged and is_judged
+    return judged
+
+
+def reduce_revision(data):
+    """
+    Reduced entry of a revision: its timestamp and the first judgement
+    left by _cleanup_user_list, with only KEPT_FIELDS
+
+    :param data: Revision entry {'timestamp':..., 'list':[...]}
+    :rtype: dict
+    """
+    entry = _cleanup_user_list(data['list'])[0]
+    return {'timestamp': data['timestamp'],
+            'list': [{f: entry[f] for f in KEPT_FIELDS}]}
+
+
+def reduce_user(values, end_time, anchor_rev=None):
+    """
+    Reduced revisions of a user, or None if the user is dropped
+
+    :param values: Revisions of the user
+    :param end_time: Exclusive end of the labeling window
+    :param anchor_rev: Revision to keep even if the user is dropped (holder of the latest timestamp)
+    :rtype: dict
+    """
+    if not _has_label(values, end_time):
+        if anchor_rev is None:
+            return None
+        data = values[anchor_rev]
+        if len(data.get('list', [])):
+            return {anchor_rev: reduce_revision(data)}
+        return {anchor_rev: {'timestamp': data['timestamp'], 'list': []}}
+
+    reduced = {}
+    for rev, data in values.iteritems():
+        if data.has_key('timestamp') and len(data.get('list', [])):
+            reduced[rev] = reduce_revision(data)
+    if anchor_rev is not None and anchor_rev not in reduced:
+        reduced[anchor_rev] = {'timestamp': values[anchor_rev]['timestamp'], 'list': []}
+    return reduced
+
+
+def reduce_graph(graph_file, reduced_file, ending=14):
+    """
+    Write the reduced graph of graph_file into reduced_file.
+    The output is written to a temporary file and renamed into place.
+
+    :param graph_file: Path of user_graph.json
+    :param reduced_file: Path of reduced_user_graph.json
+    :param ending: Days back from the latest edit used by user_reversion_label
+    :return: Number of users read and number of users kept
+    :rtype: tuple
+    """
+    max_time, anchor = _latest_revision(graph_file)
+    end_time = max_time - ending * SECS_IN_DAY if max_time is not None else None
+
+    read, kept = 0, 0
+    with open(reduced_file + '.tmp', 'wb') as outp:
+        outp.write('{')
+        for user, values in iter_graph(graph_file):
+            read += 1
+            anchor_rev = anchor[1] if anchor is not None and anchor[0] == user else None
+            reduced = reduce_user(values, end_time, anchor_rev=anchor_rev) if end_time is not None else None
+            if reduced is None:
+                continue
+
+            outp.write(',\n' if kept else '\n')
+            outp.write('%s: %s' % (json.dumps(user), json.dumps(reduced, sort_keys=True)))
+            kept += 1
+        outp.write('\n}\n')
+    os.rename(reduced_file + '.tmp', reduced_file)
+
+    return read, kept
+
+
+if __name__ == "__main__":
+    results_dir = os.path.join(os.getcwd(), 'results', WIKINAME)
+    read, kept = reduce_graph(os.path.join(results_dir, 'user_graph.json'),
+                              os.path.join(results_dir, 'reduced_user_graph.json'))
+    print "Users read %d, kept %d" % (read, kept)
@@ -19,6 +19,8 @@ Primary functions:
     - test_nn_using_k_lstm_bit
     - train_nn_only
     - test_nn_only
+    - bucketed_batches
+    - stack_batch
 
 - Rakshit Agrawal, 2016
 """
@@ -58,7 +60,9 @@ def _train_nn_with_k_lstm_bits(data_list,
                                N=1000,
                                quality=True,
                                fix_bit_val=None,
-                               weighted_learning=False):
+                               weighted_learning=False,
+                               batch_size=None,
+                               bucket_width=1):
     """
 
     Get the items of dict of authors with each value containing:
@@ -78,14 +82,22 @@ def _train_nn_with_k_lstm_bits(data_list,
         the LSTM's k bits are then fed back through the LSTM to perform
         a backward using AdaDelta algorithm.
 
+    If batch_size is given, the authors of an iteration are instead taken
+    in batches from bucketed_batches. Each batch goes through the LSTM in
+    one forward and one backward call (see _train_lstm_batch).
+
     :param data_list: This list contains all items in structure (author, (x_mat, fy, yt))
     :param k: Number of bits to be used
     :param N: Number of iterations for training
     :param quality: Boolean to control if working on quality, otherwise existence
     :param fix_bit_val: Fixed value of bit to be used if only that bit should be passed to NN
     :param weighted_learning: Boolena to control weighted learning. Default is False
+    :param batch_size: Number of authors per batched LSTM call, None to train author by author
+    :param bucket_width: Number of distinct history lengths sharing a batch (see bucketed_batches)
     :return: (Trained LSTM, Trained NNet), List of errors
     """
+    if batch_size is not None and not ((k > 0 or k is None) and fix_bit_val is None):
+        raise ValueError("Batches are only used when LSTM bits are passed to the NN")
 
     Nf = Nf_quality if quality else Nf_existence
     # Initialize an LSTM
@@ -114,55 +126,63 @@ def _train_nn_with_k_lstm_bits(data_list,
         # Create empty list for collecting errors, predicted outputs
         errors = np.array([])
 
-        # Start the process for each author
-        for cnt, (author, (x_mat, fy, yt)) in enumerate(data_list):
-
-            # Ignore if target doesn't exist
-            if not yt:
-                continue
-
-            Y = np.array([])
-            if (k > 0 or k is None) and fix_bit_val is None:
-                # Run LSTM only if bits from LSTM are required
-                # Send x features to the wikipedia_lstm and collect output in Y
-                Y = lstm.forward(x_mat)
-
-            # Set the input for NNet using k bits of Y
-            nnet_input = np.concatenate((Y[:k], fy)) if fix_bit_val is None else np.concatenate(
-                (np.array(fix_bit_val), fy))
-
-            # Sending input to NNet
-            y = nnet.forward(nnet_input)
-
-            if (k > 0 or k is None) and quality:
-                # Quality normalized
-                yt = 1.0 * (yt + 1.0) / 2.0
-
-            # Measure squared loss
-            e = np.sum((y - yt) ** 2)
-            dy = 2.0 * (y - yt)
-
-            # Add loss to error list
-            errors = np.append(errors, e)
-
-            # Now send the loss through NN backpropagation
-            bp_res = nnet.backward_adadelta(dy)
-
-            if k > 0 or k is None:
-                # Send through LSTM only if its bits count
-                # Generate input for LSTM backward round
-                back_el = np.zeros(Y.shape)
-                bp_res = np.resize(bp_res, Y.shape)
-                back_el[:k] = bp_res[:k]
-
-                # Send the result on bit back through the LSTM
-                if weighted_learning:
-                    # Get update size using average of this revision's
-                    # char added and char subtracted (fy[3] and fy[4])
-                    update_size = np.average((fy[3], fy[4]))
-                    learning_factor = _learning_factor(update_size)
-
-                lstm.backward_adadelta(back_el, learning_factor=learning_factor)
+        if batch_size is not None:
+            # Authors without a target are ignored, as below
+            items = [(author, (x_mat, fy, yt)) for (author, (x_mat, fy, yt)) in data_list if yt]
+            for batch in bucketed_batches(items, batch_size=batch_size, bucket_width=bucket_width, balanced=False):
+                batch_errors = _train_lstm_batch(batch, lstm, nnet, k=k, quality=quality,
+                                                 weighted_learning=weighted_learning)
+                errors = np.append(errors, batch_errors)
+        else:
+            # Start the process for each author
+            for cnt, (author, (x_mat, fy, yt)) in enumerate(data_list):
+
+                # Ignore if target doesn't exist
+                if not yt:
+                    continue
+
+                Y = np.array([])
+                if (k > 0 or k is None) and fix_bit_val is None:
+                    # Run LSTM only if bits from LSTM are required
+                    # Send x features to the wikipedia_lstm and collect output in Y
+                    Y = lstm.forward(x_mat)
+
+                # Set the input for NNet using k bits of Y
+                nnet_input = np.concatenate((Y[:k], fy)) if fix_bit_val is None else np.concatenate(
+                    (np.array(fix_bit_val), fy))
+
+                # Sending input to NNet
+                y = nnet.forward(nnet_input)
+
+                if (k > 0 or k is None) and quality:
+                    # Quality normalized
+                    yt = 1.0 * (yt + 1.0) / 2.0
+
+                # Measure squared loss
+                e = np.sum((y - yt) ** 2)
+                dy = 2.0 * (y - yt)
+
+                # Add loss to error list
+                errors = np.append(errors, e)
+
+                # Now send the loss through NN backpropagation
+                bp_res = nnet.backward_adadelta(dy)
+
+                if k > 0 or k is None:
+                    # Send through LSTM only if its bits count
+                    # Generate input for LSTM backward round
+                    back_el = np.zeros(Y.shape)
+                    bp_res = np.resize(bp_res, Y.shape)
+                    back_el[:k] = bp_res[:k]
+
+                    # Send the result on bit back through the LSTM
+                    if weighted_learning:
+                        # Get update size using average of this revision's
+                        # char added and char subtracted (fy[3] and fy[4])
+                        update_size = np.average((fy[3], fy[4]))
+                        learning_factor = _learning_factor(update_size)
+
+                    lstm.backward_adadelta(back_el, learning_factor=learning_factor)
 
         # Print average error
         iter_ctr += 1
@@ -179,6 +199,55 @@ def _train_nn_with_k_lstm_bits(data_list,
     return (lstm, nnet), errors
 
 
+def _train_lstm_batch(batch, lstm, nnet, k=None, quality=True, weighted_learning=False):
+    """
+    One training step of _train_nn_with_k_lstm_bits on a batch from bucketed_batches.
+
+    The histories of the batch go through the LSTM in one forward call.
+    Each author's k bits are then sent with its fy through the NNet, which
+    is trained author by author as it takes one input at a time. The
+    derivatives on the k bits of all authors are sent back through the LSTM
+    in one backward call. With weighted_learning, an author's derivatives
+    are scaled by its learning factor.
+
+    :param batch: List of items in structure (author, (x_mat, fy, yt))
+    :param lstm: LSTM being trained
+    :param nnet: Neural Net being trained
+    :param k: Number of bits to be used
+    :param quality: Boolean to control if working on quality, otherwise existence
+    :param weighted_learning: Boolean to control weighted learning
+    :return: Errors of the authors of the batch
+    :rtype: list
+    """
+    X, lengths, fy_mat, yt_vect = stack_batch(batch)
+    Y = lstm.forward(X)
+
+    errors = []
+    back_el = np.zeros(Y.shape)
+    for b in range(len(batch)):
+        y = nnet.forward(np.concatenate((Y[b, :k], fy_mat[b])))
+
+        yt = yt_vect[b]
+        if quality:
+            # Quality normalized
+            yt = 1.0 * (yt + 1.0) / 2.0
+
+        # Measure squared loss
+        e = np.sum((y - yt) ** 2)
+        dy = 2.0 * (y - yt)
+        errors.append(e)
+
+        # Derivatives on the inputs of the NNet coming from the LSTM
+        bp_res = np.asarray(nnet.backward_adadelta(dy)).ravel()[:Y.shape[1]]
+        back_el[b, :k] = bp_res[:k]
+
+        if weighted_learning:
+            back_el[b] *= _learning_factor(np.average((fy_mat[b][3], fy_mat[b][4])))
+
+    lstm.backward_adadelta(back_el)
+    return errors
+
+
 def _test_nn_with_k_lstm_bits(test_data, lstm, nnet, k=None, quality=True, fix_bit_val=None):
     """
 
@@ -267,7 +336,9 @@ def train_nn_using_k_lstm_bit(train_dict,
                               store=False,
                               picklefile=os.path.join(os.getcwd(), 'results', 'temp_model.pkl'),
                               weighted_learning=False,
-                              balanced=True):
+                              balanced=True,
+                              batch_size=None,
+                              bucket_width=1):
     """
     Train the LSTM and NNet combination using training dict.
 
@@ -280,6 +351,8 @@ def train_nn_using_k_lstm_bit(train_dict,
     :param picklefile: Pickle filename
     :param weighted_learning: Boolean to control whether learning is weighted or not
     :param balanced: Boolean to control whether results should be balanced before use or not
+    :param batch_size: Number of authors per batched LSTM call, None to train author by author
+    :param bucket_width: Number of distinct history lengths sharing a batch (see bucketed_batches)
     :rtype tuple
     :return: Returns a tuple consisting of lstm and neural net (lstm, nnet)
     """
@@ -292,7 +365,8 @@ def train_nn_using_k_lstm_bit(train_dict,
     print "Statuses-- Weighted: %r, Balanced %r" % (weighted_learning, balanced)
     t_start = time.clock()
     (lstm_out, nn_out), errors = _train_nn_with_k_lstm_bits(train_items, k=k, N=N, fix_bit_val=fix_bit_val,
-                                                            weighted_learning=weighted_learning, quality=quality)
+                                                            weighted_learning=weighted_learning, quality=quality,
+                                                            batch_size=batch_size, bucket_width=bucket_width)
     print "Training completed in %r seconds" % (time.clock() - t_start)
 
     # Store the trained model into a pickle if store is True
@@ -364,6 +438,75 @@ def _rebalance_data(items):
     return new_items
 
 
+def bucketed_batches(items, batch_size=32, bucket_width=1, balanced=True, shuffle=True):
+    """
+    Group the results by number of past revisions and yield batches of
+    authors whose x_mat has the same (or nearly the same) length.
+
+    Items are first rebalanced with _rebalance_data (if balanced is True),
+    then placed into buckets keyed by len(x_mat) / bucket_width.
+    Each bucket is cut into batches of at most batch_size items, and
+    the order of batches is shuffled so that an epoch does not go
+    from short to long histories.
+
+    :param items: List of items in structure (author, (x_mat, fy, yt))
+    :param batch_size: Maximum number of items per batch
+    :param bucket_width: Number of distinct lengths sharing a bucket. 1 gives same-length batches
+    :param balanced: Boolean to control whether results should be balanced before bucketing
+    :param shuffle: Boolean to control shuffling within buckets and of the batch order
+    :return: Iterator over lists of items
+    """
+    if batch_size < 1:
+        raise ValueError("batch_size must be at least 1, got %r" % (batch_size,))
+    if bucket_width < 1:
+        raise ValueError("bucket_width must be at least 1, got %r" % (bucket_width,))
+
+    if balanced:
+        items = _rebalance_data(items)
+
+    buckets = {}
+    for (author, (x_mat, fy, yt)) in items:
+        buckets.setdefault(len(x_mat) // bucket_width, []).append((author, (x_mat, fy, yt)))
+
+    batches = []
+    for key in sorted(buckets.keys()):
+        bucket = buckets[key]
+        if shuffle:
+            random.shuffle(bucket)
+        for start in range(0, len(bucket), batch_size):
+            batches.append(bucket[start:start + batch_size])
+
+    if shuffle:
+        random.shuffle(batches)
+
+    return iter(batches)
+
+
+def stack_batch(batch):
+    """
+    Stack a batch from bucketed_batches into arrays for a batched LSTM call.
+
+    Histories shorter than the longest one in the batch are padded with
+    zeros at the beginning, so the last time step of every column is
+    the author's latest revision.
+
+    :param batch: List of items in structure (author, (x_mat, fy, yt))
+    :return: X of shape (n, b, Nf), lengths, matrix of fy rows, array of yt
+    """
+    lengths = np.array([len(x_mat) for (author, (x_mat, fy, yt)) in batch])
+    n = lengths.max()
+    Nf = batch[0][1][0].shape[1]
+
+    X = np.zeros((n, len(batch), Nf))
+    for b, (author, (x_mat, fy, yt)) in enumerate(batch):
+        X[n - lengths[b]:, b, :] = x_mat
+
+    fy_mat = np.array([fy for (author, (x_mat, fy, yt)) in batch])
+    yt_vect = np.array([yt for (author, (x_mat, fy, yt)) in batch])
+
+    return X, lengths, fy_mat, yt_vect
+
+
 def train_nn_only(train_dict,
                   N=1000,
                   store=False,
@@ -1,6 +1,6 @@
 import numpy as np
 from multi_layer_lstm.statistical_significance import statistical_significance
-from json_plus import Serializable
+from results_log import read_results, results_log_file
 import os
 
 def significance_among(list1, list2, level):
@@ -14,23 +14,24 @@ if __name__ == "__main__":
     WIKINAME = 'astwiki'
     NUMBER_OF_INSTANCES = 50000
 
+    # Configuration of the model compared. Logs of a breadth and depth hold
+    # records of all models run with them, so only the records of this model are read.
+    MODEL_CONFIG = dict(hidden_layer_sizes=[2, 13, 9],
+                        learning_rate_vector=[0.05, 0.5, 0.5],
+                        fanouts=None,
+                        fanout_strategy=None)
+
     BREADTH = 15
     DEPTH = 1
     # results_file = os.path.join(os.getcwd(), 'results', WIKINAME, 'results_breadth_%d_depth_%d.json' % (BREADTH, DEPTH))
-    results_file = os.path.join(os.getcwd(), 'results', WIKINAME,
-                                'results_breadth_%d_depth_%d_instances_%d.json' % (BREADTH, DEPTH, NUMBER_OF_INSTANCES))
-
-    with open(results_file, 'rb') as inp:
-        r1 = Serializable.loads(inp.read())
+    r1 = read_results(results_log_file(WIKINAME, BREADTH, DEPTH, NUMBER_OF_INSTANCES),
+                      breadth=BREADTH, depth=DEPTH, instances=NUMBER_OF_INSTANCES, **MODEL_CONFIG)
 
     BREADTH = 3
     DEPTH = 1
-    results_file = os.path.join(os.getcwd(), 'results', WIKINAME,
-                                'results_breadth_%d_depth_%d_instances_%d.json' % (BREADTH, DEPTH, NUMBER_OF_INSTANCES))
-
     # results_file = os.path.join(os.getcwd(), 'results', WIKINAME, 'results_breadth_%d_depth_%d.json' % (BREADTH, DEPTH))
-    with open(results_file, 'rb') as inp:
-        r2 = Serializable.loads(inp.read())
+    r2 = read_results(results_log_file(WIKINAME, BREADTH, DEPTH, NUMBER_OF_INSTANCES),
+                      breadth=BREADTH, depth=DEPTH, instances=NUMBER_OF_INSTANCES, **MODEL_CONFIG)
     #
     # f1_label1_d1 = r1['f1']['0']
     # f1_label1_d2 = r2['f1']['0']
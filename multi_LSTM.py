@@ -15,12 +15,19 @@ import numpy as np
 
 SEQUENCE_FUNCTIONS = ['none','none','none']
 
+# Strategies to sample children when a depth has a fan-out limit
+FANOUT_STRATEGIES = ['recent', 'uniform', 'delta']
+
+# Position of Delta in the feature vectors built by graph_analysis
+DELTA_FEATURE = 5
+
 class MultiLSTM(Serializable):
     """
     Class to hold the multi layer LSTM model
     """
 
-    def __init__(self,max_depth, hidden_layer_sizes, input_sizes, instance_graph):
+    def __init__(self,max_depth, hidden_layer_sizes, input_sizes, instance_graph, fanouts=None,
+                 fanout_strategy='recent', fanout_seed=0):
         """
 
         :param max_depth: Number of LSTMs to be generated
@@ -29,7 +36,18 @@ class MultiLSTM(Serializable):
         :type hidden_layer_sizes: list
         :param input_sizes: Input size of each LSTM
         :type input_sizes:list
+        :param fanouts: Maximum number of children expanded per depth, None for no limit at a depth
+        :type fanouts: list
+        :param fanout_strategy: One of FANOUT_STRATEGIES, to pick children when over the limit
+        :type fanout_strategy: str
+        :param fanout_seed: Seed of the sampling, combined with the epoch
+        :type fanout_seed: int
         """
+        if fanout_strategy not in FANOUT_STRATEGIES:
+            raise ValueError("Unknown fan-out strategy %r" % fanout_strategy)
+        if fanouts is not None and any(k is not None and k < 1 for k in fanouts):
+            # A depth expanded to no children has no input sequence for its LSTM
+            raise ValueError("Fan-outs must be None or at least 1, got %r" % (fanouts,))
         self.lstm_stack = [lstm.LSTM() for l in range(max_depth)]
         for l in range(max_depth):
             self.lstm_stack[l].initialize(input_sizes[l] + (0 if l== max_depth -1 else hidden_layer_sizes[l + 1]), hidden_layer_sizes[l])
@@ -37,6 +55,24 @@ class MultiLSTM(Serializable):
         self.input_sizes = input_sizes
         self.instance_graph = instance_graph
         self.flow_stack = []
+        self.fanouts = fanouts
+        self.fanout_strategy = fanout_strategy
+        self.fanout_seed = fanout_seed
+        self.set_epoch(0)
+
+    def set_epoch(self, epoch):
+        """
+        Reset the random state used for fan-out sampling to the one of this epoch
+        :param epoch:
+        :type epoch: int
+        """
+        self._fanout_rng = np.random.RandomState(self.fanout_seed + epoch)
+
+    def _fan_out(self, children_sequence, current_depth):
+        if self.fanouts is None or current_depth >= len(self.fanouts):
+            return children_sequence
+        return sample_children(children_sequence, self.fanouts[current_depth], self.fanout_strategy,
+                               self._fanout_rng)
 
     def _get_instance_node(self, link_node):
         instance_node = self.instance_graph.get(link_node[0],None)
@@ -68,6 +104,7 @@ class MultiLSTM(Serializable):
         input_sequence = np.array([])
         children_sequence = instance_node.get_sequence(sequence_function=sequence_function[current_depth],
                                                        help_value=instance_node.get_help_values())
+        children_sequence = self._fan_out(children_sequence, current_depth)
 
 
         # children_sequence = get_sequence(instance_node.get_children(), sequence_function[current_depth])
@@ -92,7 +129,7 @@ class MultiLSTM(Serializable):
         # Perform the forward operation
         _, _, Y, cache = self.lstm_stack[current_depth]._forward(input_sequence)
         instance_node.cache[current_depth] = cache
-        instance_node.children_sequence = children_sequence
+        instance_node.children_sequence[current_depth] = children_sequence
         return softmax(Y)
 
     def calculate_backward_gradients(self, instance_node, derivative, current_depth, max_depth):
@@ -115,7 +152,7 @@ class MultiLSTM(Serializable):
         if current_depth == max_depth:
             return
         counter = 0
-        for item in instance_node.children_sequence:
+        for item in instance_node.children_sequence.get(current_depth, []):
             node_for_item = self._get_instance_node(item.get_link_node())
             if node_for_item.cache.get(current_depth,None) is None:
                 continue
@@ -128,7 +165,7 @@ class MultiLSTM(Serializable):
             self.lstm_stack[current_depth].WLSTM -= learning_rate_vector[current_depth] * instance_node.gradient[current_depth]
         if current_depth == max_depth:
             return
-        for item in instance_node.children_sequence:
+        for item in instance_node.children_sequence.get(current_depth, []):
             node_for_item = self._get_instance_node(item.get_link_node())
             self.update_LSTM_weights(node_for_item, current_depth + 1, max_depth, learning_rate_vector)
 
@@ -144,9 +181,18 @@ class MultiLSTM(Serializable):
 
     def train_model_force_balance(self, training_set, no_of_instances, max_depth, objective_function, learning_rate_vector):
         counter = 0
+        drawn = 0
         if no_of_instances == 0:
             return
+        epoch_length = balanced_epoch_length(training_set, self.hidden_layer_sizes[0])
+        if epoch_length == 0:
+            return
+        self.set_epoch(0)
         for item in get_balanced_training_set(training_set, self.hidden_layer_sizes[0]):
+            # The balanced set is infinite: an epoch is a pass over its largest class
+            if drawn and drawn % epoch_length == 0:
+                self.set_epoch(drawn // epoch_length)
+            drawn += 1
             if item.get_number_of_children() == 0:
                 continue
             target = np.zeros((1, self.hidden_layer_sizes[0]))
@@ -164,6 +210,7 @@ class MultiLSTM(Serializable):
         found = {}
         missed = {}
         misclassified = {}
+        self.set_epoch(0)
         for item in test_set:
             Y = self.forward_instance(item, 0, max_depth)
             if Y is None:
@@ -219,6 +266,36 @@ class MultiLSTM(Serializable):
 
 
 
+def sample_children(sequence, k, strategy, rng):
+    """
+    Keep at most k items of a children sequence, in their original order.
+
+    Strategies:
+        recent: the k items with latest timestamps
+        uniform: k items drawn uniformly without replacement
+        delta: k items drawn without replacement with probability proportional to |Delta|
+
+    :param sequence: List of SequenceItem
+    :param k: Maximum number of items, None for no limit
+    :param strategy: One of FANOUT_STRATEGIES
+    :param rng: np.random.RandomState used for drawing
+    :return: List of SequenceItem
+    """
+    if k is None or len(sequence) <= k:
+        return sequence
+
+    if strategy == 'recent':
+        idx = np.argsort([item.timestamp for item in sequence], kind='mergesort')[-k:]
+    elif strategy == 'uniform':
+        idx = rng.choice(len(sequence), k, replace=False)
+    elif strategy == 'delta':
+        weights = np.array([abs(item.get_feature_vector()[DELTA_FEATURE]) for item in sequence]) + 1e-6
+        idx = rng.choice(len(sequence), k, replace=False, p=weights / weights.sum())
+    else:
+        raise ValueError("Unknown fan-out strategy %r" % strategy)
+
+    return [sequence[i] for i in sorted(idx)]
+
 def softmax(w, t = 1.0):
     e = np.exp(np.array(w) / t)
     dist = e / np.sum(e)
@@ -251,6 +328,21 @@ def get_balanced_training_set(training_set, no_of_classes):
             yield buckets[i][buckets_current_indexes[i]]
             buckets_current_indexes[i] += 1
 
+def balanced_epoch_length(training_set, no_of_classes):
+    """
+    Number of items drawn from get_balanced_training_set in one epoch, so
+    that every item of the training set has been drawn at least once
+
+    :param training_set: List of InstanceNode
+    :param no_of_classes: Number of classes
+    :return: Number of classes with items times the size of the largest class
+    :rtype: int
+    """
+    sizes = [0] * no_of_classes
+    for item in training_set:
+        sizes[item.get_label()] += 1
+    return max(sizes) * len([size for size in sizes if size > 0])
+
 class InstanceNode:
     def __init__(self, label = None, sequence_control=None):
         """
@@ -268,7 +360,7 @@ class InstanceNode:
         self.sequence_list = []
         self.sequence_control = sequence_control # Stores the specific order by which the items were fed into the LSTM to update weights correctly
         self.helper_value = {}
-        self.children_sequence = []
+        self.children_sequence = {} # Sequence fed to the LSTM on last forward, per depth
 
     def get_sequence_size(self):
         return len(self.sequence_list)
@@ -306,26 +398,58 @@ class InstanceNode:
         else:
             return None
 
+# Feature matrices shared by the SequenceItems of a process, by name.
+# A pickled item keeps the name of its matrix instead of a copy of it.
+_SHARED_FEATURE_MATRICES = {}
+
+
+def share_feature_matrix(name, feature_matrix):
+    """
+    Register a feature matrix under a name, so that the SequenceItems
+    referencing it are pickled with the name and unpickled pointing at the
+    matrix registered under that name in the receiving process.
+
+    :param name: Name of the matrix, the same in all processes
+    :type name: str
+    :param feature_matrix: Matrix to register, or None to remove the name
+    :type feature_matrix: np.ndarray
+    """
+    if feature_matrix is None:
+        _SHARED_FEATURE_MATRICES.pop(name, None)
+    else:
+        _SHARED_FEATURE_MATRICES[name] = feature_matrix
+
+
 class SequenceItem:
     """
     Contains the item within a sequence which has a feature vector
     """
 
-    def __init__(self, item_id, link_node_id, feature_vector = None, timestamp = None, action_time=None):
+    def __init__(self, item_id, link_node_id, feature_vector = None, timestamp = None, action_time=None,
+                 feature_matrix=None, feature_row=None):
         """
         Initialize each sequence item with its owner details and
         associate a feature vector with it.
 
+        Instead of its own feature vector, the item can reference a row
+        of a feature matrix shared by all items of the graph.
+
         :param item_id:
         :type item_id:
         :param link_node_id:
         :type link_node_id:
         :param feature_vector:
         :type feature_vector:
+        :param feature_matrix: Shared matrix of features, one row per edge
+        :type feature_matrix: np.ndarray
+        :param feature_row: Row of this item in feature_matrix
+        :type feature_row: int
         """
         self.item_id = item_id
         self.link_node_id = link_node_id
         self.feature_vector = feature_vector
+        self.feature_matrix = feature_matrix
+        self.feature_row = feature_row
         self.action_time = action_time
         self.timestamp = timestamp
 
@@ -333,5 +457,20 @@ class SequenceItem:
         return self.link_node_id, self.action_time
         # return instance_dict.get(self.link_node_id)
 
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        for name, feature_matrix in _SHARED_FEATURE_MATRICES.iteritems():
+            if feature_matrix is self.feature_matrix:
+                state['feature_matrix'] = name
+                state['shared_matrix'] = True
+        return state
+
+    def __setstate__(self, state):
+        if state.pop('shared_matrix', False):
+            state['feature_matrix'] = _SHARED_FEATURE_MATRICES[state['feature_matrix']]
+        self.__dict__.update(state)
+
     def get_feature_vector(self):
+        if self.feature_vector is None and self.feature_matrix is not None:
+            return self.feature_matrix[self.feature_row]
         return self.feature_vector
\ No newline at end of file
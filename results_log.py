@@ -0,0 +1,92 @@
+"""
+Append-only log of experiment results.
+
+Each repetition of an experiment appends one json line with its
+precision, recall and F1 per label (and the seed and configuration it
+ran with). Lines are written with a single write under an exclusive
+lock on a file opened in append mode, so several processes can log to
+the same file.
+
+The per-label lists used by measure_significance are built when the
+log is read, in the same structure as the previous results json:
+
+    {'prec': {label: [...]}, 'rec': {label: [...]}, 'f1': {label: [...]}, 'avg_rec': [...]}
+"""
+import fcntl
+import json
+import os
+
+
+def results_log_file(wikiname, breadth, depth, instances):
+    """
+    Log file for a configuration, in the results directory of the wiki.
+    The log of a breadth, depth and number of instances holds the records
+    of every model run with them: readers select a model by passing its
+    configuration to read_records/read_results.
+    """
+    return os.path.join(os.getcwd(), 'results', wikiname,
+                        'results_breadth_%d_depth_%d_instances_%d.jsonl' % (breadth, depth, instances))
+
+
+def append_result(log_file, record):
+    """
+    Append one record as a json line.
+
+    :param log_file: Path of log
+    :param record: Json serializable dict
+    """
+    line = json.dumps(record, sort_keys=True) + '\n'
+    fd = os.open(log_file, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0644)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        os.write(fd, line)
+    finally:
+        # Closing releases the lock
+        os.close(fd)
+
+
+def read_records(log_file, **config):
+    """
+    Records of the log in the order they were written.
+    A line that does not decode (eg. from a process killed while writing) is skipped.
+
+    :param log_file: Path of log
+    :param config: Only return records with these configuration values
+    :rtype: list
+    """
+    records = []
+    if not os.path.isfile(log_file):
+        return records
+
+    # Same representation as values read back from json (eg. tuples become lists)
+    config = json.loads(json.dumps(config))
+
+    with open(log_file, 'rb') as inp:
+        for line in inp:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue
+            if all(record.get(k) == v for k, v in config.iteritems()):
+                records.append(record)
+    return records
+
+
+def read_results(log_file, **config):
+    """
+    Aggregate the records of a log into lists per measure and label
+
+    :param log_file: Path of log
+    :param config: Only use records with these configuration values
+    :return: Dict in structure {'prec': {label: [...]}, 'rec': {...}, 'f1': {...}, 'avg_rec': [...]}
+    :rtype: dict
+    """
+    results = {'prec': {}, 'rec': {}, 'f1': {}, 'avg_rec': []}
+
+    for record in read_records(log_file, **config):
+        for keyname in ['prec', 'rec', 'f1']:
+            for label, value in record[keyname].iteritems():
+                results[keyname].setdefault(label, []).append(value)
+        results['avg_rec'].append(record['avg_rec'])
+
+    return results
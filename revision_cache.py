@@ -0,0 +1,151 @@
+"""
+Cache of revisions fetched from Wikipedia, keyed by (pageid, revid).
+
+Revisions do not change once made, so a revision fetched with its
+content can be reused by every later lookup of it. The cache has two
+tiers:
+
+    - a bounded in-memory LRU of revision dicts,
+    - an optional on-disk SQLite store of zlib compressed json, which
+      keeps every revision seen across runs.
+
+A lookup is counted as a hit (memory), a disk hit or a miss. The cache
+is shared by the threads of the concurrent crawler, so all operations
+take a lock.
+
+wikipedia.set_revision_cache puts a cache in front of
+WikiFetch.fetch_revisions_for_page.
+"""
+import collections
+import json
+import os
+import sqlite3
+import threading
+import zlib
+
+DEFAULT_MAX_ITEMS = 10000
+DEFAULT_COMMIT_EVERY = 100
+
+
+class RevisionCache(object):
+    """
+    In-memory LRU of revisions backed by a compressed SQLite store.
+    """
+
+    def __init__(self, db_file=None, max_items=DEFAULT_MAX_ITEMS, commit_every=DEFAULT_COMMIT_EVERY):
+        """
+
+        :param db_file: Path of the SQLite store, None to keep revisions in memory only
+        :param max_items: Number of revisions held in memory
+        :param commit_every: Number of revisions written that triggers a commit of the store
+        """
+        self.db_file = db_file
+        self.max_items = max_items
+        self.commit_every = commit_every
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+        self._items = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self._uncommitted = 0
+        self._conn = None
+
+        if db_file is not None:
+            folder = os.path.dirname(db_file)
+            if folder and not os.path.isdir(folder):
+                os.makedirs(folder)
+            self._conn = sqlite3.connect(db_file, check_same_thread=False)
+            self._conn.execute('CREATE TABLE IF NOT EXISTS revisions '
+                               '(pageid INTEGER, revid INTEGER, data BLOB, PRIMARY KEY (pageid, revid));')
+            self._conn.commit()
+
+    @staticmethod
+    def _key(pageid, revid):
+        """
+        Key of a revision, None if the ids are not integers
+        """
+        try:
+            return int(pageid), int(revid)
+        except (TypeError, ValueError):
+            return None
+
+    def _remember(self, key, revision):
+        # Add to the in-memory tier as most recently used, evicting the least recently used
+        self._items.pop(key, None)
+        self._items[key] = revision
+        if len(self._items) > self.max_items:
+            self._items.popitem(last=False)
+
+    def get(self, pageid, revid):
+        """
+        Cached revision, None if it is not in the cache
+
+        :param pageid: Wikipedia pageid
+        :param revid: Revision ID
+        :rtype: dict
+        """
+        key = self._key(pageid, revid)
+        if key is None:
+            return None
+
+        with self._lock:
+            revision = self._items.get(key)
+            if revision is not None:
+                self._remember(key, revision)
+                self.hits += 1
+                return revision
+
+            if self._conn is not None:
+                row = self._conn.execute('SELECT data FROM revisions WHERE pageid = ? AND revid = ?;',
+                                         key).fetchone()
+                if row is not None:
+                    revision = json.loads(zlib.decompress(row[0]))
+                    self._remember(key, revision)
+                    self.disk_hits += 1
+                    return revision
+
+            self.misses += 1
+            return None
+
+    def put(self, pageid, revision):
+        """
+        Add a revision, as returned by the API, to the cache
+
+        :param pageid: Wikipedia pageid
+        :param revision: Revision dict, with its revid
+        """
+        key = self._key(pageid, revision.get('revid'))
+        if key is None:
+            return
+
+        with self._lock:
+            known = key in self._items
+            self._remember(key, revision)
+            if known or self._conn is None:
+                return
+            self._conn.execute('INSERT OR IGNORE INTO revisions (pageid, revid, data) VALUES (?, ?, ?);',
+                               key + (sqlite3.Binary(zlib.compress(json.dumps(revision))),))
+            self._uncommitted += 1
+            if self._uncommitted >= self.commit_every:
+                self._conn.commit()
+                self._uncommitted = 0
+
+    def flush(self):
+        """
+        Commit the revisions written to the store. To be called at exit.
+        """
+        with self._lock:
+            if self._conn is not None and self._uncommitted:
+                self._conn.commit()
+                self._uncommitted = 0
+
+    def stats(self):
+        """
+        Counters of lookups
+
+        :return: Dict of hits, disk_hits, misses and number of revisions in memory
+        :rtype: dict
+        """
+        with self._lock:
+            return dict(hits=self.hits, disk_hits=self.disk_hits, misses=self.misses, in_memory=len(self._items))
@@ -0,0 +1,162 @@
+"""
+Manifest of the stats files already ingested into user_graph.json.
+
+The manifest is a json dict of
+
+    {'graph': {'size': ..., 'mtime': ..., 'sha1': ...},
+     'files': {path: {'size': ..., 'mtime': ..., 'sha1': ..., 'lines': ..., 'lines_sha1': ...}}}
+
+'graph' describes the graph file as written by the last update. A graph
+file which does not match it (or a missing manifest) holds edges the
+manifest does not account for, so the graph is rebuilt from all files
+(see covers_graph).
+
+A file is new or changed if it is not in the manifest, or if its size
+or mtime differ and its content hash differs too (a file only touched
+keeps its entry).
+
+'lines' is the number of decompressed lines of the file already merged
+into the graph and 'lines_sha1' their hash. When a changed file still
+starts with these lines, only the lines after them are ingested (see
+new_lines), so judgements are not merged twice.
+"""
+import hashlib
+import json
+import os
+
+from graph_cache import file_digest
+
+
+def empty_manifest():
+    """
+    Manifest of a graph with no files ingested
+    """
+    return {'graph': None, 'files': {}}
+
+
+def load_manifest(manifest_file):
+    """
+    Manifest of ingested files, empty if there is none or if it is
+    in the earlier format of only the files' entries
+
+    :param manifest_file: Path of manifest json
+    :rtype: dict
+    """
+    manifest = None
+    if os.path.isfile(manifest_file):
+        with open(manifest_file, 'rb') as inp:
+            manifest = json.load(inp)
+    if manifest is None or 'files' not in manifest:
+        return empty_manifest()
+    return manifest
+
+
+def save_manifest(manifest_file, manifest):
+    """
+    Write the manifest through a temporary file
+    """
+    with open(manifest_file + '.tmp', 'wb') as outp:
+        json.dump(manifest, outp, indent=2, sort_keys=True)
+    os.rename(manifest_file + '.tmp', manifest_file)
+
+
+def file_entry(filename, sha1=None):
+    """
+    Manifest entry of a file
+
+    :param filename: Path of file
+    :param sha1: Content hash if already known
+    :rtype: dict
+    """
+    st = os.stat(filename)
+    return {'size': st.st_size, 'mtime': st.st_mtime, 'sha1': sha1 or file_digest(filename)}
+
+
+def _check_entry(filename, entry):
+    """
+    Compare a file to its entry. The entry is refreshed if only the
+    file's size or mtime changed.
+
+    :return: None if the content is unchanged, otherwise the new entry of the file
+    :rtype: dict
+    """
+    st = os.stat(filename)
+    if entry is not None and entry['size'] == st.st_size and entry['mtime'] == st.st_mtime:
+        return None
+
+    new_entry = file_entry(filename)
+    if entry is not None and entry['sha1'] == new_entry['sha1']:
+        entry.update(new_entry)
+        return None
+    return new_entry
+
+
+def covers_graph(manifest, graph_file):
+    """
+    Whether the graph file is the one written with the manifest, so that
+    the files recorded in the manifest are exactly those merged into it
+
+    :param manifest: Manifest from load_manifest, its graph entry refreshed if only touched
+    :param graph_file: Path of user_graph.json
+    :rtype: bool
+    """
+    entry = manifest['graph']
+    if not os.path.isfile(graph_file):
+        return entry is None and not manifest['files']
+    return entry is not None and _check_entry(graph_file, entry) is None
+
+
+def changed_files(filenames, manifest):
+    """
+    Files which are new or whose content changed since they were recorded.
+    Entries of files found unchanged are refreshed in the manifest.
+
+    :param filenames: Paths of stats files
+    :param manifest: Manifest from load_manifest, updated in place
+    :return: List of (filename, entry) for the files to ingest
+    :rtype: list
+    """
+    changed = []
+    for filename in filenames:
+        new_entry = _check_entry(filename, manifest['files'].get(filename))
+        if new_entry is not None:
+            changed.append((filename, new_entry))
+    return changed
+
+
+def new_lines(read_lines, entry, record):
+    """
+    Lines of a file not ingested before, as recorded in its manifest entry.
+
+    The lines counted in the entry are skipped if the file still starts
+    with them. Otherwise the file was rewritten and all its lines are
+    returned again; the judgements ingested from it before stay in the graph.
+
+    :param read_lines: Function returning an iterator over the lines of the file
+    :param entry: Manifest entry of the file, None if it is new
+    :param record: Dict given the 'lines' and 'lines_sha1' of the whole file once all its lines are read
+    :rtype: iterator
+    """
+    ingested = entry.get('lines', 0) if entry is not None else 0
+    digest = hashlib.sha1()
+    count = 0
+    lines = read_lines()
+
+    if ingested:
+        for line in lines:
+            digest.update(line + '\n')
+            count += 1
+            if count == ingested:
+                break
+        if count < ingested or digest.hexdigest() != entry.get('lines_sha1'):
+            print "Lines ingested before have changed, reading all lines again"
+            digest = hashlib.sha1()
+            count = 0
+            lines = read_lines()
+
+    for line in lines:
+        digest.update(line + '\n')
+        count += 1
+        yield line
+
+    record.update(lines=count, lines_sha1=digest.hexdigest())
@@ -0,0 +1,147 @@
+"""
+Hyperparameter sweep over the MLSL experiment of graph_analysis.
+
+A grid gives lists of values for breadth, depth, hidden_layer_sizes,
+learning_rate_vector and optionally fanouts and fanout_strategy.
+Configurations are grouped by breadth, since the instance graph
+only depends on the breadth (limiter): each graph is
+built (or loaded from the instance cache) once, and all trainings on it
+are dispatched to a bounded pool of processes that share it through fork.
+
+Results are appended to the usual per-configuration results log
+(see results_log). A configuration with enough repetitions already in
+its log is skipped, so an interrupted sweep can be run again.
+"""
+import itertools
+import multiprocessing
+import os
+import random
+
+from graph_analysis import WIKINAME, get_instance_graph, run_repetition
+from graph_cache import file_digest
+from results_log import append_result, read_records, results_log_file
+
+GRID_KEYS = ['breadth', 'depth', 'hidden_layer_sizes', 'learning_rate_vector', 'fanouts', 'fanout_strategy']
+
+# Values used for keys missing from a grid
+GRID_DEFAULTS = {'fanouts': [None], 'fanout_strategy': ['recent']}
+
+# Keys holding one value per depth level
+PER_DEPTH_KEYS = ['hidden_layer_sizes', 'learning_rate_vector', 'fanouts']
+
+INPUT_SIZE = 8
+
+
+def expand_grid(grid):
+    """
+    All configurations of a grid, skipping those whose hidden layer sizes
+    or learning rates do not cover the depth.
+
+    Per depth values are cut to the depth, since the levels past it are
+    not used, and configurations that are then the same are kept once.
+
+    :param grid: Dict of {key: list of values} for keys in GRID_KEYS
+    :return: List of configuration dicts
+    :rtype: list
+    """
+    configs = []
+    for values in itertools.product(*[grid.get(k, GRID_DEFAULTS.get(k)) for k in GRID_KEYS]):
+        config = dict(zip(GRID_KEYS, values))
+        if len(config['hidden_layer_sizes']) < config['depth'] or len(config['learning_rate_vector']) < config['depth']:
+            print "Skipping configuration %r: sizes do not cover depth" % (config,)
+            continue
+        for k in PER_DEPTH_KEYS:
+            if config[k] is not None:
+                config[k] = list(config[k][:config['depth']])
+        if config not in configs:
+            configs.append(config)
+    return configs
+
+
+# Read-only state shared with training processes through fork
+_SWEEP_STATE = {}
+
+
+def _run_task(task):
+    """
+    Worker of run_sweep. Trains and tests one repetition of a configuration
+    on the shared instance graph, and appends the record to its log.
+    """
+    config, seed, log_file = task
+    record = run_repetition(_SWEEP_STATE['instance_graph'], seed,
+                            depth=config['depth'],
+                            hidden_layer_sizes=config['hidden_layer_sizes'],
+                            input_sizes=[INPUT_SIZE] * config['depth'],
+                            learning_rate_vector=config['learning_rate_vector'],
+                            number_of_instances=config['instances'],
+                            objective_function=_SWEEP_STATE['objective_function'],
+                            fanouts=config['fanouts'],
+                            fanout_strategy=config['fanout_strategy'])
+    if record is not None:
+        record.update(config)
+        append_result(log_file, record)
+    return config, record
+
+
+def run_sweep(grid, wikiname=WIKINAME, repetitions=1, number_of_instances=50000, processes=None,
+              objective_function="softmax_classification"):
+    """
+    Run every configuration of the grid for the given number of repetitions.
+
+    :param grid: Dict of {key: list of values} for keys in GRID_KEYS
+    :param wikiname: Wiki under results directory
+    :param repetitions: Repetitions wanted per configuration
+    :param number_of_instances: Training instances per repetition
+    :param processes: Size of the worker pool. Default is the number of CPUs
+    :param objective_function: Objective function of MultiLSTM training
+    :return: Number of repetitions run
+    :rtype: int
+    """
+    graph_file = os.path.join(os.getcwd(), 'results', wikiname, 'reduced_user_graph.json')
+    cache_dir = os.path.join(os.getcwd(), 'results', wikiname, 'instance_cache')
+    processes = processes or multiprocessing.cpu_count()
+    rng = random.SystemRandom()
+
+    # Group the remaining work by breadth
+    groups = {}
+    for config in expand_grid(grid):
+        config['instances'] = number_of_instances
+        log_file = results_log_file(wikiname, config['breadth'], config['depth'], number_of_instances)
+        done = len(read_records(log_file, **config))
+        if done >= repetitions:
+            print "Skipping configuration %r: %d repetitions in log" % (config, done)
+            continue
+        groups.setdefault(config['breadth'], []).extend(
+            (config, rng.randint(0, 2 ** 31 - 1), log_file) for _ in range(repetitions - done))
+
+    graph_digest = file_digest(graph_file) if groups else None
+    wikidata = None
+    total = 0
+
+    for breadth in sorted(groups.keys()):
+        tasks = groups[breadth]
+        instance_graph, _, wikidata = get_instance_graph(graph_file, breadth, cache_dir,
+                                                         graph_digest=graph_digest, wikidata=wikidata)
+
+        _SWEEP_STATE.update(instance_graph=instance_graph, objective_function=objective_function)
+        pool = multiprocessing.Pool(min(processes, len(tasks)))
+        try:
+            for config, record in pool.imap_unordered(_run_task, tasks):
+                total += 1
+                if record is not None:
+                    print "Done %r: F1 %r" % (config, record['f1'])
+        finally:
+            pool.close()
+            pool.join()
+            _SWEEP_STATE.clear()
+
+    return total
+
+
+if __name__ == "__main__":
+    GRID = dict(breadth=[1, 3, 15],
+                depth=[1, 2, 3],
+                hidden_layer_sizes=[[2, 13, 9], [2, 8, 8]],
+                learning_rate_vector=[[0.05, 0.5, 0.5]])
+
+    run_sweep(GRID, repetitions=10)
@@ -1,7 +1,16 @@
+import atexit
+import io
+import itertools
 import json
+import multiprocessing
 import os
 import gzip
 import random
+import shutil
+import sys
+import tempfile
+import time
+import unittest
 import uuid
 from pprint import pprint
 from json_plus import Serializable
@@ -13,17 +22,51 @@ import numpy as np
 import re
 
 from db import DataAccess
+from edge_store import EdgeStore
+import stats_manifest
 
 WIKINAME = 'rmywiki'
 USER_INDEX = os.path.join(os.getcwd(), 'results', WIKINAME, 'user_index.json')
+EDGE_STORE_DIR = os.path.join(os.getcwd(), 'results', WIKINAME, 'edge_store')
 
 FILE_MODE = False
+
+# Parse stats files with a pool of processes in get_user_dict_parallel
+PARALLEL_INGESTION = True
+
+# Only ingest stats files not in the manifest, and merge them into the existing user_graph.json
+INCREMENTAL_INGESTION = True
+
+# Buffer size for reading decompressed stats files
+STATS_BUFFER_SIZE = 1 << 20
+
+# Rows per call of DataAccess.insert_graph_edges in add_to_graph
+BULK_INSERT_SIZE = 5000
+
+# Lines parsed at a time into columns by parse_edit_lines
+PARSE_CHUNK_SIZE = 10000
+
+# Typed fields of an EditInc line
+EDIT_INT_FIELDS = ['PageId', 'uid0', 'uid1', 'uid2', 't12', 't01', 'rev0', 'rev1', 'rev2', 'n01', 'n12']
+EDIT_FLOAT_FIELDS = ['d01', 'd12', 'd02', 'dp2', 'Delta']
+EDIT_NAME_FIELDS = ['uname0', 'uname1', 'uname2']
+EDIT_FIELDS = ['timestamp'] + EDIT_INT_FIELDS + EDIT_FLOAT_FIELDS + EDIT_NAME_FIELDS
+
+# Fields of an EditInc line in the order WikiTrust writes them
+EDIT_LINE_FIELDS = ['timestamp', 'PageId', 'Delta', 'rev0', 'uid0', 'uname0', 'rev1', 'uid1', 'uname1',
+                    'rev2', 'uid2', 'uname2', 'd01', 'd02', 'd12', 'dp2', 'n01', 'n12', 't01', 't12']
+_EDIT_LINE = re.compile(r'EditInc\|([^|]*)' + ''.join(r'\|%s:([^|:]*)' % f for f in EDIT_LINE_FIELDS[1:]) + '$')
 # user_graph = {}
 global NONECTR
 NONECTR = 0
 
+# Edge store of the run, created on first use by _get_edge_store
+_EDGE_STORE = None
+# User index of the run, created on first use by _get_user_index
+_USER_INDEX_OBJ = None
 
-def add_to_graph(file_content):  # , user_graph, user_contribs):
+
+def add_to_graph(file_content, db):  # , user_graph, user_contribs):
     """
 
     From WikiTrust:
@@ -52,8 +95,10 @@ def add_to_graph(file_content):  # , user_graph, user_contribs):
             t01: 3429205 ;; The elapsed time between rev0 and rev1.
             t12: 1543097 ;; The elapsed time between rev1 and rev2.
 
-    :param file_content:
-    :type file_content: str
+    :param file_content: Content of a stats file, or an iterable of its lines
+    :type file_content: str | iterable
+    :param db: DataAccess to insert into, kept open across files by the caller
+    :type db: DataAccess
     :return:
     :rtype:
     """
@@ -61,86 +106,92 @@ def add_to_graph(file_content):  # , user_graph, user_contribs):
     # pprint(user_graph)
     # print "\n-------------\n"
     global NONECTR
-    db = DataAccess()
-    lines = file_content.splitlines()
+    lines = file_content.splitlines() if isinstance(file_content, basestring) else file_content
+    names = UserNames()
+    inserted = 0
 
-    for line in lines:
-        # pattern = "EditInc (?P<time>\d+) PageId: (?P<pageid>\d+) Delta: (?P<delta_char>\d+).(?P<delta_mant>\d+) rev0: (?P<rev0>\d+) uid0: (?P<uid0>\d+) uname0: (?P<uname0>\S+) rev1: (?P<rev1>\d+) uid1: (?P<uid1>\d+) uname1: (?P<uname1>\S+) rev2: (?P<rev2>\d+) uid2: (?P<uid2>\d+) uname2: (?P<uname2>\S+) d01: (?P<d01_char>\d+).(?P<d01_mant>\d+) d02: (?P<d02_char>\d+).(?P<d02_mant>\d+) d12: (?P<d12_char>\d+).(?P<d12_mant>\d+) dp2: (?P<dp2_char>\d+).(?P<dp2_mant>\d+) n01: (?P<n01>\d+) n12: (?P<n12>\d+) t01: (?P<t01_char>\d+).(?P<t01_mant>\d+) t12: (?P<t12_char>\d+).(?P<t12_mant>\d+)"
-        #
-        # pattern = """EditInc(\s*)(?P<time>\d+)(\s*)PageId:(\s*)(?P<pageid>\d+)(\s*)Delta:(\s*)(?P<delta_char>\d+).(?P<delta_mant>\d+)(\s*)rev0:(\s*)(?P<rev0>\d+)(\s*)uid0:(\s*)(?P<uid0>\d+)(\s*)uname0:(\s*)"(?P<uname0>\S+)"(\s*)rev1:(\s*)(?P<rev1>\d+)(\s*)uid1:(\s*)(?P<uid1>\d+)(\s*)uname1:(\s*)"(?P<uname1>\S+)"(\s*)rev2:(\s*)(?P<rev2>\d+)(\s*)uid2:(\s*)(?P<uid2>\d+)(\s*)uname2:(\s*)"(?P<uname2>\S+)"(\s*)d01:(\s*)(?P<d01_char>\d+).(?P<d01_mant>\d+)(\s*)d02:(\s*)(?P<d02_char>\d+).(?P<d02_mant>\d+)(\s*)d12:(\s*)(?P<d12_char>\d+).(?P<d12_mant>\d+)(\s*)dp2:(\s*)(?P<dp2_char>\d+).(?P<dp2_mant>\d+)(\s*)n01:(\s*)(?P<n01>\d+)(\s*)n12:(\s*)(?P<n12>\d+)(\s*)t01:(\s*)(?P<t01_char>\d+).(?P<t01_mant>\d+)(\s*)t12:(\s*)(?P<t12_char>\d+).(?P<t12_mant>\d+)"""
-        # m = re.search(pattern=pattern, string=line)
-        #
+    for chunk in _chunked(lines, BULK_INSERT_SIZE):
+        columns, skipped = parse_edit_lines(chunk, names)
+        NONECTR += skipped
 
-        line_broken = line.split('|')
-        if line_broken[0] == "EditInc":
-            line_dict = {i.split(':')[0]: i.split(':')[1] for i in line_broken[2:]}
-            line_dict['timestamp'] = line_broken[1]
+        # Add entries to DB, one batch per chunk
+        inserted += db.insert_graph_edges(_named_columns(columns, names))
+
+    # All the batches of the file are committed together
+    db.ug_db.commit()
+    print "Edges inserted into DB: %d" % (inserted)
 
-            # Add entry to DB
-            entry_id = db.graph_edge.insert(**line_dict)
-            db.ug_db.commit()
-
-            if np.random.randn() > 0.99:
-                print "Entry ID for DB: %r" % (entry_id)
-
-                # keys_to_remove =['uid0','uid1','uid2','rev0','rev1','rev2','uname1','uname2']
-                #
-                # node_dict = line_dict.copy()
-                # for key in keys_to_remove:
-                #     node_dict.pop(key)
-                #
-                # u0 = line_dict['uname0']
-                # u1 = line_dict['uname1']
-                # u2 = line_dict['uname2']
-                #
-                # if not user_graph.has_key(u1):
-                #     user_graph[u1] = {}
-                #
-                # if not user_graph[u1].has_key(u2):
-                #     user_graph[u1][u2] = []
-                #
-                # user_graph[u1][u2].append(node_dict)
-                #
-                # # User contribution record
-                #
-                # if not user_contribs.has_key(u1):
-                #     user_contribs[u1] = []
-                #
-                # user_contribs[u1].append(line_dict)
 
+class UserIndex(object):
+    """
+    Index of {user: file name} held in memory for a whole run.
+
+    The index file is read once. A new user is given its uuid5 name on first
+    lookup, and the index is written (to a temporary file renamed into place)
+    once flush_every new users have been added, and at exit.
+    """
+
+    def __init__(self, filename=USER_INDEX, flush_every=1000):
+        """
 
+        :param filename: Path of the index json
+        :param flush_every: Number of new users that triggers a write of the index
+        """
+        self.filename = filename
+        self.flush_every = flush_every
+        self.added = 0
+
+        if os.path.isfile(filename):
+            with open(filename, 'rb') as inp:
+                self.index_of_users = json.load(inp)
         else:
-            # print "Reached into None"
-            # print line
-            # print "\n\n"
-            if "EditInc" in line:
-                print line
-            NONECTR += 1
+            self.index_of_users = {}
+
+    def get(self, user):
+        """
+        Index entry of user, assigned if the user is new
+        """
+        entry = self.index_of_users.get(user)
+        if entry is None:
+            entry = self.add(user)
+        return entry
 
+    def add(self, user):
+        # Names read back from json are unicode, uuid5 needs the bytes
+        name = user.encode('utf-8') if isinstance(user, unicode) else user
+        entry = self.index_of_users[user] = str(uuid.uuid5(uuid.NAMESPACE_OID, name))
 
-def _get_index_entry(user):
-    if os.path.isfile(USER_INDEX):
-        with open(USER_INDEX, 'rb') as inp:
-            index_of_users = json.load(inp)
-    else:
-        index_of_users = {}
+        self.added += 1
+        if self.added >= self.flush_every:
+            self.flush()
+        return entry
 
-    return index_of_users.get(user, _set_into_index(user))
+    def flush(self):
+        """
+        Write the index if users were added since the last write
+        """
+        if not self.added:
+            return
+        with open(self.filename + '.tmp', 'wb') as outp:
+            json.dump(self.index_of_users, outp)
+        os.rename(self.filename + '.tmp', self.filename)
+        self.added = 0
 
 
-def _set_into_index(user):
-    if os.path.isfile(USER_INDEX):
-        with open(USER_INDEX, 'rb') as inp:
-            index_of_users = json.load(inp)
-    else:
-        index_of_users = {}
+def _get_user_index():
+    global _USER_INDEX_OBJ
+    if _USER_INDEX_OBJ is None:
+        _USER_INDEX_OBJ = UserIndex(USER_INDEX)
+        atexit.register(_USER_INDEX_OBJ.flush)
+    return _USER_INDEX_OBJ
 
-    index_of_users[user] = str(uuid.uuid5(uuid.NAMESPACE_OID, user))
 
-    with open(USER_INDEX, 'wb') as outp:
-        json.dump(index_of_users, outp)
+def _get_index_entry(user):
+    return _get_user_index().get(user)
 
-    return index_of_users.get(user)
+
+def _set_into_index(user):
+    return _get_user_index().add(user)
 
 
 def _get_file_name(user, suffix='dict'):
@@ -150,61 +201,92 @@ def _get_file_name(user, suffix='dict'):
     return os.path.join(os.getcwd(), 'results', WIKINAME, user_file)
 
 
-def _get_dict_for_user(user):
+def _read_user_file(user):
+    """
+    Revision entries of user from the user's own file, empty if there is no file
     """
-    Get the file containing revision entries for the user "user"
-    If the file is present, load its json which is effectively a dict
+    filename = _get_file_name(user)
+    if os.path.isfile(filename):
+        with open(filename, 'rb') as inp:
+            user_dict = Serializable.loads(json.load(inp))
+    else:
+        user_dict = {user: {}}
+    return user_dict[user]
 
-    Otherwise create the file
-    :param user:
-    :type user:
-    :return:
-    :rtype:
+
+def _write_user_file(user, dict_for_user):
     """
-    if FILE_MODE:
-        filename = _get_file_name(user)
-        if os.path.isfile(filename):
-            with open(filename, 'rb') as inp:
-                user_dict = Serializable.loads(json.load(inp))
-        else:
-            user_dict = {user: {}}
+    Write revision entries of user into the user's own file, through a temporary file
+    """
+    dict_to_dump = {user: dict_for_user}
 
+    filename = _get_file_name(user)
+    with open(filename + '.tmp', 'wb') as outp:
+        json.dump(Serializable.dumps(dict_to_dump), outp)
+    os.rename(filename + '.tmp', filename)
 
-    else:
-        filename = os.path.join(os.getcwd(),'results',WIKINAME,'user_graph.json')
-        with open(filename, 'rb') as inp:
-            user_dict = Serializable.loads(json.load(inp))
 
-        if not user_dict.has_key(user):
-            user_dict[user] = {}
+def _get_edge_store():
+    global _EDGE_STORE
+    if _EDGE_STORE is None:
+        _EDGE_STORE = EdgeStore(EDGE_STORE_DIR)
+    return _EDGE_STORE
 
-    return user_dict[user]
 
+def _fold_edge(user_dict, rev, full_dict):
+    """
+    Add an edge read from the edge store to the revision entries of its user,
+    as _update_edge used to do one edge at a time
+    """
+    # Same key as the revision gets once written as json
+    rev_key = unicode(rev)
+    if not user_dict.has_key(rev_key):
+        user_dict[rev_key] = {}
+        user_dict[rev_key]['timestamp'] = int(full_dict['timestamp']) - int(full_dict['t12'])
+        user_dict[rev_key]['list'] = []
+
+    user_dict[rev_key]['list'].append(full_dict)
 
-def _update_dict_for_user(user, dict_for_user):
+
+def compact_edge_store(store=None):
     """
-    Write the dict into user's specific file
-    :param user:
-    :type user:
-    :return:
-    :rtype:
+    Fold the edges appended to the edge store into the users' own files.
+
+    One shard is compacted at a time: its edges are added to the entries
+    already in the files of its users, each user's file is written once
+    and the shard log is removed, so memory use is bounded by a shard.
+
+    Only for FILE_MODE. Folding the edges into the single user_graph.json
+    would hold the whole graph in memory; that graph is built in memory by
+    get_user_dict, get_user_dict_parallel or update_user_graph instead.
+
+    :param store: Edge store, the one of this run by default
+    :type store: EdgeStore
+    :return: Number of users written
+    :rtype: int
     """
-    if FILE_MODE:
-        dict_to_dump = {user: dict_for_user}
+    if not FILE_MODE:
+        raise ValueError("The edge store is compacted into user files only in FILE_MODE, "
+                         "build user_graph.json with get_user_dict or update_user_graph")
 
-        filename = _get_file_name(user)
-        with open(filename, 'wb') as outp:
-            json.dump(Serializable.dumps(dict_to_dump), outp)
+    store = store or _get_edge_store()
+    store.flush()
 
-    else:
-        filename = os.path.join(os.getcwd(), 'results', WIKINAME, 'user_graph.json')
-        with open(filename, 'rb') as inp:
-            user_dict = Serializable.loads(json.load(inp))
+    written = 0
+    for shard in store.shards_with_edges():
+        shard_users = {}
+        for user, rev, full_dict in store.read_shard(shard):
+            if not shard_users.has_key(user):
+                shard_users[user] = _read_user_file(user)
+            _fold_edge(shard_users[user], rev, full_dict)
 
-        user_dict[user] = dict_for_user
+        for user, user_dict in shard_users.iteritems():
+            _write_user_file(user, user_dict)
+        store.clear_shard(shard)
+        written += len(shard_users)
 
-        with open(filename, 'wb') as outp:
-            json.dump(Serializable.dumps(user_dict),outp)
+    _get_user_index().flush()
+    return written
 
 
 def _cleanup_user_list(entry):
@@ -234,6 +316,89 @@ def _cleanup_user_list(entry):
     return entry
 
 
+class RevisionEntry(dict):
+    """
+    Entry {'timestamp': ..., 'list': [...]} of a revision in the in-memory graph,
+    which also keeps the least n01 and n12 of the judgements added to it.
+
+    With the minima, adding a judgement as _add_judgement does gives the same list
+    as appending it and calling _cleanup_user_list, without scanning the list.
+    The minima are attributes, so the entry is written as a plain dict.
+    """
+    __slots__ = ('n01_min', 'n12_min')
+
+    def __reduce__(self):
+        # Pickled with the minima
+        return _restore_revision_entry, (dict(self), self.n01_min, self.n12_min)
+
+
+def _restore_revision_entry(values, n01_min, n12_min):
+    entry = RevisionEntry(values)
+    entry.n01_min, entry.n12_min = n01_min, n12_min
+    return entry
+
+
+def _add_judgement(revisions, rev, full_dict):
+    """
+    Add a judgement to the entry of rev, keeping the least n01 and n12
+    combination as _cleanup_user_list does (see _fold_judgements).
+
+    :param revisions: Revisions of a user in the graph, with an entry for rev
+    :param rev: Judged revision
+    :param full_dict: Judgement
+    """
+    _fold_judgements(revisions, rev, [full_dict['n01']], [full_dict['n12']], lambda i: full_dict)
+
+
+def _fold_judgements(revisions, rev, n01, n12, judgement):
+    """
+    Add judgements to the entry of rev in order, with the same result as
+    appending each one and calling _cleanup_user_list.
+
+    The list of an entry only holds more than one judgement when none of them
+    has both the least n01 and the least n12. So a new judgement replaces the
+    list if it is at most both minima, a single judgement is kept if it is at
+    most both values of the new one, and otherwise the new one is appended.
+    A judgement is only built, by judgement(i), when it enters the list.
+
+    :param revisions: Revisions of a user in the graph, with an entry for rev
+    :param rev: Judged revision
+    :param n01: n01 of each judgement
+    :param n12: n12 of each judgement
+    :param judgement: Function of the position of a judgement returning its dict
+    """
+    entry = revisions[rev]
+    first = 0
+    if not isinstance(entry, RevisionEntry):
+        # Entry from elsewhere (eg. loaded from json): clean up once and start keeping minima
+        entry['list'].append(judgement(0))
+        entry = revisions[rev] = RevisionEntry(entry, list=_cleanup_user_list(entry['list']))
+        entry.n01_min = min(i['n01'] for i in entry['list'])
+        entry.n12_min = min(i['n12'] for i in entry['list'])
+        first = 1
+
+    judgements = entry['list']
+    n01_min, n12_min = (entry.n01_min, entry.n12_min) if judgements else (None, None)
+
+    for i in xrange(first, len(n01)):
+        a, b = n01[i], n12[i]
+        if not judgements:
+            judgements = [judgement(i)]
+            n01_min, n12_min = a, b
+            continue
+
+        if len(judgements) == 1 and n01_min <= a and n12_min <= b:
+            pass
+        elif a <= n01_min and b <= n12_min:
+            judgements = [judgement(i)]
+        else:
+            judgements.append(judgement(i))
+        n01_min, n12_min = min(n01_min, a), min(n12_min, b)
+
+    entry['list'] = judgements
+    entry.n01_min, entry.n12_min = n01_min, n12_min
+
+
 def _update_edge(user, rev, full_dict, user_graph=None):
     """
     Update the dictionary for user witha list to the revisions rev.
@@ -257,27 +422,15 @@ def _update_edge(user, rev, full_dict, user_graph=None):
             user_graph[user] = {}
 
         if not user_graph[user].has_key(rev):
-            user_graph[user][rev] = {}
+            user_graph[user][rev] = RevisionEntry()
             user_graph[user][rev]['timestamp'] = int(full_dict['timestamp']) - int(full_dict['t12'])
             user_graph[user][rev]['list'] = []
-        user_graph[user][rev]['list'].append(full_dict)
-        user_graph[user][rev]['list']=_cleanup_user_list(user_graph[user][rev]['list'])
+        _add_judgement(user_graph[user], rev, full_dict)
 
         return user_graph
     else:
-
-        user_dict = _get_dict_for_user(user)
-
-        # rev_key = (rev, full_dict['timestamp'] - full_dict['t12'])
-        rev_key = rev
-        if not user_dict.has_key(rev_key):
-            user_dict[rev_key] = {}
-            user_dict[rev_key]['timestamp'] = int(full_dict['timestamp']) - int(full_dict['t12'])
-            user_dict[rev_key]['list'] = []
-
-        user_dict[rev_key]['list'].append(full_dict)
-
-        _update_dict_for_user(user, user_dict)
+        # Appended to the edge store, and added to the user's file by compact_edge_store
+        _get_edge_store().append(user, rev, full_dict)
 
 
 def _correct_types(line_dict):
@@ -299,27 +452,211 @@ def _correct_types(line_dict):
 
 
 
-def add_graph_content(file_content, user_graph=None):
+class UserNames(object):
+    """
+    Interns user names into integer ids, each name being kept once.
     """
 
-    :param file_content:
-    :type file_content:
-    :return:
-    :rtype:
+    def __init__(self):
+        self.ids = {}
+        self.names = []
+
+    def intern(self, name):
+        i = self.ids.get(name)
+        if i is None:
+            i = self.ids[name] = len(self.names)
+            self.names.append(name)
+        return i
+
+
+def _chunked(lines, size):
+    lines = iter(lines)
+    while True:
+        chunk = list(itertools.islice(lines, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def parse_edit_lines(lines, names):
+    """
+    Parse a chunk of stats lines into typed columns, one entry per EditInc line:
+
+        timestamp, EDIT_INT_FIELDS  int64
+        EDIT_FLOAT_FIELDS           float64
+        EDIT_NAME_FIELDS            int64 ids of the names in `names`
+
+    :param lines: Lines of a stats file
+    :type lines: list
+    :param names: Interned user names, extended with new names
+    :type names: UserNames
+    :return: Dict of columns keyed by field, and the number of lines which are not EditInc lines
+    :rtype: tuple
     """
-    lines = file_content.splitlines()
+    rows = []
+    skipped = 0
+
     for line in lines:
+        # Lines with the fields in the order WikiTrust writes them are parsed with one match
+        m = _EDIT_LINE.match(line)
+        if m is not None:
+            rows.append(m.groups())
+            continue
+
+        # Otherwise fields are split on their first ':', so names containing ':'
+        # (IPv6 addresses of anonymous editors) are kept whole
         line_broken = line.split('|')
-        if line_broken[0] == "EditInc":
-            line_dict = {i.split(':')[0]: i.split(':')[1] for i in line_broken[2:]}
-            line_dict['timestamp'] = int(line_broken[1])
-            line_dict = _correct_types(line_dict)
+        try:
+            if line_broken[0] != "EditInc":
+                raise ValueError
+            line_dict = dict(i.split(':', 1) for i in line_broken[2:])
+            line_dict['timestamp'] = line_broken[1]
+            rows.append(tuple(line_dict[f] for f in EDIT_LINE_FIELDS))
+        except (ValueError, KeyError, IndexError):
+            if "EditInc" in line:
+                print line
+            skipped += 1
+
+    values = dict(zip(EDIT_LINE_FIELDS, zip(*rows))) if rows else {f: () for f in EDIT_LINE_FIELDS}
+
+    columns = {}
+    for f in ['timestamp'] + EDIT_INT_FIELDS:
+        columns[f] = np.array(values[f], dtype=np.int64)
+    for f in EDIT_FLOAT_FIELDS:
+        columns[f] = np.array(values[f], dtype=np.float64)
+    for f in EDIT_NAME_FIELDS:
+        columns[f] = np.array([names.intern(n) for n in values[f]], dtype=np.int64)
+
+    return columns, skipped
+
+
+def _named_columns(columns, names):
+    """
+    Columns as python lists, with user names in place of their ids
+    """
+    lists = {f: columns[f].tolist() for f in EDIT_FIELDS}
+    for f in EDIT_NAME_FIELDS:
+        lists[f] = [names.names[i] for i in lists[f]]
+    return lists
+
+
+def edit_rows(columns, names):
+    """
+    Rows of parsed columns as dicts, with the keys and types given by _correct_types
+
+    :param columns: Columns from parse_edit_lines
+    :param names: Names the columns were interned into
+    :rtype: iterator
+    """
+    lists = _named_columns(columns, names)
+    for i in xrange(len(lists['timestamp'])):
+        yield {f: lists[f][i] for f in EDIT_FIELDS}
+
+
+def add_graph_columns(columns, names, user_graph, json_keys=False):
+    """
+    Add the edges of parsed columns to user_graph, with the same result as
+    _update_edge called on each row in order.
+
+    Rows are grouped by judged revision (uname1, rev1) with a stable sort,
+    so each revision's entry is looked up once and its judgements are
+    folded from the n01 and n12 columns (see _fold_judgements). Only the
+    judgements entering a list are built as dicts.
+
+    :param columns: Columns from parse_edit_lines
+    :param names: Names the columns were interned into
+    :param user_graph: Graph updated in place
+    :param json_keys: Use the keys of a graph read back from json: unicode user names and revision ids
+    :return: Users whose revisions were added to
+    :rtype: set
+    """
+    users = set()
+    n = len(columns['timestamp'])
+    if not n:
+        return users
+
+    # Stable, so the rows of a revision stay in the order of the lines
+    order = np.lexsort((columns['rev1'], columns['uname1']))
+    uname1, rev1 = columns['uname1'][order], columns['rev1'][order]
+    starts = np.flatnonzero(np.append(True, (uname1[1:] != uname1[:-1]) | (rev1[1:] != rev1[:-1])))
+    ends = np.append(starts[1:], n)
+
+    lists = _named_columns(columns, names)
+    order = order.tolist()
+
+    for start, end in zip(starts.tolist(), ends.tolist()):
+        rows = order[start:end]
+        first = rows[0]
+        user, rev = lists['uname1'][first], lists['rev1'][first]
+        if json_keys:
+            user, rev = user.decode('utf-8') if isinstance(user, str) else user, unicode(rev)
+        users.add(user)
+
+        revisions = user_graph.setdefault(user, {})
+        if not revisions.has_key(rev):
+            revisions[rev] = RevisionEntry(timestamp=lists['timestamp'][first] - lists['t12'][first], list=[])
+
+        _fold_judgements(revisions, rev, [lists['n01'][r] for r in rows], [lists['n12'][r] for r in rows],
+                         lambda i: {f: lists[f][rows[i]] for f in EDIT_FIELDS})
+    return users
+
 
+def add_graph_content(file_content, user_graph=None):
+    """
+
+    :param file_content: Content of a stats file, or an iterable of its lines
+    :type file_content: str | iterable
+    :return:
+    :rtype:
+    """
+    lines = file_content.splitlines() if isinstance(file_content, basestring) else file_content
+    names = UserNames()
+    for chunk in _chunked(lines, PARSE_CHUNK_SIZE):
+        columns, _ = parse_edit_lines(chunk, names)
+        if user_graph is not None:
+            add_graph_columns(columns, names, user_graph)
+            continue
+        for line_dict in edit_rows(columns, names):
             # This entry in line_dict represents judgement of uname1's rev1 revision by uname2 using rev2
-            if user_graph is not None:
-                _update_edge(user=line_dict['uname1'], rev=line_dict['rev1'], full_dict=line_dict, user_graph=user_graph)
-            else:
-                _update_edge(user=line_dict['uname1'], rev=line_dict['rev1'], full_dict=line_dict)
+            _update_edge(user=line_dict['uname1'], rev=line_dict['rev1'], full_dict=line_dict)
+
+
+def iter_stats_lines(filename, counter=None):
+    """
+    Lines of a gzipped stats file, decompressed as a stream through a
+    buffered reader instead of reading the whole file into memory.
+
+    :param filename: Path of .gz stats file
+    :param counter: Dict whose 'bytes' entry is increased by the decompressed size read
+    :type counter: dict
+    :return: Lines without line endings
+    :rtype: iterator
+    """
+    with gzip.open(filename, 'rb') as raw:
+        inp = io.BufferedReader(raw, buffer_size=STATS_BUFFER_SIZE)
+        for line in inp:
+            if counter is not None:
+                counter['bytes'] += len(line)
+            yield line.rstrip('\r\n')
+
+
+def ingest_stats_file(filename, consume):
+    """
+    Stream the lines of a stats file into consume, and report the throughput
+
+    :param filename: Path of .gz stats file
+    :param consume: Function taking an iterable of lines, eg. add_graph_content
+    :return: Decompressed bytes read and seconds taken
+    :rtype: tuple
+    """
+    counter = {'bytes': 0}
+    start = time.time()
+    consume(iter_stats_lines(filename, counter))
+    elapsed = time.time() - start
+
+    print "%s: %d bytes in %.1fs (%.2f MB/s)" % (filename, counter['bytes'], elapsed,
+                                                counter['bytes'] / (1e6 * max(elapsed, 1e-6)))
+    return counter['bytes'], elapsed
 
 
 def get_files(base_dir):  # , user_graph, user_contribs):
@@ -336,10 +673,8 @@ def get_files(base_dir):  # , user_graph, user_contribs):
         for dir in dirs:
             for r2, d2, f2 in os.walk(os.path.join(root, dir)):
                 for file in f2:
-                    with gzip.open(os.path.join(r2, file), 'rb') as input:
-                        file_content = input.read()
-                        # add_to_graph(file_content)
-                        add_graph_content(file_content=file_content)
+                    # add_to_graph(file_content)
+                    ingest_stats_file(os.path.join(r2, file), add_graph_content)
 
 
 def build_graph():
@@ -421,11 +756,30 @@ def get_split_files(base_dir):  # , user_graph):
     :rtype:
     """
 
+    db = DataAccess()
+    db.begin_graph_load()
+    try:
+        for root, dirs, files in os.walk(base_dir):
+            for file in files:
+                ingest_stats_file(os.path.join(root, file), lambda lines: add_to_graph(lines, db=db))
+    finally:
+        db.end_graph_load()
+
+
+def _stats_files(base_dir):
+    """
+    Paths of the stats files in the directories under base_dir,
+    in the order get_user_dict reads them
+
+    :param base_dir: Absolute path of the base directory
+    :type base_dir: str
+    :rtype: iterator
+    """
     for root, dirs, files in os.walk(base_dir):
-        for file in files:
-            with gzip.open(os.path.join(root, file), 'rb') as input:
-                file_content = input.read()
-                add_to_graph(file_content)
+        for dir in dirs:
+            for r2, d2, f2 in os.walk(os.path.join(root, dir)):
+                for file in f2:
+                    yield os.path.join(r2, file)
 
 
 def get_user_dict(base_dir):
@@ -438,16 +792,190 @@ def get_user_dict(base_dir):
     :rtype:
     """
     user_graph = {}
-    for root, dirs, files in os.walk(base_dir):
-        for dir in dirs:
-            for r2, d2, f2 in os.walk(os.path.join(root, dir)):
-                for file in f2:
-                    with gzip.open(os.path.join(r2, file), 'rb') as input:
-                        file_content = input.read()
-                        # add_to_graph(file_content)
-                        add_graph_content(file_content=file_content, user_graph=user_graph)
+    total_bytes, total_time = 0, 0.0
+    for filename in _stats_files(base_dir):
+        # add_to_graph(file_content)
+        read, elapsed = ingest_stats_file(filename, lambda lines: add_graph_content(lines, user_graph=user_graph))
+        total_bytes += read
+        total_time += elapsed
+
+    print "Ingested %d bytes in %.1fs (%.2f MB/s)" % (total_bytes, total_time,
+                                                      total_bytes / (1e6 * max(total_time, 1e-6)))
     return user_graph
 
+
+def parse_stats_columns(lines):
+    """
+    Parse all the lines of a stats file into one set of columns
+
+    :param lines: Lines of a stats file
+    :type lines: iterable
+    :return: Columns as from parse_edit_lines, and the UserNames they were interned into
+    :rtype: tuple
+    """
+    names = UserNames()
+    parts = [parse_edit_lines(chunk, names)[0] for chunk in _chunked(lines, PARSE_CHUNK_SIZE)]
+    if not parts:
+        return parse_edit_lines([], names)[0], names
+    return {f: np.concatenate([part[f] for part in parts]) for f in parts[0]}, names
+
+
+def _parse_stats_file(filename):
+    """
+    Worker of get_user_dict_parallel. Parse one stats file into columns.
+
+    :param filename: Path of .gz stats file
+    :return: Columns and their UserNames, decompressed bytes read, seconds taken
+    :rtype: tuple
+    """
+    parsed = []
+    read, elapsed = ingest_stats_file(filename, lambda lines: parsed.append(parse_stats_columns(lines)))
+    return parsed[0], read, elapsed
+
+
+def _parse_new_stats_lines(task):
+    """
+    Worker of update_user_graph. Parse the lines of a stats file not ingested
+    before (see stats_manifest.new_lines) into columns.
+
+    :param task: Path of .gz stats file, and its manifest entry (None for a new file)
+    :type task: tuple
+    :return: Columns and their UserNames, decompressed bytes read, seconds taken,
+             and the 'lines' and 'lines_sha1' to record in the manifest
+    :rtype: tuple
+    """
+    filename, entry = task
+    record = {}
+    counter = {'bytes': 0}
+    start = time.time()
+    parsed = parse_stats_columns(stats_manifest.new_lines(lambda: iter_stats_lines(filename, counter), entry, record))
+    elapsed = time.time() - start
+
+    print "%s: %d bytes in %.1fs (%.2f MB/s)" % (filename, counter['bytes'], elapsed,
+                                                counter['bytes'] / (1e6 * max(elapsed, 1e-6)))
+    return parsed, counter['bytes'], elapsed, record
+
+
+def get_user_dict_parallel(base_dir, processes=None):
+    """
+    Same graph as get_user_dict, with the stats files parsed by a pool of processes.
+
+    Each file is parsed into columns by a worker. The columns are added to
+    the graph in the order get_user_dict reads the files (not the order
+    workers finish), so edges are updated in the same order of lines as
+    get_user_dict and the graph is the same.
+
+    :param base_dir: Absolute path of the base directory
+    :type base_dir: str
+    :param processes: Size of the pool. Default is the number of CPUs
+    :type processes: int
+    :return:
+    :rtype: dict
+    """
+    user_graph = {}
+    _parse_files_parallel(list(_stats_files(base_dir)), user_graph, processes=processes)
+    return user_graph
+
+
+def _parse_files_parallel(tasks, user_graph, processes=None, worker=_parse_stats_file, json_keys=False):
+    """
+    Parse the stats files with a pool of processes and add their columns
+    to user_graph in the order of tasks.
+
+    :param tasks: Argument of worker for each stats file
+    :type tasks: list
+    :param user_graph: Graph updated in place
+    :type user_graph: dict
+    :param processes: Size of the pool. Default is the number of CPUs
+    :type processes: int
+    :param worker: Function parsing a file, which returns its columns and UserNames, the
+                   decompressed bytes read and the seconds taken, then any other values
+    :param json_keys: Whether user_graph has the keys of a graph read back from json (see add_graph_columns)
+    :return: Users whose revisions were added to, and the other values returned by worker for each task
+    :rtype: tuple
+    """
+    users = set()
+    extras = []
+    total_bytes = 0
+    if not tasks:
+        return users, extras
+
+    start = time.time()
+    pool = multiprocessing.Pool(min(processes or multiprocessing.cpu_count(), len(tasks)))
+    try:
+        for result in pool.imap(worker, tasks):
+            columns, names = result[0]
+            users.update(add_graph_columns(columns, names, user_graph, json_keys=json_keys))
+            total_bytes += result[1]
+            extras.append(result[3:])
+    finally:
+        pool.close()
+        pool.join()
+    elapsed = time.time() - start
+
+    print "Ingested %d bytes from %d files in %.1fs (%.2f MB/s)" % (total_bytes, len(tasks), elapsed,
+                                                                    total_bytes / (1e6 * max(elapsed, 1e-6)))
+    return users, extras
+
+
+def update_user_graph(base_dir, graph_file, manifest_file, processes=None):
+    """
+    Ingest only the stats files which are new or changed since the last run
+    (see stats_manifest) and merge their edges into the graph in graph_file.
+
+    Of a changed file, only the lines after those ingested before are merged
+    (see stats_manifest.new_lines), so its judgements are not added twice.
+    If the manifest is missing or does not describe graph_file (eg. a graph
+    written by a full build), the graph is rebuilt from all the stats files.
+
+    :param base_dir: Absolute path of the stats directory
+    :param graph_file: Path of user_graph.json, created if missing
+    :param manifest_file: Path of the manifest of ingested files
+    :param processes: Size of the pool parsing files
+    :return: Users changed by the update
+    :rtype: set
+    """
+    filenames = list(_stats_files(base_dir))
+    if not filenames:
+        print "No stats files in %s" % base_dir
+        return set()
+
+    manifest = stats_manifest.load_manifest(manifest_file)
+    rebuild = not stats_manifest.covers_graph(manifest, graph_file)
+    if rebuild:
+        print "Manifest does not cover %s, rebuilding it from all stats files" % graph_file
+        manifest = stats_manifest.empty_manifest()
+
+    changed = stats_manifest.changed_files(filenames, manifest)
+    if not changed:
+        stats_manifest.save_manifest(manifest_file, manifest)
+        print "No new stats files"
+        return set()
+
+    user_graph = {}
+    if not rebuild and os.path.isfile(graph_file):
+        with open(graph_file, 'rb') as inp:
+            user_graph = Serializable.load(inp)
+
+    # New lines are added on top of the graph, as if they followed the lines ingested before
+    tasks = [(f, manifest['files'].get(f)) for f, _ in changed]
+    users, records = _parse_files_parallel(tasks, user_graph, processes=processes, worker=_parse_new_stats_lines,
+                                           json_keys=True)
+
+    with open(graph_file + '.tmp', 'wb') as outp:
+        outp.write(Serializable.dumps(user_graph))
+    os.rename(graph_file + '.tmp', graph_file)
+
+    # Manifest is written once the graph holds the files' edges
+    for (filename, entry), (record,) in zip(changed, records):
+        entry.update(record)
+        manifest['files'][filename] = entry
+    manifest['graph'] = stats_manifest.file_entry(graph_file)
+    stats_manifest.save_manifest(manifest_file, manifest)
+
+    print "Ingested %d new or changed files, %d users changed" % (len(changed), len(users))
+    return users
+
 #
 # def _compute_lstm_forward(user, timestamp, depth_now, max_depth):
 #     user_revisions = _get_user_revisions(user, timestamp)
@@ -492,6 +1020,101 @@ def get_user_dict(base_dir):
 
 
 
+class TestParseEditLines(unittest.TestCase):
+
+    def _line(self, **names):
+        values = dict(timestamp='1113671446', PageId='7954', Delta='2.50', rev0='10550535', uid0='55767',
+                      uname0='R. fiend', rev1='11805828', uid1='0', uname1='210.49.80.154', rev2='12543256',
+                      uid2='231414', uname2='Jack39', d01='16.00', d02='611.67', d12='613.17', dp2='302.00',
+                      n01='6', n12='3', t01='3429205', t12='1543097')
+        values.update(names)
+        return 'EditInc|%s|' % values['timestamp'] + '|'.join(
+            '%s:%s' % (f, values[f]) for f in EDIT_LINE_FIELDS[1:])
+
+    def test_fields(self):
+        names = UserNames()
+        columns, skipped = parse_edit_lines([self._line(), 'Other|line'], names)
+        self.assertEqual(skipped, 1)
+        self.assertEqual(list(columns['timestamp']), [1113671446])
+        self.assertEqual(list(columns['rev1']), [11805828])
+        self.assertEqual(list(columns['d02']), [611.67])
+        self.assertEqual([names.names[i] for i in columns['uname1']], ['210.49.80.154'])
+
+    def test_ipv6_names(self):
+        # Names containing ':' are kept whole, not cut at the first ':'
+        names = UserNames()
+        columns, skipped = parse_edit_lines([self._line(uname1='2001:db8::1', uname2='2001:db8::2')], names)
+        self.assertEqual(skipped, 0)
+        self.assertEqual([names.names[i] for i in columns['uname1']], ['2001:db8::1'])
+        self.assertEqual([names.names[i] for i in columns['uname2']], ['2001:db8::2'])
+        self.assertEqual(list(columns['rev2']), [12543256])
+
+
+class TestParallelIngestion(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.base_dir = os.path.join(self.tmp, 'stats')
+        self.rnd = random.Random(7)
+        # Few users and revisions, so that revisions are judged in several files
+        self.files = [self._write(os.path.join(self.base_dir, 'dir%d' % (i % 2), 'stats_%d.gz' % i),
+                                  self._lines(800)) for i in range(4)]
+        self.stdout, sys.stdout = sys.stdout, open(os.devnull, 'w')
+
+    def tearDown(self):
+        sys.stdout.close()
+        sys.stdout = self.stdout
+        shutil.rmtree(self.tmp)
+
+    def _lines(self, n):
+        rnd = self.rnd
+        lines = []
+        for _ in range(n):
+            values = dict(timestamp=rnd.randint(10 ** 9, 2 * 10 ** 9), PageId=rnd.randint(1, 20),
+                          Delta='%.2f' % (rnd.random() * 50), rev0=rnd.randint(1, 10 ** 6), uid0=1, uname0='x',
+                          rev1=rnd.randint(1, 60), uid1=2, uname1='user %d' % rnd.randint(0, 5),
+                          rev2=rnd.randint(1, 10 ** 6), uid2=3, uname2='user %d' % rnd.randint(0, 5),
+                          d01='%.2f' % (rnd.random() * 100), d02='%.2f' % (rnd.random() * 100),
+                          d12='%.2f' % (rnd.random() * 100), dp2='%.2f' % (rnd.random() * 100),
+                          n01=rnd.randint(1, 4), n12=rnd.randint(1, 4), t01=rnd.randint(0, 10 ** 6),
+                          t12=rnd.randint(0, 10 ** 6))
+            lines.append('EditInc|%s|' % values['timestamp'] + '|'.join(
+                '%s:%s' % (f, values[f]) for f in EDIT_LINE_FIELDS[1:]))
+        return lines
+
+    def _write(self, filename, lines, mode='wb'):
+        if not os.path.isdir(os.path.dirname(filename)):
+            os.makedirs(os.path.dirname(filename))
+        with gzip.open(filename, mode) as outp:
+            outp.write(''.join(line + '\n' for line in lines))
+        return filename
+
+    @staticmethod
+    def _as_json(user_graph):
+        return json.loads(Serializable.dumps(user_graph))
+
+    def test_parallel_same_as_serial(self):
+        serial = get_user_dict(self.base_dir)
+        self.assertTrue(any(len(data['list']) > 1 for revs in serial.values() for data in revs.values()))
+        self.assertEqual(self._as_json(get_user_dict_parallel(self.base_dir, processes=3)), self._as_json(serial))
+
+    def test_update_same_as_serial(self):
+        graph_file = os.path.join(self.tmp, 'user_graph.json')
+        manifest_file = os.path.join(self.tmp, 'stats_manifest.json')
+        update_user_graph(self.base_dir, graph_file, manifest_file, processes=2)
+
+        # Lines appended to the last file read
+        last = list(_stats_files(self.base_dir))[-1]
+        with gzip.open(last, 'rb') as inp:
+            lines = inp.read().splitlines()
+        self._write(last, lines + self._lines(300))
+        update_user_graph(self.base_dir, graph_file, manifest_file, processes=2)
+
+        with open(graph_file, 'rb') as inp:
+            updated = json.load(inp)
+        self.assertEqual(updated, self._as_json(get_user_dict(self.base_dir)))
+
+
 if __name__ == "__main__":
     base_dir = os.path.join(os.getcwd(),'data','%s_pipe/stats/' % (WIKINAME))
     print base_dir
@@ -521,6 +1144,19 @@ if __name__ == "__main__":
     # get_split_files(base_dir)
     if FILE_MODE:
         get_files(base_dir)
+        print "User files written", compact_edge_store()
+
+    elif INCREMENTAL_INGESTION:
+        results_dir = os.path.join(os.getcwd(), 'results', WIKINAME)
+        update_user_graph(base_dir,
+                          graph_file=os.path.join(results_dir, 'user_graph.json'),
+                          manifest_file=os.path.join(results_dir, 'stats_manifest.json'))
+
+    elif PARALLEL_INGESTION:
+        user_graph = get_user_dict_parallel(base_dir)
+        filename = os.path.join(os.getcwd(), 'results', WIKINAME, 'user_graph.json')
+        with open(filename, 'wb') as outp:
+            outp.write(Serializable.dumps(user_graph))
 
     else:
         user_graph = get_user_dict(base_dir)
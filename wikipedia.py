@@ -9,8 +9,11 @@
 from datetime import datetime
 import json
 import logging
+import threading
+import time
 import urllib
 import urllib2
+import urlparse
 from pprint import pprint
 
 __author__ = 'rakshit'
@@ -19,6 +22,7 @@ DATE_PATTERN = "%a, %d %b %Y %H:%M:%S %z"
 WIKI_BASE_URL = "http://en.wikipedia.org/w/api.php"
 
 WIKI_MAX_REVISION_LIMIT = 500  # Update if any change observed. Not used mostly but kept for reference.
+WIKI_MAX_REVIDS = 50  # Maximum number of revids in a single prop=revisions query
 
 ############################################################
 # Parameter values to be sent for concerned GET requests
@@ -87,6 +91,111 @@ WIKI_PARAMS = {
 }
 
 
+class RequestLimiter(object):
+    """
+    Limits on the requests made to a host, shared by all threads:
+    a maximum number of requests in flight, and a token bucket rate
+    limit of `rate` requests per second with bursts of up to `burst`.
+
+    Used as a context manager around each request.
+    """
+
+    def __init__(self, max_in_flight=None, rate=None, burst=None):
+        """
+
+        :param max_in_flight: Maximum number of concurrent requests, None for no limit
+        :param rate: Requests per second, None for no limit
+        :param burst: Size of the token bucket, 1 by default
+        """
+        self.max_in_flight = max_in_flight
+        self.rate = rate
+        self.burst = burst or 1
+        self._slots = threading.BoundedSemaphore(max_in_flight) if max_in_flight else None
+        self._lock = threading.Lock()
+        self._tokens = float(self.burst)
+        self._last = time.time()
+
+    def _take_token(self):
+        # Wait until the bucket holds a token, and take it
+        while True:
+            with self._lock:
+                now = time.time()
+                self._tokens = min(self.burst, self._tokens + (now - self._last) * self.rate)
+                self._last = now
+                if self._tokens >= 1.0:
+                    self._tokens -= 1.0
+                    return
+                wait = (1.0 - self._tokens) / self.rate
+            time.sleep(wait)
+
+    def __enter__(self):
+        if self._slots is not None:
+            self._slots.acquire()
+        if self.rate:
+            try:
+                self._take_token()
+            except:
+                if self._slots is not None:
+                    self._slots.release()
+                raise
+        return self
+
+    def __exit__(self, *exc_info):
+        if self._slots is not None:
+            self._slots.release()
+        return False
+
+
+# Request limits per host (netloc of the URL). Hosts not in here are not limited.
+_LIMITERS = {}
+_NO_LIMIT = RequestLimiter()
+
+
+def set_request_limits(max_in_flight=None, rate=None, burst=None, url=None):
+    """
+    Set the limits of requests made by _get to the host of url
+
+    :param max_in_flight: Maximum number of concurrent requests, None for no limit
+    :param rate: Requests per second, None for no limit
+    :param burst: Size of the token bucket
+    :param url: URL on the host, WIKI_BASE_URL by default
+    :return: Previous limits of the host, to give to restore_request_limits. None if there were none
+    :rtype: RequestLimiter
+    """
+    host = urlparse.urlparse(url or WIKI_BASE_URL).netloc
+    previous = _LIMITERS.get(host)
+    _LIMITERS[host] = RequestLimiter(max_in_flight=max_in_flight, rate=rate, burst=burst)
+    return previous
+
+
+def restore_request_limits(previous, url=None):
+    """
+    Put back the limits returned by set_request_limits
+
+    :param previous: RequestLimiter, None for no limits
+    :param url: URL on the host, WIKI_BASE_URL by default
+    """
+    host = urlparse.urlparse(url or WIKI_BASE_URL).netloc
+    if previous is None:
+        _LIMITERS.pop(host, None)
+    else:
+        _LIMITERS[host] = previous
+
+
+# Cache of revisions in front of WikiFetch.fetch_revisions_for_page (see revision_cache.py), None for no cache
+_REVISION_CACHE = None
+
+
+def set_revision_cache(cache):
+    """
+    Set the revision cache used by WikiFetch.fetch_revisions_for_page
+
+    :param cache: revision_cache.RevisionCache, None to stop caching
+    """
+    global _REVISION_CACHE
+    _REVISION_CACHE = cache
+
+
 def _get(url="", values=None, headers=None):
     # HTTP GET to fetch from external URLs
     """
@@ -101,10 +210,12 @@ def _get(url="", values=None, headers=None):
         values = {}
     try:
         data = urllib.urlencode(values)
+        limiter = _LIMITERS.get(urlparse.urlparse(url).netloc, _NO_LIMIT)
         url = url + "?" + data
         req = urllib2.Request(url=url, headers=headers)
-        response = urllib2.urlopen(req)
-        result = response.read()
+        with limiter:
+            response = urllib2.urlopen(req)
+            result = response.read()
         result = json.loads(result)
     except urllib2.HTTPError as e:
         print e.code
@@ -201,6 +312,15 @@ class WikiFetch:
         :return:
         """
 
+        # Revisions with content are cached by (pageid, revid). A lookup of the
+        # single revision start_rev can be answered by the cache.
+        cache = _REVISION_CACHE if props is None else None
+        if (cache is not None and chunk_size == 1 and not continuous and not exclude and not include
+                and direction in (None, "older")):
+            revision = cache.get(pageid, start_rev)
+            if revision is not None:
+                return [revision]
+
         wiki_access = dict(WIKI_PARAMS['revisions'])
 
         # Setting parameters in GET request dict
@@ -240,6 +360,11 @@ class WikiFetch:
         except Exception as e:
             print e
             revisions = []
+
+        if cache is not None:
+            for revision in revisions:
+                cache.put(pageid, revision)
+
         # Check for continuous
         if continuous:
             # Recursively fetch all available revisions till latest
@@ -272,6 +397,56 @@ class WikiFetch:
 
         return revisions
 
+    @staticmethod
+    def fetch_revisions_by_ids(revids, props=None):
+        """
+        Fetch revisions by their IDs, WIKI_MAX_REVIDS per request.
+        Continuations returned by the API (when the content of a batch is
+        too large for one response) are followed.
+
+        The revisions are the same dicts as those of fetch_revisions_for_page,
+        and are added to the revision cache.
+
+        :param revids: Revision IDs
+        :param props: rvprop to request instead of the default one
+        :return: Dict of revid to revision. Revisions not found are left out.
+        :rtype: dict
+        """
+        revids = list(revids)
+        cache = _REVISION_CACHE if props is None else None
+        revisions = {}
+
+        for start in range(0, len(revids), WIKI_MAX_REVIDS):
+            wiki_access = dict(WIKI_PARAMS['revisions'])
+            wiki_access['revids'] = '|'.join(str(r) for r in revids[start:start + WIKI_MAX_REVIDS])
+            if props is not None:
+                wiki_access['rvprop'] = props
+
+            while True:
+                result = _get(url=WIKI_BASE_URL, values=wiki_access)
+
+                # Extract revisions of all pages from resulting json
+                try:
+                    pages = result["query"]["pages"]
+                except KeyError as e:
+                    logging.info("Error is {}".format(e))
+                    pages = {}
+                except Exception as e:
+                    print e
+                    pages = {}
+                for pageid, page in pages.iteritems():
+                    for revision in page.get("revisions", []):
+                        revisions[revision['revid']] = revision
+                        if cache is not None:
+                            cache.put(pageid, revision)
+
+                # Follow continuation of this batch
+                if "continue" not in result:
+                    break
+                wiki_access.update(result["continue"])
+
+        return revisions
+
     @staticmethod
     def get_user_contributions(username=None,
                                start_time=None,